@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import ChatGroup, GroupMessage
+from .models import ArchivedSegment, ChatGroup, ChatImage, GroupMessage, Notification
 
 
 @admin.register(ChatGroup)
@@ -26,9 +26,31 @@ class GroupMessageAdmin(admin.ModelAdmin):
     readonly_fields = ['created']
 
     def body_preview(self, obj):
-        from .encryption import decrypt_message
-        decrypted = decrypt_message(obj.encrypted_body) if obj.is_encrypted else obj.encrypted_body
+        from .encryption import decrypt_group_message
+        decrypted = decrypt_group_message(obj)
         if decrypted:
             return decrypted[:50] + '...' if len(decrypted) > 50 else decrypted
         return '[Encrypted]'
     body_preview.short_description = 'Message'
+
+
+@admin.register(ArchivedSegment)
+class ArchivedSegmentAdmin(admin.ModelAdmin):
+    list_display = ['group', 'first_id', 'last_id', 'message_count', 'last_created', 'size']
+    list_filter = ['group']
+    readonly_fields = [field.name for field in ArchivedSegment._meta.fields]
+
+
+@admin.register(ChatImage)
+class ChatImageAdmin(admin.ModelAdmin):
+    list_display = ['sha256', 'format', 'width', 'height', 'size', 'processed_at', 'created']
+    search_fields = ['sha256']
+    readonly_fields = [field.name for field in ChatImage._meta.fields]
+
+
+@admin.register(Notification)
+class NotificationAdmin(admin.ModelAdmin):
+    list_display = ['user', 'kind', 'chat', 'actor', 'count', 'created']
+    list_filter = ['kind']
+    search_fields = ['user__username']
+    raw_id_fields = ['user', 'chat', 'actor']
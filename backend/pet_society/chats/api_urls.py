@@ -5,6 +5,7 @@ from . import views
 # API Router
 router = DefaultRouter()
 router.register(r'groups', views.ChatGroupViewSet, basename='chatgroup')
+router.register(r'notifications', views.NotificationViewSet, basename='notification')
 
 urlpatterns = [
     path('', include(router.urls)),
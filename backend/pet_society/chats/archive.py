@@ -0,0 +1,244 @@
+import base64
+import gzip
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from itertools import takewhile
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils.dateparse import parse_datetime
+
+
+def _serialize(message):
+    return {
+        'id': message.id,
+        'author_id': message.author_id,
+        'encrypted_body': message.encrypted_body,
+        'ciphertext': base64.b64encode(bytes(message.ciphertext)).decode() if message.ciphertext else None,
+        'key_id': message.key_id,
+        'image': message.image.name if message.image else None,
+        'media_id': message.media_id,
+        'message_type': message.message_type,
+        'is_encrypted': message.is_encrypted,
+        'created': message.created.isoformat(),
+        'provisional_id': message.provisional_id,
+    }
+
+
+class MessageArchive:
+    """
+    Cold storage for old chat messages.
+
+    A group's oldest messages are moved out of GroupMessage in chunks, each
+    into a gzipped JSON lines segment under ``archive_dir/<group id>/`` with an
+    ArchivedSegment row as its index entry. Messages keep their ids and stay
+    encrypted. A group's archive only ever holds a prefix of its history by
+    id, so history pagination simply continues into the archive once the
+    group's rows in GroupMessage run out.
+
+    Each chunk is written to its file first, then indexed and deleted from
+    GroupMessage in one transaction. An interrupted run leaves at most an
+    unindexed file, which the next run overwrites or prunes.
+    """
+
+    def __init__(self, archive_dir, compress_level=6, cache_size=16):
+        self.archive_dir = str(archive_dir)
+        self.compress_level = compress_level
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # {path: [record]}, recently read segments
+        self._lock = threading.Lock()
+
+    # Archiving
+
+    def archive_chunk(self, group_id, cutoff, chunk_size):
+        """
+        Move up to ``chunk_size`` of a group's oldest messages created before
+        ``cutoff`` into a new segment. Returns the ArchivedSegment, or None
+        when the group has nothing left to archive.
+        """
+        from .models import ArchivedSegment, GroupMessage
+
+        oldest = GroupMessage.objects.filter(group_id=group_id).order_by('id')[:chunk_size]
+        # Stop at the first newer message, so the archive stays a prefix by id
+        chunk = list(takewhile(lambda message: message.created < cutoff, oldest))
+        if not chunk:
+            return None
+
+        path = os.path.join(str(group_id), f'{chunk[0].id:012d}-{chunk[-1].id:012d}.jsonl.gz')
+        data = gzip.compress(
+            b''.join(json.dumps(_serialize(message)).encode() + b'\n' for message in chunk),
+            self.compress_level,
+        )
+        self._write(path, data)
+
+        try:
+            with transaction.atomic():
+                segment = ArchivedSegment.objects.create(
+                    group_id=group_id,
+                    first_id=chunk[0].id,
+                    last_id=chunk[-1].id,
+                    first_created=chunk[0].created,
+                    last_created=chunk[-1].created,
+                    message_count=len(chunk),
+                    path=path,
+                    size=len(data),
+                )
+                GroupMessage.objects.filter(id__in=[message.id for message in chunk]).delete()
+        except Exception:
+            self._remove(path)
+            raise
+        return segment
+
+    def _write(self, path, data):
+        full_path = os.path.join(self.archive_dir, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        temp_path = f'{full_path}.tmp'
+        with open(temp_path, 'wb') as segment_file:
+            segment_file.write(data)
+            segment_file.flush()
+            os.fsync(segment_file.fileno())
+        os.replace(temp_path, full_path)
+
+    def _remove(self, path):
+        try:
+            os.remove(os.path.join(self.archive_dir, path))
+        except FileNotFoundError:
+            pass
+
+    def prune_orphans(self, min_age=3600):
+        """
+        Delete segment files without an index entry, e.g. from an interrupted
+        run or a deleted group. Files younger than ``min_age`` seconds are
+        left alone, they may belong to a chunk being archived right now.
+        """
+        from .models import ArchivedSegment
+
+        indexed = set(ArchivedSegment.objects.values_list('path', flat=True))
+        removed = 0
+        for root, _, files in os.walk(self.archive_dir):
+            for name in files:
+                full_path = os.path.join(root, name)
+                path = os.path.relpath(full_path, self.archive_dir)
+                if path not in indexed and time.time() - os.path.getmtime(full_path) >= min_age:
+                    os.remove(full_path)
+                    removed += 1
+        return removed
+
+    # Reading
+
+    def read_segment(self, segment):
+        """The records of a segment, oldest first"""
+        with self._lock:
+            records = self._cache.get(segment.path)
+            if records is not None:
+                self._cache.move_to_end(segment.path)
+                return records
+        with open(os.path.join(self.archive_dir, segment.path), 'rb') as segment_file:
+            records = [json.loads(line) for line in gzip.decompress(segment_file.read()).splitlines()]
+        with self._lock:
+            self._cache[segment.path] = records
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return records
+
+    def messages_before(self, group_id, before_id, limit, offset=0):
+        """Archived messages with ids below ``before_id`` (None for all), newest first"""
+        from .models import ArchivedSegment
+
+        segments = ArchivedSegment.objects.filter(group_id=group_id).order_by('-last_id')
+        if before_id is not None:
+            segments = segments.filter(first_id__lt=before_id)
+        records = []
+        for segment in segments:
+            matching = [
+                record for record in reversed(self.read_segment(segment))
+                if before_id is None or record['id'] < before_id
+            ]
+            skipped = min(offset, len(matching))
+            offset -= skipped
+            records.extend(matching[skipped:limit - len(records) + skipped])
+            if len(records) >= limit:
+                break
+        return self.to_messages(records)
+
+    def messages_after(self, group_id, after_id, limit):
+        """Archived messages with ids above ``after_id``, oldest first"""
+        from .models import ArchivedSegment
+
+        segments = ArchivedSegment.objects.filter(group_id=group_id, last_id__gt=after_id).order_by('first_id')
+        records = []
+        for segment in segments:
+            records.extend(
+                [record for record in self.read_segment(segment) if record['id'] > after_id][:limit - len(records)]
+            )
+            if len(records) >= limit:
+                break
+        return self.to_messages(records)
+
+    def contains(self, group_id, message_id):
+        from .models import ArchivedSegment
+
+        return ArchivedSegment.objects.filter(
+            group_id=group_id, first_id__lte=message_id, last_id__gte=message_id
+        ).exists()
+
+    def to_messages(self, records):
+        """Unsaved GroupMessage instances for archived records, authors and images attached"""
+        from .models import ChatImage, GroupMessage
+
+        authors = get_user_model().objects.in_bulk({record['author_id'] for record in records})
+        media_ids = {record['media_id'] for record in records if record.get('media_id')}
+        media = ChatImage.objects.in_bulk(media_ids) if media_ids else {}
+        messages = []
+        for record in records:
+            message = GroupMessage(
+                id=record['id'],
+                author_id=record['author_id'],
+                encrypted_body=record['encrypted_body'],
+                ciphertext=base64.b64decode(record['ciphertext']) if record['ciphertext'] else None,
+                key_id=record['key_id'],
+                image=record['image'],
+                media_id=record.get('media_id'),
+                message_type=record['message_type'],
+                is_encrypted=record['is_encrypted'],
+                created=parse_datetime(record['created']),
+                provisional_id=record['provisional_id'],
+            )
+            if record['author_id'] in authors:
+                message.author = authors[record['author_id']]
+            if message.media_id in media:
+                message.media = media[message.media_id]
+            messages.append(message)
+        return messages
+
+
+_archive = None
+_archive_lock = threading.Lock()
+
+
+def get_message_archive():
+    """Return the process-wide message archive configured by CHAT_ARCHIVE"""
+    global _archive
+    if _archive is None:
+        with _archive_lock:
+            if _archive is None:
+                config = getattr(settings, 'CHAT_ARCHIVE', {})
+                _archive = MessageArchive(
+                    config.get('DIR', os.path.join(settings.BASE_DIR, 'chat_archive')),
+                    compress_level=config.get('COMPRESS_LEVEL', 6),
+                    cache_size=config.get('CACHE_SIZE', 16),
+                )
+    return _archive
+
+
+@receiver(setting_changed)
+def _reset_archive(setting, **kwargs):
+    global _archive
+    if setting == 'CHAT_ARCHIVE':
+        _archive = None
@@ -1,233 +1,344 @@
 import json
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from channels.layers import get_channel_layer
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from .models import ChatGroup, GroupMessage
-from .encryption import encrypt_message
+from django.db import transaction
+from .models import GroupMessage
+from .encryption import message_storage_fields, decrypt_messages
+from .presence import get_presence_registry
+from .fanout import get_notification_fanout
+from .persistence import get_write_behind_writer, write_behind_enabled
+from .frames import FrameProtocolMixin, encode_frame
+from .groups import room_group_name
+from .idle import IdleTimeoutMixin
+from .typing import get_typing_coordinator
+from .search import index_message, search_tokens
 
 User = get_user_model()
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
-        self.room_name = self.scope['url_route']['kwargs']['room_name']
-        self.room_group_name = f'chat_{self.room_name}'
-        self.user = self.scope['user']
+class ChatRoomMixin:
+    """
+    What a socket does in one chat room: the membership check, presence,
+    typing, resuming, posting messages and handling the room's channel events.
 
-        # Check if user is authenticated
-        if not self.user.is_authenticated:
-            await self.close(code=4001)  # Custom close code for authentication error
-            return
+    ChatConsumer is one room per socket; a MultiplexConsumer keeps one
+    RoomSubscription per room. Both provide ``user``, ``channel_layer``,
+    ``channel_name``, ``send_payload`` and ``send_frame``.
+    """
 
-        try:
-            # Join room group
-            await self.channel_layer.group_add(
-                self.room_group_name,
-                self.channel_name
-            )
+    def init_room(self, room_name, presence=None, after_id=None):
+        self.room_name = room_name
+        self.room_group_name = room_group_name(room_name)
+        self.room = None
+        # presence=delta: one snapshot, then joined/left deltas. Otherwise the
+        # full user_list_update on every change, rebuilt locally from the deltas.
+        self.presence_mode = 'delta' if presence == 'delta' else 'list'
+        self.online_users = {}
+        # after_id: resume a session, replaying messages newer than this id
+        after_id = str(after_id) if after_id is not None else ''
+        self.resume_after = int(after_id) if after_id.isdigit() else None
+        self.replayed_through = None
 
-            # Add user to online users
-            await self.add_user_to_room()
+    async def check_membership(self):
+        """Resolve the room once; returns a close code unless the user is a member"""
+        self.room = await get_notification_fanout().get_room(self.room_name)
+        if self.room is None:
+            return 4004  # Room does not exist
+        if self.user.id not in self.room.member_ids:
+            # The cached member list may predate an invite, check once more
+            get_notification_fanout().invalidate(self.room_name)
+            self.room = await get_notification_fanout().get_room(self.room_name)
+            if self.room is None or self.user.id not in self.room.member_ids:
+                return 4003  # Not a member of this room
+        return None
 
-            await self.accept()
+    async def enter_room(self):
+        # Join room group
+        await self.channel_layer.group_add(
+            self.room_group_name,
+            self.channel_name
+        )
+        get_typing_coordinator().register(self.room_name, self)
 
-            # Send user list to all users in the room
-            await self.send_user_list()
-        except Exception as e:
-            print(f"WebSocket connection error: {e}")
-            await self.close(code=4000)  # Custom close code for general error
+        # Mark the user online in this room and tell the others
+        registry = get_presence_registry()
+        if await registry.join(self.room_name, self.user, self.channel_name):
+            registry.announce_join(self.room_name, self.user.id, self.user.username)
 
-    async def disconnect(self, close_code):
-        if hasattr(self, 'room_group_name') and self.user.is_authenticated:
-            # Remove user from online users
-            await self.remove_user_from_room()
-
-            # Leave room group
-            await self.channel_layer.group_discard(
-                self.room_group_name,
-                self.channel_name
-            )
+        await self.send_presence_snapshot()
 
-            # Send updated user list
-            await self.send_user_list()
+        if self.resume_after is not None:
+            await self.replay_missed_messages(self.resume_after)
 
-    async def receive(self, text_data):
-        try:
-            text_data_json = json.loads(text_data)
-            message_type = text_data_json.get('type', 'chat_message')
+    async def leave_room(self):
+        typing = get_typing_coordinator()
+        typing.unregister(self.room_name, self)
+        await typing.stop(self.channel_layer, self.room_name, self.user)
 
-            if message_type == 'chat_message':
-                message = text_data_json['message']
-                
-                # Save message to database
-                group_message, original_message = await self.save_message(message)
-                
-                # Send message to room group
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'chat_message',
-                        'message': original_message,  # Send the original (decrypted) message
-                        'username': self.user.username,
-                        'user_id': self.user.id,
-                        'timestamp': group_message.created.isoformat(),
-                        'message_id': group_message.id,
-                    }
-                )
-
-                # Send global notifications to all chat members
-                await self.send_message_notifications(group_message, message)
-            elif message_type == 'typing':
-                # Handle typing indicator
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'typing_indicator',
-                        'username': self.user.username,
-                        'user_id': self.user.id,
-                        'is_typing': text_data_json.get('is_typing', False),
-                    }
-                )
-        except json.JSONDecodeError:
-            await self.send(text_data=json.dumps({
-                'error': 'Invalid JSON format'
-            }))
-        except Exception as e:
-            await self.send(text_data=json.dumps({
-                'error': f'Error processing message: {str(e)}'
-            }))
+        # Remove user from online users
+        registry = get_presence_registry()
+        if await registry.leave(self.room_name, self.channel_name):
+            registry.announce_leave(self.room_name, self.user.id)
+
+        # Leave room group
+        await self.channel_layer.group_discard(
+            self.room_group_name,
+            self.channel_name
+        )
+
+    async def post_message(self, message):
+        # Save message to database, or queue it for a bulk insert
+        provisional = write_behind_enabled()
+        if provisional:
+            group_message, original_message = self.queue_message(message)
+        else:
+            group_message, original_message = await self.save_message(message)
+
+        # Send message to room group, encoded once for every socket
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            {
+                'type': 'chat_message',
+                'room': self.room_name,
+                'message_id': group_message.id,
+                'frame': encode_frame({
+                    'type': 'chat_message',
+                    'message': original_message,  # Send the original (decrypted) message
+                    'username': self.user.username,
+                    'user_id': self.user.id,
+                    'timestamp': group_message.created.isoformat(),
+                    'message_id': group_message.id,
+                    'provisional': provisional,
+                }),
+            }
+        )
+
+        # Send global notifications to all chat members
+        await self.send_message_notifications(group_message, message)
+
+    async def update_typing(self, is_typing):
+        # Handle typing indicator, throttled per user and room
+        await get_typing_coordinator().update(self.channel_layer, self.room_name, self.user, is_typing)
+
+    async def room_access_revoked(self):
+        """The user was removed from the room; closes the socket with 4003 unless overridden"""
+        await self.close(code=4003)
+
+    # Room channel events
 
     async def chat_message(self, event):
+        # Already sent by the replay of a resumed session
+        if self.replayed_through is not None and isinstance(event.get('message_id'), int) \
+                and event['message_id'] <= self.replayed_through:
+            return
         # Send message to WebSocket (including back to sender for confirmation)
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'message': event['message'],
-            'username': event['username'],
-            'user_id': event['user_id'],
-            'timestamp': event['timestamp'],
-            'message_id': event['message_id'],
-        }))
+        await self.send_frame(event['frame'])
+
+    async def message_persisted(self, event):
+        # Write-behind insert finished: real ids for provisional message ids
+        await self.send_frame(event['frame'])
 
     async def typing_indicator(self, event):
-        # Don't send typing indicator to the user who is typing
-        if event['user_id'] != self.user.id:
-            await self.send(text_data=json.dumps({
-                'type': 'typing_indicator',
-                'username': event['username'],
-                'user_id': event['user_id'],
-                'is_typing': event['is_typing'],
-            }))
-
-    async def user_list_update(self, event):
-        # Send updated user list to WebSocket
-        await self.send(text_data=json.dumps({
+        # Collected per process; typing_update frames go out at a fixed cadence
+        get_typing_coordinator().receive(self.room_name, event)
+
+    async def presence_delta(self, event):
+        if self.presence_mode == 'delta':
+            # A dropped delta shows up as a seq gap, and the client resyncs
+            await self.send_frame(event['frame'], droppable=True)
+            return
+
+        for user in event['joined']:
+            self.online_users[user['id']] = user['username']
+        for user_id in event['left']:
+            self.online_users.pop(user_id, None)
+        await self.send_user_list()
+
+    async def membership_changed(self, event):
+        # Members were added or removed through the REST API
+        fanout = get_notification_fanout()
+        fanout.invalidate(self.room_name)
+        room = await fanout.get_room(self.room_name)
+        if room is None or self.user.id not in room.member_ids:
+            await self.room_access_revoked()
+            return
+        self.room = room
+
+    async def send_presence_snapshot(self):
+        seq, users = await get_presence_registry().snapshot_async(self.room_name)
+        self.online_users = {user['id']: user['username'] for user in users}
+        if self.presence_mode == 'delta':
+            await self.send_payload({
+                'type': 'presence_snapshot',
+                'seq': seq,
+                'users': users,
+            })
+        else:
+            await self.send_user_list()
+
+    async def send_user_list(self):
+        # Send the full user list to this socket only
+        await self.send_payload({
             'type': 'user_list_update',
-            'users': event['users'],
-        }))
+            'users': [
+                {'id': user_id, 'username': username}
+                for user_id, username in sorted(self.online_users.items())
+            ],
+        }, droppable=True, replaces='user_list_update')
+
+    async def replay_missed_messages(self, after_id):
+        """
+        Send the messages a resuming client missed, oldest first, then a
+        resume_complete frame. Only the newest CHAT_RESUME_LIMIT are sent; if
+        there were more, a resume_gap frame first tells the client which range
+        to refetch through the REST messages endpoint.
+
+        Runs before the consumer handles any live event, and live messages the
+        replay already covered are skipped.
+        """
+        limit = getattr(settings, 'CHAT_RESUME_LIMIT', 200)
+        messages, plaintexts, gap = await self.get_missed_messages(after_id, limit)
+        if gap:
+            await self.send_payload({
+                'type': 'resume_gap',
+                'after_id': after_id,
+                'before_id': messages[0].id,
+            })
+        for message in messages:
+            await self.send_payload({
+                'type': 'chat_message',
+                'message': plaintexts.get(message.id, None if message.is_encrypted else message.encrypted_body),
+                'message_type': message.message_type,
+                'image_url': message.image.url if message.message_type == 'image' and message.image else None,
+                'thumbnail_url': message.media.thumbnail.url if message.media and message.media.thumbnail else None,
+                'username': message.author.username,
+                'user_id': message.author_id,
+                'timestamp': message.created.isoformat(),
+                'message_id': message.id,
+                'provisional': False,
+                'replayed': True,
+            })
+        if messages:
+            self.replayed_through = messages[-1].id
+        await self.send_payload({
+            'type': 'resume_complete',
+            'count': len(messages),
+            'last_id': messages[-1].id if messages else after_id,
+        })
 
     @database_sync_to_async
-    def save_message(self, message):
-        chat_group, _ = ChatGroup.objects.get_or_create(name=self.room_name)
-        
-        # Encrypt the message
-        encrypted_body = encrypt_message(message)
-        if not encrypted_body:
-            # If encryption fails, store the original message
-            encrypted_body = message
-            is_encrypted = False
-        else:
-            is_encrypted = True
-        
-        group_message = GroupMessage.objects.create(
-            group=chat_group,
-            author=self.user,
-            encrypted_body=encrypted_body,
-            is_encrypted=is_encrypted
+    def get_missed_messages(self, after_id, limit):
+        messages = list(
+            GroupMessage.objects.filter(group_id=self.room.id, id__gt=after_id)
+            .select_related('author', 'media')
+            .order_by('-id')[:limit + 1]
         )
+        gap = len(messages) > limit
+        messages = messages[:limit][::-1]
+        return messages, decrypt_messages(messages), gap
+
+    @database_sync_to_async
+    def save_message(self, message):
+        with transaction.atomic():
+            group_message = GroupMessage.objects.create(
+                group_id=self.room.id,
+                author=self.user,
+                **message_storage_fields(message)
+            )
+            index_message(group_message, message)
         return group_message, message  # Return both the message object and original message
 
+    def queue_message(self, message):
+        group_message = get_write_behind_writer().submit(
+            self.room_name,
+            self.room.id,
+            self.user.id,
+            message_storage_fields(message),
+            search_tokens=search_tokens(message),
+        )
+        return group_message, message
+
     async def send_message_notifications(self, group_message, message):
         """Send message notifications to all chat members who are not currently in this room"""
         try:
-            # Get chat group and all its members
-            chat_group = await self.get_chat_group()
-            if not chat_group:
-                return
-
-            member_ids = await self.get_chat_members(chat_group.id)
-
-            # Send notification to each member (except the sender)
-            for member_id in member_ids:
-                if member_id != self.user.id:
-                    # Check if this user has already read this message
-                    # (This is a new message, so it won't be read yet, but we keep this for future use)
-                    await self.channel_layer.group_send(
-                        f'user_{member_id}',
-                        {
-                            'type': 'chat_message_notification',
-                            'chat_id': chat_group.id,
-                            'chat_name': chat_group.name,
-                            'is_private': chat_group.is_private,
-                            'message': message,
-                            'message_id': group_message.id,
-                            'author': {
-                                'id': self.user.id,
-                                'username': self.user.username,
-                                'first_name': self.user.first_name,
-                                'last_name': self.user.last_name,
-                            },
-                            'timestamp': group_message.created.isoformat(),
-                        }
-                    )
+            room = self.room
+            await get_notification_fanout().notify_message(self.channel_layer, room, {
+                'type': 'chat_message_notification',
+                'chat_id': room.id,
+                'chat_name': room.name,
+                'is_private': room.is_private,
+                'message': message,
+                'message_id': group_message.id,
+                'author': {
+                    'id': self.user.id,
+                    'username': self.user.username,
+                    'first_name': self.user.first_name,
+                    'last_name': self.user.last_name,
+                },
+                'timestamp': group_message.created.isoformat(),
+            })
         except Exception as e:
             print(f"Error sending message notifications: {e}")
 
-    @database_sync_to_async
-    def get_chat_group(self):
-        try:
-            return ChatGroup.objects.get(name=self.room_name)
-        except ChatGroup.DoesNotExist:
-            return None
 
-    @database_sync_to_async
-    def get_chat_members(self, chat_id):
-        try:
-            chat = ChatGroup.objects.get(id=chat_id)
-            return list(chat.members.values_list('id', flat=True))
-        except ChatGroup.DoesNotExist:
-            return []
+class ChatConsumer(ChatRoomMixin, IdleTimeoutMixin, FrameProtocolMixin, AsyncWebsocketConsumer):
+    async def connect(self):
+        self.user = self.scope['user']
+        query_params = parse_qs(self.scope.get('query_string', b'').decode())
+        self.init_room(
+            self.scope['url_route']['kwargs']['room_name'],
+            presence=query_params.get('presence', [''])[0],
+            after_id=query_params.get('after_id', [''])[0],
+        )
 
-    @database_sync_to_async
-    def add_user_to_room(self):
-        chat_group, _ = ChatGroup.objects.get_or_create(name=self.room_name)
-        chat_group.users_online.add(self.user)
-        if not chat_group.members.filter(id=self.user.id).exists():
-            chat_group.members.add(self.user)
+        # Check if user is authenticated
+        if not self.user.is_authenticated:
+            await self.close(code=4001)  # Custom close code for authentication error
+            return
 
-    @database_sync_to_async
-    def remove_user_from_room(self):
         try:
-            if self.user.is_authenticated:
-                chat_group = ChatGroup.objects.get(name=self.room_name)
-                chat_group.users_online.remove(self.user)
-        except ChatGroup.DoesNotExist:
-            pass
+            close_code = await self.check_membership()
+            if close_code is not None:
+                await self.close(code=close_code)
+                return
 
-    @database_sync_to_async
-    def get_online_users(self):
+            await self.accept_negotiated()
+            await self.enter_room()
+        except Exception as e:
+            print(f"WebSocket connection error: {e}")
+            await self.close(code=4000)  # Custom close code for general error
+
+    async def disconnect(self, close_code):
+        if getattr(self, 'room', None) and self.user.is_authenticated:
+            await self.leave_room()
+
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            chat_group = ChatGroup.objects.get(name=self.room_name)
-            return list(chat_group.users_online.values('id', 'username'))
-        except ChatGroup.DoesNotExist:
-            return []
+            text_data_json = self.decode_frame(text_data, bytes_data)
+            message_type = text_data_json.get('type', 'chat_message')
+            get_presence_registry().heartbeat(self.channel_name)
 
-    async def send_user_list(self):
-        users = await self.get_online_users()
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'user_list_update',
-                'users': users,
-            }
-        )
+            if message_type == 'heartbeat':
+                await self.send_payload({'type': 'heartbeat_ack'}, droppable=True)
+            elif message_type == 'presence_resync':
+                # Client saw a gap in presence_delta sequence numbers
+                await self.send_presence_snapshot()
+            elif message_type == 'chat_message':
+                await self.post_message(text_data_json['message'])
+            elif message_type == 'typing':
+                await self.update_typing(bool(text_data_json.get('is_typing', False)))
+        except json.JSONDecodeError:
+            await self.send_payload({
+                'error': 'Invalid JSON format'
+            })
+        except Exception as e:
+            await self.send_payload({
+                'error': f'Error processing message: {str(e)}'
+            })
+
+    def connection_groups(self):
+        return [self.room_group_name]
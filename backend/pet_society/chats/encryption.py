@@ -1,8 +1,20 @@
-from cryptography.fernet import Fernet
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+from cryptography.fernet import Fernet, MultiFernet
 import os
+import zlib
 from django.conf import settings
 import base64
 
+# Binary storage format for GroupMessage.ciphertext:
+#   byte 0     format version
+#   byte 1     flags (FLAG_ZLIB: plaintext was zlib-compressed before encryption)
+#   bytes 2..  raw Fernet token (the url-safe base64 decoded form)
+STORAGE_FORMAT_V1 = 1
+FLAG_ZLIB = 0x01
+
 def get_encryption_key():
     """
     Get or generate encryption key for chat messages
@@ -15,35 +27,325 @@ def get_encryption_key():
         print("Please set ENCRYPTION_KEY environment variable for production")
     return key.encode() if isinstance(key, str) else key
 
+
+def get_encryption_key_id():
+    """Id stored on every message encrypted with the primary key"""
+    return getattr(settings, 'ENCRYPTION_KEY_ID', 'default')
+
+
+def get_legacy_keys():
+    """
+    Retired keys that can still decrypt old messages, as ``{key_id: key}``
+    """
+    legacy_keys = getattr(settings, 'ENCRYPTION_LEGACY_KEYS', None) or {}
+    return {
+        key_id: key.encode() if isinstance(key, str) else key
+        for key_id, key in legacy_keys.items()
+    }
+
+
+class EncryptionService:
+    """
+    Encrypts and decrypts chat messages with a cipher built once.
+
+    Decrypted plaintexts are kept in a bounded LRU keyed by message id, so a
+    history page requested by many members of a room is only decrypted once.
+    Large batches are spread across a small thread pool.
+
+    New messages are always encrypted with the primary key. Messages record
+    the id of the key that encrypted them, so after a rotation they can still
+    be decrypted with the matching legacy key until they are re-encrypted.
+    """
+
+    def __init__(self, key=None, key_id=None, legacy_keys=None, cache_size=None, max_workers=None,
+                 parallel_threshold=None, compress_threshold=None):
+        self.key_id = key_id or get_encryption_key_id()
+        self.fernet = Fernet(key or get_encryption_key())
+        legacy_keys = get_legacy_keys() if legacy_keys is None else legacy_keys
+        self.ciphers = {key_id: Fernet(legacy_key) for key_id, legacy_key in legacy_keys.items()}
+        self.ciphers[self.key_id] = self.fernet
+        # Tries the primary key first, then every legacy key (for rows without a key id)
+        self.multi_fernet = MultiFernet(
+            [self.fernet] + [cipher for kid, cipher in self.ciphers.items() if kid != self.key_id]
+        )
+        self.compress_threshold = compress_threshold or getattr(settings, 'CHAT_COMPRESS_THRESHOLD', 256)
+        self.cache_size = cache_size if cache_size is not None else getattr(settings, 'CHAT_DECRYPT_CACHE_SIZE', 4096)
+        self.max_workers = max_workers or getattr(settings, 'CHAT_DECRYPT_WORKERS', 4)
+        self.parallel_threshold = parallel_threshold or getattr(settings, 'CHAT_DECRYPT_PARALLEL_THRESHOLD', 64)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def encrypt(self, message):
+        """Encrypt to the legacy text format (base64 of the Fernet token)"""
+        encrypted_message = self.fernet.encrypt(message.encode())
+        return base64.b64encode(encrypted_message).decode()
+
+    def encrypt_bytes(self, message):
+        """Encrypt to the compact binary storage format"""
+        data = message.encode()
+        flags = 0
+        if len(data) >= self.compress_threshold:
+            compressed = zlib.compress(data)
+            if len(compressed) < len(data):
+                data = compressed
+                flags |= FLAG_ZLIB
+        token = self.fernet.encrypt(data)
+        return bytes([STORAGE_FORMAT_V1, flags]) + base64.urlsafe_b64decode(token)
+
+    def _cipher_for(self, key_id):
+        return self.ciphers.get(key_id, self.multi_fernet)
+
+    def _decrypt(self, encrypted_message, key_id=None):
+        cipher = self._cipher_for(key_id)
+        if isinstance(encrypted_message, (bytes, bytearray, memoryview)):
+            return self._decrypt_bytes(bytes(encrypted_message), cipher)
+        decoded_message = base64.b64decode(encrypted_message.encode())
+        return cipher.decrypt(decoded_message).decode()
+
+    def _decrypt_bytes(self, data, cipher):
+        version, flags = data[0], data[1]
+        if version != STORAGE_FORMAT_V1:
+            raise ValueError(f'Unknown message storage format {version}')
+        plaintext = cipher.decrypt(base64.urlsafe_b64encode(data[2:]))
+        if flags & FLAG_ZLIB:
+            plaintext = zlib.decompress(plaintext)
+        return plaintext.decode()
+
+    def reencrypt(self, encrypted_message, key_id=None):
+        """
+        Re-encrypt a stored message with the primary key.
+
+        Accepts either storage format and returns the binary format. The
+        plaintext is never decompressed, only the Fernet token is rotated.
+        """
+        cipher = self._cipher_for(key_id)
+        if isinstance(encrypted_message, (bytes, bytearray, memoryview)):
+            data = bytes(encrypted_message)
+            if data[0] != STORAGE_FORMAT_V1:
+                raise ValueError(f'Unknown message storage format {data[0]}')
+            flags, token = data[1], base64.urlsafe_b64encode(data[2:])
+        else:
+            flags, token = 0, base64.b64decode(encrypted_message.encode())
+        # Decrypting with the old cipher validates the token before it is replaced
+        plaintext = cipher.decrypt(token)
+        new_token = self.fernet.encrypt(plaintext)
+        return bytes([STORAGE_FORMAT_V1, flags]) + base64.urlsafe_b64decode(new_token)
+
+    def _cache_get(self, message_id, encrypted_message):
+        # Entries remember their ciphertext: ids of deleted rows can be reused
+        # by SQLite, and a rotated row must not be served its old plaintext
+        if isinstance(encrypted_message, memoryview):
+            encrypted_message = bytes(encrypted_message)
+        with self._lock:
+            entry = self._cache.get(message_id)
+            if entry is not None and entry[0] == encrypted_message:
+                self._cache.move_to_end(message_id)
+                return entry[1]
+        return None
+
+    def _cache_set(self, message_id, encrypted_message, plaintext):
+        if not self.cache_size:
+            return
+        if isinstance(encrypted_message, memoryview):
+            encrypted_message = bytes(encrypted_message)
+        with self._lock:
+            self._cache[message_id] = (encrypted_message, plaintext)
+            self._cache.move_to_end(message_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def forget(self, message_id):
+        """Drop a cached plaintext, e.g. after the stored ciphertext changed"""
+        with self._lock:
+            self._cache.pop(message_id, None)
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+
+    def decrypt(self, encrypted_message, message_id=None, key_id=None):
+        """Decrypt one message, raising on invalid tokens"""
+        if message_id is not None:
+            cached = self._cache_get(message_id, encrypted_message)
+            if cached is not None:
+                return cached
+        plaintext = self._decrypt(encrypted_message, key_id)
+        if message_id is not None:
+            self._cache_set(message_id, encrypted_message, plaintext)
+        return plaintext
+
+    def _decrypt_or_none(self, encrypted_message, key_id=None):
+        try:
+            return self._decrypt(encrypted_message, key_id)
+        except Exception as e:
+            print(f"Decryption error: {e}")
+            return None
+
+    def decrypt_many(self, items):
+        """
+        Decrypt a batch of ``(message_id, encrypted_body, key_id)`` triples.
+
+        Returns a dict of message id to plaintext; messages that fail to
+        decrypt map to ``None``.
+        """
+        results = {}
+        pending = []
+        for message_id, encrypted_message, key_id in items:
+            if not encrypted_message:
+                results[message_id] = encrypted_message
+                continue
+            cached = self._cache_get(message_id, encrypted_message)
+            if cached is not None:
+                results[message_id] = cached
+            else:
+                pending.append((message_id, encrypted_message, key_id))
+
+        if len(pending) >= self.parallel_threshold and self.max_workers > 1:
+            chunk_size = -(-len(pending) // self.max_workers)
+            chunks = [pending[i:i + chunk_size] for i in range(0, len(pending), chunk_size)]
+            decrypted = []
+            for chunk_result in self._get_executor().map(self._decrypt_chunk, chunks):
+                decrypted.extend(chunk_result)
+        else:
+            decrypted = self._decrypt_chunk(pending)
+
+        for (message_id, encrypted_message, _), plaintext in zip(pending, decrypted):
+            results[message_id] = plaintext
+            if plaintext is not None:
+                self._cache_set(message_id, encrypted_message, plaintext)
+        return results
+
+    def _decrypt_chunk(self, chunk):
+        return [
+            self._decrypt_or_none(encrypted_message, key_id)
+            for _, encrypted_message, key_id in chunk
+        ]
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers,
+                        thread_name_prefix='chat-decrypt'
+                    )
+        return self._executor
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_encryption_service():
+    """Return the process-wide encryption service, building it on first use"""
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = EncryptionService()
+    return _service
+
+
+def reset_encryption_service():
+    """Forget the cached service so the next call picks up new settings"""
+    global _service
+    with _service_lock:
+        _service = None
+
+
 def encrypt_message(message):
     """
     Encrypt a chat message
     """
     if not message:
         return message
-    
+
     try:
-        key = get_encryption_key()
-        fernet = Fernet(key)
-        encrypted_message = fernet.encrypt(message.encode())
-        return base64.b64encode(encrypted_message).decode()
+        return get_encryption_service().encrypt(message)
     except Exception as e:
         print(f"Encryption error: {e}")
         return None
 
-def decrypt_message(encrypted_message):
+def decrypt_message(encrypted_message, message_id=None):
     """
     Decrypt a chat message
     """
     if not encrypted_message:
         return encrypted_message
-    
+
     try:
-        key = get_encryption_key()
-        fernet = Fernet(key)
-        decoded_message = base64.b64decode(encrypted_message.encode())
-        decrypted_message = fernet.decrypt(decoded_message)
-        return decrypted_message.decode()
+        return get_encryption_service().decrypt(encrypted_message, message_id=message_id)
+    except Exception as e:
+        print(f"Decryption error: {e}")
+        return None
+
+
+def legacy_to_storage_bytes(encrypted_message):
+    """
+    Convert a legacy ``encrypted_body`` to the binary storage format.
+
+    Only the encoding changes, so no decryption is needed.
+    """
+    token = base64.b64decode(encrypted_message.encode())
+    return bytes([STORAGE_FORMAT_V1, 0]) + base64.urlsafe_b64decode(token)
+
+
+def message_storage_fields(message):
+    """
+    Return the GroupMessage field values that store a text message.
+
+    Falls back to storing the plaintext unencrypted if encryption fails.
+    """
+    try:
+        ciphertext = get_encryption_service().encrypt_bytes(message)
+    except Exception as e:
+        print(f"Encryption error: {e}")
+        return {'ciphertext': None, 'encrypted_body': message, 'is_encrypted': False, 'key_id': None}
+    return {
+        'ciphertext': ciphertext,
+        'encrypted_body': None,
+        'is_encrypted': True,
+        'key_id': get_encryption_service().key_id,
+    }
+
+
+def stored_ciphertext(message):
+    """Return whichever encrypted payload a GroupMessage carries, binary first"""
+    if message.ciphertext:
+        return message.ciphertext
+    return message.encrypted_body
+
+
+def decrypt_group_message(message):
+    """
+    Return the plaintext of a GroupMessage text message, or ``None`` if it
+    cannot be decrypted. Reads both the binary and the legacy text format.
+    """
+    if not message.is_encrypted:
+        return message.encrypted_body
+    stored = stored_ciphertext(message)
+    if not stored:
+        return stored
+    try:
+        return get_encryption_service().decrypt(stored, message_id=message.id, key_id=message.key_id)
     except Exception as e:
         print(f"Decryption error: {e}")
-        return None
\ No newline at end of file
+        return None
+
+
+def decrypt_messages(messages):
+    """
+    Decrypt the text bodies of a batch of GroupMessage instances.
+
+    Returns a dict of message id to plaintext for every encrypted text
+    message in ``messages``.
+    """
+    items = [
+        (message.id, stored_ciphertext(message), message.key_id)
+        for message in messages
+        if message.message_type != 'image' and message.is_encrypted and stored_ciphertext(message)
+    ]
+    if not items:
+        return {}
+    return get_encryption_service().decrypt_many(items)
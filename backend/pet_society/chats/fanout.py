@@ -0,0 +1,167 @@
+import asyncio
+import threading
+import time
+from dataclasses import dataclass
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from .groups import room_group_name
+from .inbox import store_notifications
+from .presence import get_presence_registry
+
+
+@dataclass(frozen=True)
+class RoomInfo:
+    id: int
+    name: str
+    is_private: bool
+    member_ids: frozenset
+
+
+class NotificationFanout:
+    """
+    Sends notifications to the personal ``user_{id}`` groups of room members.
+
+    Room membership is cached per process and invalidated on join, leave and
+    invite (see ``invalidate_membership``); entries also expire after
+    ``membership_ttl`` seconds to pick up changes made by other processes.
+    Sends go out concurrently in batches. Message notifications skip members
+    who are connected to the room, and bursts are coalesced per user and room:
+    the first message is notified right away, the rest of the window collapses
+    into one "N new messages" notification. Everything sent is also stored in
+    the recipients' inboxes (see chats.inbox) for users who are offline.
+    """
+
+    def __init__(self, batch_size=100, coalesce_window=2.0, membership_ttl=60):
+        self.batch_size = batch_size
+        self.coalesce_window = coalesce_window
+        self.membership_ttl = membership_ttl
+        self._rooms = {}  # {room name: (RoomInfo, fetched at)}
+        self._windows = {}  # {(user_id, chat_id): {'count': n, 'event': last event}}
+
+    # Membership cache
+
+    async def get_room(self, room_name):
+        cached = self._rooms.get(room_name)
+        if cached and time.monotonic() - cached[1] < self.membership_ttl:
+            return cached[0]
+        room = await self._load_room(room_name)
+        if room:
+            self._rooms[room_name] = (room, time.monotonic())
+        return room
+
+    @database_sync_to_async
+    def _load_room(self, room_name):
+        from .models import ChatGroup
+
+        try:
+            chat_group = ChatGroup.objects.get(name=room_name)
+        except ChatGroup.DoesNotExist:
+            return None
+        return RoomInfo(
+            id=chat_group.id,
+            name=chat_group.name,
+            is_private=chat_group.is_private,
+            member_ids=frozenset(chat_group.members.values_list('id', flat=True)),
+        )
+
+    def invalidate(self, room_name):
+        self._rooms.pop(room_name, None)
+
+    # Sending
+
+    async def send_to_users(self, channel_layer, user_ids, event):
+        """
+        Store one event in many users' inboxes, then group_send it to their
+        notification groups a batch at a time. Each user's copy carries their
+        ``notification_id``, the cursor a client reconnects with.
+        """
+        user_ids = list(user_ids)
+        try:
+            notification_ids = await database_sync_to_async(store_notifications)(user_ids, event)
+        except Exception as e:
+            # Still deliver live; only offline delivery is lost
+            print(f"Error storing notifications: {e}")
+            notification_ids = {}
+        for start in range(0, len(user_ids), self.batch_size):
+            batch = user_ids[start:start + self.batch_size]
+            results = await asyncio.gather(
+                *[
+                    channel_layer.group_send(
+                        f'user_{user_id}', dict(event, notification_id=notification_ids.get(user_id))
+                    )
+                    for user_id in batch
+                ],
+                return_exceptions=True,
+            )
+            for result in results:
+                if isinstance(result, Exception):
+                    print(f"Error sending notification: {result}")
+
+    async def notify_message(self, channel_layer, room, event):
+        """
+        Notify every member of ``room`` except the author and anyone
+        connected to it about a new message.
+        """
+        online = set(await get_presence_registry().online_user_ids_async(room.name))
+        recipients = room.member_ids - online - {event['author']['id']}
+
+        send_now = []
+        for user_id in recipients:
+            key = (user_id, room.id)
+            window = self._windows.get(key)
+            if window is None:
+                self._windows[key] = {'count': 0, 'event': None}
+                asyncio.get_running_loop().call_later(
+                    self.coalesce_window,
+                    lambda key=key: asyncio.ensure_future(self._close_window(channel_layer, key)),
+                )
+                send_now.append(user_id)
+            else:
+                window['count'] += 1
+                window['event'] = event
+
+        if send_now:
+            await self.send_to_users(channel_layer, send_now, dict(event, count=1))
+
+    async def _close_window(self, channel_layer, key):
+        window = self._windows.pop(key, None)
+        if not window or not window['count']:
+            return
+        event = window['event']
+        count = window['count']
+        await self.send_to_users(channel_layer, [key[0]], dict(
+            event,
+            count=count,
+            message=f"{count} new messages in {event['chat_name']}" if count > 1 else event['message'],
+        ))
+
+
+_fanout = None
+_fanout_lock = threading.Lock()
+
+
+def get_notification_fanout():
+    """Return the process-wide notification fan-out service"""
+    global _fanout
+    if _fanout is None:
+        with _fanout_lock:
+            if _fanout is None:
+                config = getattr(settings, 'CHAT_NOTIFICATIONS', {})
+                _fanout = NotificationFanout(
+                    batch_size=config.get('BATCH_SIZE', 100),
+                    coalesce_window=config.get('COALESCE_WINDOW', 2.0),
+                    membership_ttl=config.get('MEMBERSHIP_TTL', 60),
+                )
+    return _fanout
+
+
+async def invalidate_membership(channel_layer, room_name):
+    """
+    Drop cached membership for a room in this process, and in every process
+    with sockets in the room, which are the ones that fan out its messages.
+    """
+    get_notification_fanout().invalidate(room_name)
+    if channel_layer:
+        await channel_layer.group_send(room_group_name(room_name), {'type': 'membership_changed', 'room': room_name})
@@ -0,0 +1,242 @@
+import json
+import threading
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .outbound import OutboundQueue, send_queue_drain_timeout, send_queue_options
+
+try:
+    import orjson
+except ImportError:  # Optional, the standard library encoder is the fallback
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # Optional, without it the msgpack subprotocol is not offered
+    msgpack = None
+
+
+SUBPROTOCOL_MSGPACK = 'pets.msgpack.v1'
+SUBPROTOCOL_JSON_DEFLATE = 'pets.json-deflate.v1'
+
+# First byte of every binary frame
+FLAG_DEFLATE = 0x01
+
+_encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+
+
+def encode_frame(payload):
+    """
+    Serialize a websocket frame to JSON text.
+
+    Room broadcasts call this once in the sending consumer and put the result
+    in the channel event under ``frame``; every receiving consumer forwards it
+    verbatim instead of rebuilding and re-encoding the dict per socket.
+    """
+    if orjson is not None:
+        return orjson.dumps(payload).decode()
+    return _encoder.encode(payload)
+
+
+def with_room(frame, room):
+    """
+    Prefix a pre-encoded frame with a ``room`` field, for multiplexed sockets.
+    Splices the JSON text so the frame is not decoded and re-encoded.
+    """
+    return f'{{"room":{encode_frame(room)},{frame[1:]}'
+
+
+class JSONCodec:
+    """Plain JSON text frames, what every client without a subprotocol gets"""
+    subprotocol = None
+    binary = False
+
+    def encode(self, payload):
+        return encode_frame(payload)
+
+    def from_json(self, frame):
+        return frame
+
+    def decode(self, text_data=None, bytes_data=None):
+        return json.loads(text_data if text_data is not None else bytes_data)
+
+
+class BinaryCodec(ABC):
+    """
+    Binary frames: one flags byte, then the serialized payload, raw-deflated
+    when it is at least ``compress_threshold`` bytes and deflating helps.
+    Clients may still send JSON text frames. Subclasses provide the
+    serialization.
+    """
+    subprotocol = None
+    binary = True
+
+    def __init__(self, compress_threshold=512, compress_level=6, cache_size=256):
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.cache_size = cache_size
+        # Broadcast frames arrive once per local socket; convert each only once
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def serialize(self, payload):
+        """Bytes for a payload dict"""
+
+    @abstractmethod
+    def serialize_json(self, frame):
+        """Bytes for a frame pre-encoded as JSON by ``encode_frame``"""
+
+    @abstractmethod
+    def deserialize(self, data):
+        """The payload dict in a serialized frame"""
+
+    def pack(self, data):
+        if len(data) >= self.compress_threshold:
+            compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, -15)
+            compressed = compressor.compress(data) + compressor.flush()
+            if len(compressed) < len(data):
+                return bytes([FLAG_DEFLATE]) + compressed
+        return b'\x00' + data
+
+    def encode(self, payload):
+        return self.pack(self.serialize(payload))
+
+    def from_json(self, frame):
+        """Convert a pre-encoded JSON broadcast frame"""
+        with self._lock:
+            cached = self._cache.get(frame)
+            if cached is not None:
+                self._cache.move_to_end(frame)
+                return cached
+        packed = self.pack(self.serialize_json(frame))
+        with self._lock:
+            self._cache[frame] = packed
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return packed
+
+    def decode(self, text_data=None, bytes_data=None):
+        if text_data is not None:
+            return json.loads(text_data)
+        if not bytes_data:
+            raise ValueError('Empty frame')
+        try:
+            data = bytes_data[1:]
+            if bytes_data[0] & FLAG_DEFLATE:
+                data = zlib.decompress(data, -15)
+            return self.deserialize(data)
+        except ValueError:
+            raise
+        except Exception as e:
+            raise ValueError(f'Invalid frame: {e}') from e
+
+
+class MsgpackCodec(BinaryCodec):
+    subprotocol = SUBPROTOCOL_MSGPACK
+
+    def serialize(self, payload):
+        return msgpack.packb(payload)
+
+    def serialize_json(self, frame):
+        return msgpack.packb(json.loads(frame))
+
+    def deserialize(self, data):
+        return msgpack.unpackb(data)
+
+
+class JSONDeflateCodec(BinaryCodec):
+    """JSON in binary frames, for clients that want compression but not msgpack"""
+    subprotocol = SUBPROTOCOL_JSON_DEFLATE
+
+    def serialize(self, payload):
+        return encode_frame(payload).encode()
+
+    def serialize_json(self, frame):
+        return frame.encode()
+
+    def deserialize(self, data):
+        return json.loads(data)
+
+
+JSON = JSONCodec()
+_codecs = None
+_codecs_lock = threading.Lock()
+
+
+def get_codecs():
+    """Return the binary codecs this server offers, by subprotocol"""
+    global _codecs
+    if _codecs is None:
+        with _codecs_lock:
+            if _codecs is None:
+                options = {
+                    'compress_threshold': getattr(settings, 'CHAT_FRAME_COMPRESS_THRESHOLD', 512),
+                    'compress_level': getattr(settings, 'CHAT_FRAME_COMPRESS_LEVEL', 6),
+                }
+                codecs = [JSONDeflateCodec(**options)]
+                if msgpack is not None:
+                    codecs.insert(0, MsgpackCodec(**options))
+                _codecs = {codec.subprotocol: codec for codec in codecs}
+    return _codecs
+
+
+def negotiate(subprotocols):
+    """Pick the first subprotocol the client offers that we support, else JSON"""
+    codecs = get_codecs()
+    for subprotocol in subprotocols or ():
+        if subprotocol in codecs:
+            return codecs[subprotocol]
+    return JSON
+
+
+class FrameProtocolMixin:
+    """
+    Websocket consumer helpers that send and read frames in the protocol
+    negotiated on connect (see ``negotiate``), JSON text by default.
+
+    Once accepted, frames go through a bounded ``OutboundQueue``; pass
+    ``droppable=True`` for frames that may be dropped under backpressure
+    (typing, presence) and ``replaces`` for snapshots that supersede their
+    previous unsent version.
+    """
+    codec = JSON
+    send_queue = None
+
+    async def accept_negotiated(self):
+        self.codec = negotiate(self.scope.get('subprotocols'))
+        await self.accept(subprotocol=self.codec.subprotocol)
+        self.send_queue = OutboundQueue(self, **send_queue_options())
+
+    def decode_frame(self, text_data=None, bytes_data=None):
+        return self.codec.decode(text_data, bytes_data)
+
+    async def send_payload(self, payload, droppable=False, replaces=None):
+        """Encode and send a frame built for this socket only"""
+        await self._queue_frame(self.codec.encode(payload), droppable, replaces)
+
+    async def send_frame(self, frame, droppable=False, replaces=None):
+        """Send a broadcast frame pre-encoded as JSON by ``encode_frame``"""
+        await self._queue_frame(self.codec.from_json(frame), droppable, replaces)
+
+    async def _queue_frame(self, data, droppable, replaces):
+        if self.send_queue is not None:
+            await self.send_queue.put(data, droppable, replaces)
+        elif isinstance(data, bytes):
+            await self.send(bytes_data=data)
+        else:
+            await self.send(text_data=data)
+
+    async def close(self, code=None, reason=None):
+        # Frames queued just before closing (e.g. an error) still reach the client
+        if self.send_queue is not None:
+            await self.send_queue.drain(send_queue_drain_timeout())
+        await super().close(code=code, reason=reason)
+
+    async def websocket_disconnect(self, message):
+        if self.send_queue is not None:
+            self.send_queue.stop()
+        await super().websocket_disconnect(message)
@@ -0,0 +1,19 @@
+import hashlib
+import re
+
+# What channels accepts as a group name: ASCII letters, digits, hyphens,
+# underscores and periods, shorter than 100 characters
+_VALID_GROUP_NAME = re.compile(r'^[a-zA-Z\d\-_.]{1,99}$')
+
+
+def room_group_name(room_name):
+    """
+    Channel layer group of a chat room's sockets. Room names are user input,
+    so names channels would reject (spaces, non-ASCII, too long) map to a
+    hash instead; the ``chat.`` prefix keeps those apart from every plain
+    ``chat_<name>`` group.
+    """
+    group = f'chat_{room_name}'
+    if _VALID_GROUP_NAME.match(group):
+        return group
+    return f'chat.{hashlib.sha256(room_name.encode()).hexdigest()}'
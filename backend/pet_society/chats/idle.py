@@ -0,0 +1,140 @@
+import asyncio
+import threading
+import time
+
+from django.conf import settings
+
+from .metrics import metrics
+from .presence import get_presence_registry
+
+IDLE_CLOSE_CODE = 4010
+
+
+class IdleReaper:
+    """
+    Finds websockets whose client went away without closing them.
+
+    Every frame a client sends counts as activity. A socket quiet for
+    ``ping_after`` seconds gets a ``ping`` frame, which live clients answer
+    with a ``pong``; one quiet for ``idle_timeout`` seconds is reaped. Reaped
+    sockets are dropped from their channel layer groups and from presence in
+    one bulk operation per sweep, then closed with code 4010, so nothing
+    depends on the server noticing the dead TCP connection.
+
+    Metrics: ``connections.live`` and ``connections.max_live`` for the
+    sockets this process holds, ``connections.opened`` and
+    ``connections.reaped`` as running totals.
+    """
+
+    def __init__(self, idle_timeout=90, ping_after=45, sweep_interval=15):
+        self.idle_timeout = idle_timeout
+        self.ping_after = ping_after
+        self.sweep_interval = sweep_interval
+        self._connections = {}  # {consumer: last client activity}
+        self._pinged = set()
+        self._task = None
+
+    def register(self, consumer):
+        self._connections[consumer] = time.monotonic()
+        metrics.incr('connections.opened')
+        metrics.incr('connections.live')
+        metrics.set_max('connections.max_live', len(self._connections))
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def activity(self, consumer):
+        if consumer in self._connections:
+            self._connections[consumer] = time.monotonic()
+            self._pinged.discard(consumer)
+
+    def unregister(self, consumer):
+        self._pinged.discard(consumer)
+        if self._connections.pop(consumer, None) is not None:
+            metrics.decr('connections.live')
+
+    async def _run(self):
+        while self._connections:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(f"Idle connection sweep error: {e}")
+
+    async def sweep(self):
+        """Ping quiet sockets and reap idle ones; returns the reaped consumers"""
+        now = time.monotonic()
+        idle = []
+        for consumer, last_seen in list(self._connections.items()):
+            if now - last_seen >= self.idle_timeout:
+                idle.append(consumer)
+            elif now - last_seen >= self.ping_after and consumer not in self._pinged:
+                self._pinged.add(consumer)
+                await consumer.send_payload({'type': 'ping', 'timestamp': int(time.time() * 1000)}, droppable=True)
+        if idle:
+            await self.reap(idle)
+        return idle
+
+    async def reap(self, consumers):
+        for consumer in consumers:
+            self.unregister(consumer)
+
+        # Group memberships and presence of every reaped socket, in bulk
+        channel_layer = consumers[0].channel_layer
+        memberships = [(group, consumer.channel_name) for consumer in consumers for group in consumer.connection_groups()]
+        if hasattr(channel_layer, 'group_discard_many'):
+            await channel_layer.group_discard_many(memberships)
+        else:
+            await asyncio.gather(*[channel_layer.group_discard(group, channel) for group, channel in memberships])
+        await get_presence_registry().drop_connections([consumer.channel_name for consumer in consumers])
+
+        # Concurrently, each close may wait out its send queue's drain timeout
+        results = await asyncio.gather(
+            *[consumer.close(code=IDLE_CLOSE_CODE) for consumer in consumers], return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"Error closing idle connection: {result}")
+        metrics.incr('connections.reaped', len(consumers))
+
+
+class IdleTimeoutMixin:
+    """
+    Tracks a websocket consumer's client activity for the IdleReaper. Put it
+    before FrameProtocolMixin; consumers list their channel layer groups in
+    ``connection_groups``.
+    """
+
+    def connection_groups(self):
+        """Channel layer groups this socket is in, discarded in bulk if it is reaped"""
+        return []
+
+    async def accept(self, subprotocol=None, headers=None):
+        await super().accept(subprotocol=subprotocol, headers=headers)
+        get_idle_reaper().register(self)
+
+    async def websocket_receive(self, message):
+        get_idle_reaper().activity(self)
+        await super().websocket_receive(message)
+
+    async def websocket_disconnect(self, message):
+        get_idle_reaper().unregister(self)
+        await super().websocket_disconnect(message)
+
+
+_reaper = None
+_reaper_lock = threading.Lock()
+
+
+def get_idle_reaper():
+    """Return the process-wide idle connection reaper configured by CHAT_IDLE"""
+    global _reaper
+    if _reaper is None:
+        with _reaper_lock:
+            if _reaper is None:
+                config = getattr(settings, 'CHAT_IDLE', {})
+                _reaper = IdleReaper(
+                    idle_timeout=config.get('TIMEOUT', 90),
+                    ping_after=config.get('PING_AFTER', 45),
+                    sweep_interval=config.get('SWEEP_INTERVAL', 15),
+                )
+    return _reaper
@@ -0,0 +1,172 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+
+def store_notifications(user_ids, event):
+    """
+    Append one notification per user for a notification event, in a single
+    bulk insert, and bump the users' unread counters. Returns the new
+    notification ids, ``{user id: notification id}``.
+
+    Rows only keep ids and counts; message text is never stored, it stays
+    encrypted in GroupMessage.
+    """
+    from .models import Notification, NotificationInbox
+
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return {}
+    kind = {event_type: kind for kind, event_type in Notification.KINDS}[event['type']]
+    actor = event.get('created_by') or event.get('invited_by') or event.get('author') or {}
+    message_id = event.get('message_id')
+    notifications = [
+        Notification(
+            user_id=user_id,
+            kind=kind,
+            chat_id=event['chat_id'],
+            actor_id=actor.get('id'),
+            # Write-behind messages are notified under a provisional string id
+            message_id=message_id if isinstance(message_id, int) else None,
+            count=event.get('count', 1),
+        )
+        for user_id in user_ids
+    ]
+    with transaction.atomic():
+        Notification.objects.bulk_create(notifications, batch_size=500)
+        NotificationInbox.objects.bulk_create(
+            [NotificationInbox(user_id=user_id) for user_id in user_ids], batch_size=500, ignore_conflicts=True
+        )
+        for start in range(0, len(user_ids), 500):
+            NotificationInbox.objects.filter(user_id__in=user_ids[start:start + 500]).update(
+                unread_count=F('unread_count') + 1
+            )
+    return {notification.user_id: notification.id for notification in notifications}
+
+
+def read_cursor(user_id):
+    from .models import NotificationInbox
+
+    return NotificationInbox.objects.filter(user_id=user_id).values_list('read_through', flat=True).first() or 0
+
+
+def pending_notifications(user_id, after_id=None, limit=None):
+    """
+    A user's notifications after ``after_id`` (their read cursor when None),
+    oldest first, rendered like live notification frames. Returns
+    ``(payloads, has_more)``.
+    """
+    from .models import Notification
+
+    if limit is None:
+        limit = getattr(settings, 'CHAT_NOTIFICATION_INBOX', {}).get('BACKLOG_LIMIT', 100)
+    if after_id is None:
+        after_id = read_cursor(user_id)
+    notifications = list(
+        Notification.objects.filter(user_id=user_id, id__gt=after_id).order_by('id')[:limit + 1]
+    )
+    return render_notifications(notifications[:limit]), len(notifications) > limit
+
+
+def recent_notifications(user_id, before_id=None, limit=50):
+    """A user's notifications before ``before_id``, newest first, for scrolling back through the inbox"""
+    from .models import Notification
+
+    notifications = Notification.objects.filter(user_id=user_id).order_by('-id')
+    if before_id is not None:
+        notifications = notifications.filter(id__lt=before_id)
+    notifications = list(notifications[:limit + 1])
+    return render_notifications(notifications[:limit]), len(notifications) > limit
+
+
+def render_notifications(notifications):
+    """Payloads for stored notifications, chats and actors loaded in bulk"""
+    from django.contrib.auth import get_user_model
+    from .models import ChatGroup, Notification
+
+    chats = ChatGroup.objects.in_bulk({notification.chat_id for notification in notifications})
+    actors = get_user_model().objects.in_bulk(
+        {notification.actor_id for notification in notifications if notification.actor_id}
+    )
+    read_through = read_cursor(notifications[0].user_id) if notifications else 0
+
+    payloads = []
+    for notification in notifications:
+        chat = chats.get(notification.chat_id)
+        actor = actors.get(notification.actor_id)
+        actor = actor and {
+            'id': actor.id,
+            'username': actor.username,
+            'first_name': actor.first_name,
+            'last_name': actor.last_name,
+        }
+        payload = {
+            'type': notification.get_kind_display(),
+            'notification_id': notification.id,
+            'read': notification.id <= read_through,
+            'chat_id': notification.chat_id,
+            'chat_name': chat.name if chat else None,
+            'is_private': chat.is_private if chat else False,
+            'timestamp': notification.created.isoformat(),
+        }
+        if notification.kind == Notification.NEW_CHAT:
+            payload['created_by'] = actor
+        elif notification.kind == Notification.INVITED:
+            payload['invited_by'] = actor
+        else:
+            payload.update({
+                'author': actor,
+                'message_id': notification.message_id,
+                'count': notification.count,
+                'message': (
+                    f'{notification.count} new messages in {payload["chat_name"]}'
+                    if notification.count > 1 else f'New message in {payload["chat_name"]}'
+                ),
+            })
+        payloads.append(payload)
+    return payloads
+
+
+def unread_count(user_id):
+    """The badge count, one primary key lookup"""
+    from .models import NotificationInbox
+
+    return NotificationInbox.objects.filter(user_id=user_id).values_list('unread_count', flat=True).first() or 0
+
+
+def mark_read(user_id, through_id=None):
+    """
+    Move a user's read cursor up to ``through_id`` (their newest notification
+    when None) and recount what is left unread. Returns the unread count.
+
+    The cursor never passes the newest notification, so ones stored later
+    are not marked read in advance.
+    """
+    from .models import Notification, NotificationInbox
+
+    with transaction.atomic():
+        inbox, _ = NotificationInbox.objects.select_for_update().get_or_create(user_id=user_id)
+        latest_id = Notification.objects.filter(user_id=user_id).order_by('-id').values_list(
+            'id', flat=True
+        ).first() or inbox.read_through
+        through_id = latest_id if through_id is None else min(through_id, latest_id)
+        if through_id > inbox.read_through:
+            inbox.read_through = through_id
+            inbox.unread_count = Notification.objects.filter(user_id=user_id, id__gt=through_id).count()
+            inbox.save(update_fields=['read_through', 'unread_count'])
+    return inbox.unread_count
+
+
+def prune_read(cutoff, batch_size=1000):
+    """Delete read notifications created before ``cutoff``, a batch per transaction. Returns how many."""
+    from .models import Notification
+
+    old_read = Notification.objects.filter(
+        created__lt=cutoff, id__lte=F('user__notification_inbox__read_through')
+    )
+    deleted = 0
+    while True:
+        batch = list(old_read.order_by('id').values_list('id', flat=True)[:batch_size])
+        if not batch:
+            return deleted
+        deleted += Notification.objects.filter(id__in=batch).delete()[0]
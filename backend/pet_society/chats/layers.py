@@ -0,0 +1,365 @@
+import asyncio
+import os
+import pickle
+import random
+import sqlite3
+import string
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+
+class SQLiteChannelLayer(BaseChannelLayer):
+    """
+    Channel layer shared by every process on one machine, backed by a SQLite
+    database in WAL mode. Lets several daphne workers and gunicorn talk to the
+    same channels and groups without running Redis.
+
+    Each process keeps a single connection, used from one worker thread, and a
+    single poller task that fetches messages for all channels this process is
+    currently receiving on in one query.
+    """
+
+    extensions = ["groups", "flush"]
+
+    def __init__(
+        self,
+        path='channel_layer.sqlite3',
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+        poll_interval=0.005,
+        max_poll_interval=0.05,
+        cleanup_interval=5,
+        **kwargs,
+    ):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.path = str(path)
+        self.group_expiry = group_expiry
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.cleanup_interval = cleanup_interval
+        self.client_prefix = ''.join(random.choice(string.ascii_letters) for _ in range(8))
+
+        self._connection = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='channel-layer')
+        self._connection_lock = threading.Lock()
+        self._last_cleanup = 0
+        self._receive_buffers = {}
+        self._waiting = {}
+        self._last_receive = {}
+        self._poller = None
+        self._poller_loop = None
+        self._wakeup = None
+
+    # Database access, always on the layer's worker thread
+
+    def _get_connection(self):
+        if self._connection is None:
+            with self._connection_lock:
+                if self._connection is None:
+                    fresh = not os.path.exists(self.path)
+                    connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+                    if fresh:
+                        # Messages are pickled, so only this user may read or write them
+                        os.chmod(self.path, 0o600)
+                    connection.execute('PRAGMA journal_mode=WAL')
+                    connection.execute('PRAGMA synchronous=NORMAL')
+                    connection.executescript(
+                        """
+                        CREATE TABLE IF NOT EXISTS layer_messages (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            channel TEXT NOT NULL,
+                            expires REAL NOT NULL,
+                            payload BLOB NOT NULL
+                        );
+                        CREATE INDEX IF NOT EXISTS layer_messages_channel ON layer_messages (channel, id);
+                        CREATE TABLE IF NOT EXISTS layer_groups (
+                            grp TEXT NOT NULL,
+                            channel TEXT NOT NULL,
+                            joined REAL NOT NULL,
+                            PRIMARY KEY (grp, channel)
+                        );
+                        CREATE INDEX IF NOT EXISTS layer_groups_channel ON layer_groups (channel);
+                        """
+                    )
+                    self._connection = connection
+        return self._connection
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _db_send(self, sends):
+        """
+        Insert ``(channel, payload)`` pairs in one transaction, skipping (or,
+        for a single direct send, rejecting) channels that are at capacity.
+        """
+        connection = self._get_connection()
+        now = time.time()
+        channels = list({channel for channel, _ in sends})
+        placeholders = ','.join('?' * len(channels))
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            depths = dict(connection.execute(
+                f'SELECT channel, COUNT(*) FROM layer_messages '
+                f'WHERE channel IN ({placeholders}) AND expires >= ? GROUP BY channel',
+                (*channels, now),
+            ).fetchall())
+            rows = []
+            full = []
+            for channel, payload in sends:
+                if depths.get(channel, 0) >= self.get_capacity(channel):
+                    full.append(channel)
+                    continue
+                depths[channel] = depths.get(channel, 0) + 1
+                rows.append((channel, now + self.expiry, payload))
+            connection.executemany(
+                'INSERT INTO layer_messages (channel, expires, payload) VALUES (?, ?, ?)', rows
+            )
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return full
+
+    def _db_fetch(self, channels, limit=500):
+        """Atomically take the oldest pending messages for the given channels"""
+        connection = self._get_connection()
+        placeholders = ','.join('?' * len(channels))
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = connection.execute(
+                f'SELECT id, channel, expires, payload FROM layer_messages '
+                f'WHERE channel IN ({placeholders}) ORDER BY id LIMIT ?',
+                (*channels, limit),
+            ).fetchall()
+            if rows:
+                connection.executemany('DELETE FROM layer_messages WHERE id = ?', [(row[0],) for row in rows])
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return rows
+
+    def _db_cleanup(self):
+        """
+        Drop expired messages and group memberships. A channel whose message
+        expired unread is treated as dead and removed from all groups.
+        """
+        now = time.time()
+        if now - self._last_cleanup < self.cleanup_interval:
+            return
+        self._last_cleanup = now
+        connection = self._get_connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(
+                'DELETE FROM layer_groups WHERE channel IN '
+                '(SELECT DISTINCT channel FROM layer_messages WHERE expires < ?)',
+                (now,),
+            )
+            connection.execute('DELETE FROM layer_messages WHERE expires < ?', (now,))
+            connection.execute('DELETE FROM layer_groups WHERE joined < ?', (now - self.group_expiry,))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def _db_group_channels(self, group):
+        connection = self._get_connection()
+        return [
+            row[0] for row in connection.execute(
+                'SELECT channel FROM layer_groups WHERE grp = ? AND joined >= ?',
+                (group, time.time() - self.group_expiry),
+            )
+        ]
+
+    def _db_group_send(self, group, payload):
+        channels = self._db_group_channels(group)
+        if channels:
+            self._db_send([(channel, payload) for channel in channels])
+        return channels
+
+    def _db_execute(self, sql, params=()):
+        self._get_connection().execute(sql, params)
+
+    def _db_executemany(self, sql, rows):
+        connection = self._get_connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany(sql, rows)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        """
+        Send a message onto a (general or specific) channel.
+        """
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        assert "__asgi_channel__" not in message
+
+        full = await self._run(self._db_send, [(channel, pickle.dumps(message))])
+        if full:
+            raise ChannelFull(channel)
+        self._wake_if_local(channel)
+
+    async def receive(self, channel):
+        """
+        Receive the first message that arrives on the channel.
+        """
+        self.require_valid_channel_name(channel)
+        self._ensure_poller()
+
+        queue = self._receive_buffers.setdefault(channel, asyncio.Queue())
+        if not queue.empty():
+            return queue.get_nowait()
+
+        # Only channels with a waiting receiver are polled, so messages for a
+        # consumer that stopped receiving stay in the database
+        self._waiting[channel] = self._waiting.get(channel, 0) + 1
+        self._wakeup.set()
+        try:
+            return await queue.get()
+        finally:
+            self._waiting[channel] -= 1
+            if not self._waiting[channel]:
+                del self._waiting[channel]
+            self._last_receive[channel] = time.time()
+
+    async def new_channel(self, prefix="specific."):
+        """
+        Returns a new channel name that can be used by something in our
+        process as a specific channel.
+        """
+        return "%s.%s!%s" % (
+            prefix,
+            self.client_prefix,
+            "".join(random.choice(string.ascii_letters) for i in range(12)),
+        )
+
+    # Receiving
+
+    def _ensure_poller(self):
+        loop = asyncio.get_running_loop()
+        if self._poller is None or self._poller.done() or self._poller_loop is not loop:
+            self._receive_buffers = {}
+            self._waiting = {}
+            self._last_receive = {}
+            self._wakeup = asyncio.Event()
+            self._poller_loop = loop
+            self._poller = loop.create_task(self._poll())
+
+    def _wake_if_local(self, channel):
+        if self._wakeup is not None and channel in self._waiting:
+            try:
+                if asyncio.get_running_loop() is self._poller_loop:
+                    self._wakeup.set()
+            except RuntimeError:
+                pass
+
+    async def _poll(self):
+        interval = self.poll_interval
+        while True:
+            self._wakeup.clear()
+            channels = list(self._waiting)
+            if not channels:
+                # Nobody in this process is receiving; sleep until someone is
+                self._drop_idle_buffers()
+                await self._wakeup.wait()
+                continue
+
+            rows = await self._run(self._db_fetch, channels)
+            now = time.time()
+            for _, channel, expires, payload in rows:
+                if expires >= now:
+                    self._receive_buffers.setdefault(channel, asyncio.Queue()).put_nowait(pickle.loads(payload))
+
+            await self._run(self._db_cleanup)
+
+            if rows:
+                interval = self.poll_interval
+                continue
+            interval = min(interval * 2, self.max_poll_interval)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=interval)
+                interval = self.poll_interval
+            except asyncio.TimeoutError:
+                self._drop_idle_buffers()
+
+    def _drop_idle_buffers(self):
+        """Forget local buffers of channels nobody has received on for a while"""
+        cutoff = time.time() - self.expiry
+        for channel in list(self._receive_buffers):
+            if channel not in self._waiting and self._last_receive.get(channel, 0) < cutoff:
+                self._receive_buffers.pop(channel, None)
+                self._last_receive.pop(channel, None)
+
+    # Flush extension
+
+    async def flush(self):
+        await self._run(self._db_execute, 'DELETE FROM layer_messages')
+        await self._run(self._db_execute, 'DELETE FROM layer_groups')
+
+    async def close(self):
+        if self._poller is not None:
+            self._poller.cancel()
+            self._poller = None
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        """
+        Adds the channel name to a group.
+        """
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self._run(
+            self._db_execute,
+            'INSERT OR REPLACE INTO layer_groups (grp, channel, joined) VALUES (?, ?, ?)',
+            (group, channel, time.time()),
+        )
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        await self._run(
+            self._db_execute,
+            'DELETE FROM layer_groups WHERE grp = ? AND channel = ?',
+            (group, channel),
+        )
+
+    async def group_discard_many(self, memberships):
+        """
+        Remove many ``(group, channel)`` memberships in one transaction, e.g.
+        for every connection reaped by an idle sweep.
+        """
+        memberships = list(memberships)
+        for group, channel in memberships:
+            self.require_valid_group_name(group)
+            self.require_valid_channel_name(channel)
+        if memberships:
+            await self._run(
+                self._db_executemany, 'DELETE FROM layer_groups WHERE grp = ? AND channel = ?', memberships
+            )
+
+    async def group_send(self, group, message):
+        """
+        Send a message to every channel in a group in one transaction. Channels
+        at capacity are skipped, like the other channel layers do.
+        """
+        assert isinstance(message, dict), "Message is not a dict"
+        self.require_valid_group_name(group)
+
+        channels = await self._run(self._db_group_send, group, pickle.dumps(message))
+        for channel in channels:
+            self._wake_if_local(channel)
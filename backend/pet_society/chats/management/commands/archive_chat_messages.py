@@ -0,0 +1,68 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chats.archive import get_message_archive
+from chats.models import ChatGroup, GroupMessage
+
+
+class Command(BaseCommand):
+    help = (
+        'Move chat messages older than the retention period out of GroupMessage into compressed '
+        'per-group archive segments. Works one chunk per transaction and can be interrupted and '
+        'restarted at any time.'
+    )
+
+    def add_arguments(self, parser):
+        config = getattr(settings, 'CHAT_ARCHIVE', {})
+        parser.add_argument(
+            '--days', type=int, default=config.get('RETENTION_DAYS', 365),
+            help='Archive messages older than this many days',
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=config.get('CHUNK_SIZE', 500),
+            help='Messages per segment and transaction',
+        )
+        parser.add_argument('--max-chunks', type=int, help='Stop after this many chunks, to spread the work out')
+        parser.add_argument('--sleep', type=float, default=0.05, help='Seconds to pause between chunks')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be archived')
+
+    def handle(self, *args, **options):
+        archive = get_message_archive()
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        old_messages = GroupMessage.objects.filter(created__lt=cutoff)
+
+        if options['dry_run']:
+            self.stdout.write(
+                f'Would archive up to {old_messages.count()} messages '
+                f'in {old_messages.values("group").distinct().count()} groups'
+            )
+            return
+
+        pruned = archive.prune_orphans()
+        if pruned:
+            self.stdout.write(f'Removed {pruned} unindexed segment files')
+
+        chunks = messages = size = 0
+        group_ids = ChatGroup.objects.filter(
+            id__in=old_messages.values('group')
+        ).order_by('id').values_list('id', flat=True)
+        for group_id in group_ids:
+            if options['max_chunks'] is not None and chunks >= options['max_chunks']:
+                break
+            while options['max_chunks'] is None or chunks < options['max_chunks']:
+                segment = archive.archive_chunk(group_id, cutoff, options['chunk_size'])
+                if segment is None:
+                    break
+                chunks += 1
+                messages += segment.message_count
+                size += segment.size
+                self.stdout.write(f'Archived {segment.message_count} messages of group {group_id} to {segment.path}')
+                if options['sleep']:
+                    time.sleep(options['sleep'])
+
+        self.stdout.write(f'Archived {messages} messages in {chunks} segments ({size} bytes compressed)')
+        self.stdout.write(self.style.SUCCESS('Archiving complete'))
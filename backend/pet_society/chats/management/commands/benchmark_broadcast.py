@@ -0,0 +1,90 @@
+import json
+import time
+from types import SimpleNamespace
+
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from chats.consumers import ChatConsumer
+from chats.frames import encode_frame
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure CPU time per chat message broadcast against room size, encoding the frame '
+        'per socket versus once in the sender'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=200, help='Messages per room size')
+        parser.add_argument(
+            '--room-sizes', type=int, nargs='+', default=[1, 10, 100, 500],
+            help='Numbers of sockets in the room',
+        )
+
+    def handle(self, *args, **options):
+        count = options['messages']
+        self.stdout.write(f'{"sockets":>8} {"per socket":>14} {"encode once":>14} {"saved":>7}')
+        for size in options['room_sizes']:
+            per_socket = async_to_sync(self.run_room)(size, count, False)
+            once = async_to_sync(self.run_room)(size, count, True)
+            self.stdout.write(
+                f'{size:>8} {per_socket * 1e6:>11,.0f} us {once * 1e6:>11,.0f} us '
+                f'{1 - once / per_socket:>7.0%}'
+            )
+        self.stdout.write('CPU time per message, from group_send until every socket has its frame')
+        self.stdout.write(self.style.SUCCESS('Benchmark complete'))
+
+    def make_event(self, i, encode_once):
+        payload = {
+            'type': 'chat_message',
+            'message': f'benchmark message {i} with a little more text in it',
+            'username': 'bench',
+            'user_id': 1,
+            'timestamp': '2025-01-01T12:00:00.000000+00:00',
+            'message_id': i,
+            'provisional': False,
+        }
+        if encode_once:
+            return {'type': 'chat_message', 'frame': encode_frame(payload)}
+        return payload
+
+    async def run_room(self, size, count, encode_once):
+        layer = InMemoryChannelLayer(capacity=count + 1)
+        channels = [await layer.new_channel() for _ in range(size)]
+        for channel in channels:
+            await layer.group_add('benchmark', channel)
+
+        sent = []
+
+        async def send(text_data=None, bytes_data=None, close=False):
+            sent.append(text_data)
+
+        consumer = ChatConsumer()
+        consumer.user = SimpleNamespace(id=2)
+        consumer.send = send
+        handler = consumer.chat_message if encode_once else self.per_socket_handler(send)
+
+        started = time.process_time()
+        for i in range(count):
+            await layer.group_send('benchmark', self.make_event(i, encode_once))
+            for channel in channels:
+                await handler(await layer.receive(channel))
+        elapsed = time.process_time() - started
+        assert len(sent) == size * count
+        return elapsed / count
+
+    def per_socket_handler(self, send):
+        """The handler as it was before frames were encoded once"""
+        async def chat_message(event):
+            await send(text_data=json.dumps({
+                'type': 'chat_message',
+                'message': event['message'],
+                'username': event['username'],
+                'user_id': event['user_id'],
+                'timestamp': event['timestamp'],
+                'message_id': event['message_id'],
+                'provisional': event.get('provisional', False),
+            }))
+        return chat_message
@@ -0,0 +1,95 @@
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from chats.layers import SQLiteChannelLayer
+
+
+def _send_from_other_process(path, channel, count):
+    layer = SQLiteChannelLayer(path=path, capacity=count)
+
+    async def send_all():
+        for i in range(count):
+            await layer.send(channel, {'type': 'bench.message', 'n': i})
+
+    async_to_sync(send_all)()
+
+
+class Command(BaseCommand):
+    help = 'Compare SQLiteChannelLayer throughput against InMemoryChannelLayer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000, help='Messages per scenario')
+        parser.add_argument('--group-size', type=int, default=50, help='Channels in the group_send scenario')
+
+    def handle(self, *args, **options):
+        count = options['messages']
+        group_size = options['group_size']
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'layer.sqlite3')
+            layers = [
+                ('in-memory', lambda: InMemoryChannelLayer(capacity=count)),
+                ('sqlite', lambda: SQLiteChannelLayer(path=path, capacity=count)),
+            ]
+            for label, make_layer in layers:
+                layer = make_layer()
+                rate = async_to_sync(self.send_receive)(layer, count)
+                self.stdout.write(f'{label:<10} send+receive       {rate:>10,.0f} msg/s')
+                layer = make_layer()
+                rate = async_to_sync(self.group_fanout)(layer, count // group_size or 1, group_size)
+                self.stdout.write(f'{label:<10} group_send x{group_size:<5}  {rate:>10,.0f} deliveries/s')
+
+            rate = async_to_sync(self.cross_process)(path, count)
+            self.stdout.write(f'{"sqlite":<10} cross-process      {rate:>10,.0f} msg/s')
+        self.stdout.write(self.style.SUCCESS('Benchmark complete'))
+
+    async def send_receive(self, layer, count):
+        channel = await layer.new_channel()
+        started = time.perf_counter()
+        for i in range(count):
+            await layer.send(channel, {'type': 'bench.message', 'n': i})
+        for _ in range(count):
+            await layer.receive(channel)
+        elapsed = time.perf_counter() - started
+        await layer.flush()
+        await layer.close()
+        return count / elapsed
+
+    async def group_fanout(self, layer, sends, group_size):
+        channels = [await layer.new_channel() for _ in range(group_size)]
+        for channel in channels:
+            await layer.group_add('bench', channel)
+        started = time.perf_counter()
+        for i in range(sends):
+            await layer.group_send('bench', {'type': 'bench.message', 'n': i})
+        await asyncio.gather(*[
+            self.drain(layer, channel, sends) for channel in channels
+        ])
+        elapsed = time.perf_counter() - started
+        await layer.flush()
+        await layer.close()
+        return sends * group_size / elapsed
+
+    async def drain(self, layer, channel, count):
+        for _ in range(count):
+            await layer.receive(channel)
+
+    async def cross_process(self, path, count):
+        layer = SQLiteChannelLayer(path=path, capacity=count)
+        channel = await layer.new_channel()
+        started = time.perf_counter()
+        process = multiprocessing.Process(target=_send_from_other_process, args=(path, channel, count))
+        process.start()
+        await self.drain(layer, channel, count)
+        elapsed = time.perf_counter() - started
+        await asyncio.get_running_loop().run_in_executor(None, process.join)
+        await layer.flush()
+        await layer.close()
+        return count / elapsed
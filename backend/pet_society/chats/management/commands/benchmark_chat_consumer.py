@@ -0,0 +1,113 @@
+import asyncio
+import shutil
+import tempfile
+import time
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from rest_framework.authtoken.models import Token
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure ChatConsumer messages/sec for one room with the channels test communicator. '
+        'Runs against a throwaway test database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=500, help='Messages sent by the sender')
+        parser.add_argument('--listeners', type=int, default=4, help='Other members connected to the room')
+        parser.add_argument(
+            '--in-memory-layer', action='store_true',
+            help='Use InMemoryChannelLayer to measure the consumer without channel layer overhead',
+        )
+        parser.add_argument(
+            '--write-behind', action='store_true',
+            help='Store messages with write-behind persistence instead of one INSERT per message',
+        )
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0)
+        log_dir = tempfile.mkdtemp(prefix='chat-wal-')
+        overrides = {}
+        if options['in_memory_layer']:
+            overrides['CHANNEL_LAYERS'] = {
+                'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 10000}}
+            }
+        if options['write_behind']:
+            overrides['CHAT_PERSISTENCE'] = {'MODE': 'write_behind', 'LOG_DIR': log_dir}
+        try:
+            with override_settings(**overrides):
+                rate, persisted_rate = async_to_sync(self.run_benchmark)(
+                    options['messages'], options['listeners'], options['write_behind']
+                )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            shutil.rmtree(log_dir, ignore_errors=True)
+        self.stdout.write(
+            f"{options['messages']} messages, {options['listeners']} listeners: {rate:,.0f} msg/s"
+        )
+        if persisted_rate:
+            self.stdout.write(f"  all messages stored at {persisted_rate:,.0f} msg/s")
+        self.stdout.write(self.style.SUCCESS('Benchmark complete'))
+
+    @database_sync_to_async
+    def create_room(self, members):
+        from chats.models import ChatGroup
+
+        User = get_user_model()
+        tokens = []
+        chat_group = ChatGroup.objects.create(name='benchmark-room')
+        for i in range(members):
+            user = User.objects.create_user(
+                username=f'bench{i}', email=f'bench{i}@example.com', password='bench',
+                first_name='Bench', last_name=str(i),
+            )
+            chat_group.members.add(user)
+            tokens.append(Token.objects.create(user=user).key)
+        return tokens
+
+    async def connect(self, token):
+        from pet_society.asgi import application
+
+        communicator = WebsocketCommunicator(
+            application, f'/ws/chat/benchmark-room/?token={token}', headers=[(b'origin', b'http://localhost')]
+        )
+        connected, _ = await communicator.connect()
+        assert connected, 'Could not connect to the room'
+        return communicator
+
+    async def drain(self, communicator, count, persisted=0):
+        received = 0
+        stored = 0
+        while received < count or stored < persisted:
+            frame = await communicator.receive_json_from(timeout=30)
+            if frame.get('type') == 'chat_message':
+                received += 1
+            elif frame.get('type') == 'message_persisted':
+                stored += len(frame['messages'])
+
+    async def run_benchmark(self, count, listeners, write_behind=False):
+        tokens = await self.create_room(listeners + 1)
+        sockets = [await self.connect(token) for token in tokens]
+        sender = sockets[0]
+
+        started = time.perf_counter()
+        for i in range(count):
+            await sender.send_json_to({'type': 'chat_message', 'message': f'benchmark message {i}'})
+        await asyncio.gather(*[self.drain(socket, count) for socket in sockets[1:]])
+        elapsed = time.perf_counter() - started
+        # With write-behind the sender also waits until every message has a real id
+        await self.drain(sender, count, count if write_behind else 0)
+        stored_elapsed = time.perf_counter() - started
+
+        for socket in sockets:
+            await socket.disconnect()
+        return count / elapsed, count / stored_elapsed if write_behind else None
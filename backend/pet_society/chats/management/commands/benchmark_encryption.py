@@ -0,0 +1,59 @@
+import base64
+import time
+
+from cryptography.fernet import Fernet
+from django.core.management.base import BaseCommand
+
+from chats.encryption import EncryptionService, get_encryption_key
+
+
+class Command(BaseCommand):
+    help = 'Micro-benchmark chat message decryption throughput (messages/sec)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=5000, help='Number of messages to decrypt')
+        parser.add_argument('--length', type=int, default=120, help='Plaintext length in characters')
+        parser.add_argument('--workers', type=int, default=4, help='Thread pool size for batch decryption')
+
+    def handle(self, *args, **options):
+        count = options['messages']
+        key = get_encryption_key()
+        service = EncryptionService(key=key, cache_size=count, max_workers=options['workers'], parallel_threshold=64)
+        plaintext = ('woof ' * options['length'])[:options['length']]
+        items = [(i, service.encrypt(plaintext), service.key_id) for i in range(count)]
+
+        def per_call_fernet():
+            # What decrypt_message used to do: build a new cipher for every message
+            for _, token, _ in items:
+                Fernet(get_encryption_key()).decrypt(base64.b64decode(token.encode())).decode()
+
+        def cached_cipher():
+            for _, token, _ in items:
+                service.decrypt(token)
+
+        def batch_serial():
+            service.clear_cache()
+            service.parallel_threshold = count + 1
+            service.decrypt_many(items)
+
+        def batch_parallel():
+            service.clear_cache()
+            service.parallel_threshold = 64
+            service.decrypt_many(items)
+
+        def batch_cached():
+            service.decrypt_many(items)
+
+        self.stdout.write(f'Decrypting {count} messages of {len(plaintext)} chars')
+        for label, run in [
+            ('new Fernet per message', per_call_fernet),
+            ('cached cipher', cached_cipher),
+            ('decrypt_many (serial)', batch_serial),
+            (f'decrypt_many ({options["workers"]} threads)', batch_parallel),
+            ('decrypt_many (LRU hit)', batch_cached),
+        ]:
+            started = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f'  {label:<32} {count / elapsed:>12,.0f} msg/s')
+        self.stdout.write(self.style.SUCCESS('Benchmark complete'))
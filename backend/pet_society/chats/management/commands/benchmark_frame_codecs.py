@@ -0,0 +1,91 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from chats.frames import JSON, encode_frame, get_codecs
+
+
+def _user(i):
+    return {'id': i, 'username': f'petlover{i}', 'first_name': 'Pet', 'last_name': f'Lover {i}'}
+
+
+SAMPLE_FRAMES = {
+    'chat message': {
+        'type': 'chat_message',
+        'message': 'Just took Biscuit to the park, he loved it!',
+        'username': 'petlover1',
+        'user_id': 1,
+        'timestamp': '2025-01-01T12:00:00.123456+00:00',
+        'message_id': 123456,
+        'provisional': False,
+    },
+    'long chat message': {
+        'type': 'chat_message',
+        'message': ' '.join(['Biscuit chased the ball across the whole park again today.'] * 20),
+        'username': 'petlover1',
+        'user_id': 1,
+        'timestamp': '2025-01-01T12:00:00.123456+00:00',
+        'message_id': 123457,
+        'provisional': False,
+    },
+    'notification': {
+        'type': 'chat_message_notification',
+        'chat_id': 42,
+        'chat_name': 'dog-owners',
+        'is_private': False,
+        'message': 'Just took Biscuit to the park, he loved it!',
+        'message_id': 123456,
+        'count': 1,
+        'author': _user(1),
+        'timestamp': '2025-01-01T12:00:00.123456+00:00',
+    },
+    'user list (100 users)': {
+        'type': 'user_list_update',
+        'users': [{'id': i, 'username': f'petlover{i}'} for i in range(100)],
+    },
+}
+
+
+class Command(BaseCommand):
+    help = 'Measure frame size and encode/decode CPU time for each websocket protocol'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=5000, help='Encodes and decodes per measurement')
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        codecs = [('json', JSON)] + [(subprotocol, codec) for subprotocol, codec in get_codecs().items()]
+
+        self.stdout.write(f'{"frame":<24} {"protocol":<22} {"bytes":>7} {"encode":>10} {"decode":>10}')
+        for label, payload in SAMPLE_FRAMES.items():
+            for name, codec in codecs:
+                encoded = codec.encode(payload)
+                encode_time = self.measure(lambda: codec.encode(payload), iterations)
+                if codec.binary:
+                    decode_time = self.measure(lambda: codec.decode(bytes_data=encoded), iterations)
+                    assert codec.decode(bytes_data=encoded) == payload
+                else:
+                    decode_time = self.measure(lambda: codec.decode(text_data=encoded), iterations)
+                size = len(encoded if codec.binary else encoded.encode())
+                self.stdout.write(
+                    f'{label:<24} {name:<22} {size:>7,} {encode_time * 1e6:>7.2f} us {decode_time * 1e6:>7.2f} us'
+                )
+
+        # Broadcasts are pre-encoded as JSON; binary sockets convert once per process
+        frame = encode_frame(SAMPLE_FRAMES['chat message'])
+        self.stdout.write('')
+        self.stdout.write('Converting a pre-encoded broadcast frame (first socket / cached):')
+        for name, codec in codecs[1:]:
+            uncached = self.measure(lambda: codec.pack(codec.serialize_json(frame)), iterations)
+            cached = self.measure(lambda: codec.from_json(frame), iterations)
+            self.stdout.write(f'  {name:<22} {uncached * 1e6:>7.2f} us / {cached * 1e6:.2f} us')
+
+        self.stdout.write(f'(json.dumps baseline: {self.measure(lambda: json.dumps(SAMPLE_FRAMES["chat message"]), iterations) * 1e6:.2f} us)')
+        self.stdout.write(self.style.SUCCESS('Benchmark complete'))
+
+    def measure(self, func, iterations):
+        started = time.process_time()
+        for _ in range(iterations):
+            func()
+        return (time.process_time() - started) / iterations
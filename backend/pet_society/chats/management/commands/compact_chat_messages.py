@@ -0,0 +1,68 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chats.encryption import legacy_to_storage_bytes
+from chats.models import GroupMessage
+
+
+class Command(BaseCommand):
+    help = (
+        'Rewrite legacy base64 encrypted_body rows into the compact binary ciphertext column. '
+        'Runs in small chunks and can be interrupted and restarted at any time.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows rewritten per transaction')
+        parser.add_argument('--sleep', type=float, default=0.05, help='Seconds to pause between batches')
+        parser.add_argument('--dry-run', action='store_true', help='Only report the storage savings')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        legacy_rows = GroupMessage.objects.filter(
+            is_encrypted=True,
+            ciphertext__isnull=True,
+            encrypted_body__isnull=False,
+        ).exclude(encrypted_body='').order_by('id')
+
+        last_id = 0
+        rewritten = 0
+        legacy_bytes = 0
+        compact_bytes = 0
+        while True:
+            batch = list(legacy_rows.filter(id__gt=last_id).only('id', 'encrypted_body')[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1].id
+
+            to_update = []
+            for message in batch:
+                try:
+                    ciphertext = legacy_to_storage_bytes(message.encrypted_body)
+                except Exception as e:
+                    self.stderr.write(f'Skipping message {message.id}: {e}')
+                    continue
+                legacy_bytes += len(message.encrypted_body)
+                compact_bytes += len(ciphertext)
+                message.ciphertext = ciphertext
+                message.encrypted_body = None
+                to_update.append(message)
+
+            if not options['dry_run'] and to_update:
+                with transaction.atomic():
+                    GroupMessage.objects.bulk_update(to_update, ['ciphertext', 'encrypted_body'])
+            rewritten += len(to_update)
+
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        verb = 'Would rewrite' if options['dry_run'] else 'Rewrote'
+        self.stdout.write(f'{verb} {rewritten} messages')
+        if legacy_bytes:
+            saved = legacy_bytes - compact_bytes
+            self.stdout.write(
+                f'Legacy size {legacy_bytes} bytes, compact size {compact_bytes} bytes, '
+                f'saved {saved} bytes ({saved / legacy_bytes:.1%})'
+            )
+        self.stdout.write(self.style.SUCCESS('Compaction complete'))
@@ -0,0 +1,60 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chats.encryption import decrypt_messages
+from chats.models import GroupMessage, MessageSearchToken
+from chats.search import index_tokens, search_tokens
+
+
+class Command(BaseCommand):
+    help = (
+        'Backfill the chat search blind index for text messages stored before search existed. '
+        'Runs in small chunks and can be interrupted and restarted at any time.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Messages indexed per transaction')
+        parser.add_argument('--sleep', type=float, default=0.05, help='Seconds to pause between batches')
+        parser.add_argument(
+            '--rebuild', action='store_true',
+            help='Drop the whole index first, e.g. after changing CHAT_SEARCH_KEY',
+        )
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            deleted, _ = MessageSearchToken.objects.all().delete()
+            self.stdout.write(f'Dropped {deleted} search tokens')
+
+        # Messages that already have tokens were indexed when they were sent
+        unindexed = GroupMessage.objects.filter(message_type='text').exclude(
+            id__in=MessageSearchToken.objects.values('message_id')
+        ).order_by('id')
+
+        last_id = 0
+        indexed = tokens = 0
+        while True:
+            batch = list(unindexed.filter(id__gt=last_id).only(
+                'id', 'group_id', 'message_type', 'encrypted_body', 'ciphertext', 'key_id', 'is_encrypted'
+            )[:options['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1].id
+
+            plaintexts = decrypt_messages(batch)
+            entries = []
+            for message in batch:
+                text = plaintexts.get(message.id) if message.is_encrypted else message.encrypted_body
+                if text:
+                    entries.append((message.id, message.group_id, search_tokens(text)))
+            with transaction.atomic():
+                index_tokens(entries)
+            indexed += len(entries)
+            tokens += sum(len(entry[2]) for entry in entries)
+
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        self.stdout.write(f'Indexed {indexed} messages ({tokens} tokens)')
+        self.stdout.write(self.style.SUCCESS('Indexing complete'))
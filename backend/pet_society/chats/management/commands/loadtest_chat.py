@@ -0,0 +1,345 @@
+import asyncio
+import base64
+import json
+import os
+import random
+import struct
+import time
+from urllib.parse import urlparse
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import setup_test_environment, teardown_test_environment
+from rest_framework.authtoken.models import Token
+
+ORIGIN = 'http://localhost'
+PREFIX = 'loadtest'
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def rss_bytes(pid):
+    """Resident set size of a process, from /proc (Linux only)"""
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+class InProcessClient:
+    """A socket to the ASGI application running in this process"""
+
+    def __init__(self, path):
+        from pet_society.asgi import application
+
+        self.communicator = WebsocketCommunicator(application, path, headers=[(b'origin', ORIGIN.encode())])
+
+    async def connect(self):
+        connected, code = await self.communicator.connect(timeout=30)
+        if not connected:
+            raise ConnectionError(f'Connection refused with code {code}')
+
+    async def send(self, payload):
+        await self.communicator.send_json_to(payload)
+
+    async def receive(self):
+        """Next frame, or None once the socket is closed"""
+        # Reading the queue directly: a receive timeout would cancel the app
+        message = await self.communicator.output_queue.get()
+        if message['type'] == 'websocket.close':
+            return None
+        return json.loads(message.get('text') or message['bytes'])
+
+    async def close(self):
+        await self.communicator.disconnect(timeout=5)
+
+
+class ServerClient:
+    """
+    A socket to a running server, e.g. daphne. A minimal RFC 6455 client on
+    asyncio streams: autobahn's client cannot run next to daphne's Twisted
+    setup in the same process.
+    """
+
+    def __init__(self, url):
+        self.url = urlparse(url)
+
+    async def connect(self):
+        port = self.url.port or 80
+        self.reader, self.writer = await asyncio.open_connection(self.url.hostname, port)
+        path = self.url.path + (f'?{self.url.query}' if self.url.query else '')
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.writer.write((
+            f'GET {path} HTTP/1.1\r\n'
+            f'Host: {self.url.hostname}:{port}\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            f'Sec-WebSocket-Key: {key}\r\n'
+            'Sec-WebSocket-Version: 13\r\n'
+            f'Origin: {ORIGIN}\r\n\r\n'
+        ).encode())
+        response = await self.reader.readuntil(b'\r\n\r\n')
+        status = response.split(b'\r\n', 1)[0]
+        if b' 101 ' not in status:
+            self.writer.close()
+            raise ConnectionError(f'Connection refused: {status.decode()}')
+
+    async def _write_frame(self, opcode, payload):
+        header = bytearray([0x80 | opcode])
+        if len(payload) < 126:
+            header.append(0x80 | len(payload))
+        elif len(payload) < 1 << 16:
+            header.append(0x80 | 126)
+            header += struct.pack('!H', len(payload))
+        else:
+            header.append(0x80 | 127)
+            header += struct.pack('!Q', len(payload))
+        # Client frames must be masked
+        mask = os.urandom(4)
+        repeated = (mask * (len(payload) // 4 + 1))[:len(payload)]
+        masked = (int.from_bytes(payload, 'big') ^ int.from_bytes(repeated, 'big')).to_bytes(len(payload), 'big')
+        self.writer.write(bytes(header) + mask + masked)
+        await self.writer.drain()
+
+    async def send(self, payload):
+        await self._write_frame(0x1, json.dumps(payload).encode())
+
+    async def receive(self):
+        """Next frame, or None once the socket is closed"""
+        data = b''
+        while True:
+            try:
+                first, second = await self.reader.readexactly(2)
+                length = second & 0x7f
+                if length == 126:
+                    length = struct.unpack('!H', await self.reader.readexactly(2))[0]
+                elif length == 127:
+                    length = struct.unpack('!Q', await self.reader.readexactly(8))[0]
+                payload = await self.reader.readexactly(length)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return None
+            opcode = first & 0x0f
+            if opcode == 0x8:  # Close
+                return None
+            if opcode == 0x9:  # Ping
+                await self._write_frame(0xA, payload)
+                continue
+            if opcode == 0xA:  # Pong
+                continue
+            data += payload
+            if first & 0x80:  # Final fragment
+                return json.loads(data)
+
+    async def close(self):
+        try:
+            await self._write_frame(0x8, struct.pack('!H', 1000))
+        except ConnectionError:
+            pass
+        self.writer.close()
+
+
+class Command(BaseCommand):
+    help = (
+        'Load test ChatConsumer and NotificationConsumer: open authenticated sockets across rooms, '
+        'send chat messages at a fixed rate and report connect latency, delivery latency, '
+        'throughput and memory per connection. Runs the ASGI application in-process on a '
+        'throwaway test database, or against a running server with --url.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=100, help='Chat sockets, one user each')
+        parser.add_argument('--rooms', type=int, default=10, help='Rooms the chat sockets are spread over')
+        parser.add_argument('--rate', type=float, default=50, help='Chat messages per second, across all rooms')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds to send for')
+        parser.add_argument(
+            '--notification-users', type=int, default=0,
+            help='Extra members per room connected only to notifications, who get a notification per message',
+        )
+        parser.add_argument(
+            '--url', help='Base URL of a running server, e.g. ws://127.0.0.1:8000. Users, rooms and tokens '
+                          'are created in the configured database and deleted afterwards.',
+        )
+        parser.add_argument('--server-pid', type=int, help='Server process to measure memory of, with --url')
+
+    def handle(self, *args, **options):
+        self.created = None
+        if options['url']:
+            self.url = options['url'].rstrip('/')
+            pid = options['server_pid']
+            try:
+                self.report(async_to_sync(self.run)(options, pid))
+            finally:
+                self.cleanup()
+            return
+
+        self.url = None
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            self.report(async_to_sync(self.run)(options, os.getpid()))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def client(self, path):
+        if self.url:
+            return ServerClient(self.url + path)
+        return InProcessClient(path)
+
+    @database_sync_to_async
+    def create_users(self, connections, rooms, notification_users):
+        """
+        Bulk-create users, tokens and rooms; returns [(user id, token, room
+        name, chat socket?)]. All or nothing; what was created is recorded in
+        ``self.created`` for ``cleanup``.
+        """
+        from chats.models import ChatGroup
+
+        User = get_user_model()
+        total = connections + rooms * notification_users
+        with transaction.atomic():
+            users = User.objects.bulk_create([
+                User(
+                    username=f'{PREFIX}{i}', email=f'{PREFIX}{i}@example.com',
+                    first_name='Load', last_name=f'Test {i}', password='!',
+                )
+                for i in range(total)
+            ])
+            tokens = Token.objects.bulk_create([Token(key=Token.generate_key(), user=user) for user in users])
+            groups = ChatGroup.objects.bulk_create([ChatGroup(name=f'{PREFIX}-room-{i}') for i in range(rooms)])
+
+            sockets = []
+            memberships = []
+            for i, (user, token) in enumerate(zip(users, tokens)):
+                if i < connections:
+                    group, chat = groups[i % rooms], True
+                else:
+                    group, chat = groups[(i - connections) // notification_users], False
+                memberships.append(ChatGroup.members.through(chatgroup_id=group.id, user_id=user.id))
+                sockets.append((user.id, token.key, group.name, chat))
+            ChatGroup.members.through.objects.bulk_create(memberships)
+        self.created = {
+            'users': [user.id for user in users],
+            'tokens': [token.key for token in tokens],
+            'groups': [group.id for group in groups],
+        }
+        return sockets
+
+    def cleanup(self):
+        """Delete exactly the rows this run created, nothing if it created none"""
+        from chats.models import ChatGroup
+
+        if not self.created:
+            return
+        ChatGroup.objects.filter(id__in=self.created['groups']).delete()
+        Token.objects.filter(key__in=self.created['tokens']).delete()
+        get_user_model().objects.filter(id__in=self.created['users']).delete()
+        self.created = None
+
+    async def run(self, options, pid):
+        sockets = await self.create_users(
+            options['connections'], options['rooms'], options['notification_users']
+        )
+        stats = {'connect': [], 'delivery': [], 'notification': [], 'delivered': 0, 'notified': 0, 'failed': 0}
+
+        rss_before = rss_bytes(pid) if pid else None
+        chats, notifications = [], []
+        for user_id, token, room, chat in sockets:
+            if chat:
+                client = self.client(f'/ws/chat/{room}/?token={token}')
+            else:
+                client = self.client(f'/ws/notifications/{user_id}/?token={token}')
+            started = time.perf_counter()
+            try:
+                await client.connect()
+            except Exception as e:
+                stats['failed'] += 1
+                self.stderr.write(f'Connection failed: {e}')
+                continue
+            stats['connect'].append(time.perf_counter() - started)
+            (chats if chat else notifications).append(client)
+        rss_after = rss_bytes(pid) if pid else None
+        stats['rss_per_connection'] = (
+            (rss_after - rss_before) / max(1, len(chats) + len(notifications))
+            if rss_before is not None and rss_after is not None else None
+        )
+
+        readers = [asyncio.ensure_future(self.read(client, stats)) for client in chats + notifications]
+
+        # Send at a fixed rate from random chat sockets; the text carries the send time
+        sent = 0
+        started = time.time()
+        interval = 1 / options['rate']
+        while chats and time.time() - started < options['duration']:
+            await random.choice(chats).send({'type': 'chat_message', 'message': f'{PREFIX} {time.time():.6f}'})
+            sent += 1
+            delay = started + sent * interval - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        send_elapsed = time.time() - started
+
+        # Let in-flight messages arrive
+        await asyncio.sleep(2)
+        elapsed = time.time() - started
+        for client in chats + notifications:
+            await client.close()
+        for reader in readers:
+            reader.cancel()
+
+        stats.update(
+            sent=sent, send_elapsed=send_elapsed, elapsed=elapsed,
+            chats=len(chats), notifications=len(notifications),
+        )
+        return stats
+
+    async def read(self, client, stats):
+        while True:
+            frame = await client.receive()
+            if frame is None:
+                return
+            now = time.time()
+            if frame.get('type') == 'chat_message' and str(frame.get('message', '')).startswith(PREFIX):
+                stats['delivery'].append(now - float(frame['message'].split()[1]))
+                stats['delivered'] += 1
+            elif frame.get('type') == 'chat_message_notification' and str(frame.get('message', '')).startswith(PREFIX):
+                stats['notification'].append(now - float(frame['message'].split()[1]))
+                stats['notified'] += 1
+
+    def report(self, stats):
+        def latencies(label, values):
+            self.stdout.write(
+                f'{label:<22} p50 {percentile(values, 0.5) * 1000:8.1f} ms   '
+                f'p95 {percentile(values, 0.95) * 1000:8.1f} ms   '
+                f'p99 {percentile(values, 0.99) * 1000:8.1f} ms   '
+                f'max {max(values, default=0) * 1000:8.1f} ms'
+            )
+
+        self.stdout.write(
+            f"{stats['chats']} chat sockets, {stats['notifications']} notification sockets, "
+            f"{stats['failed']} failed"
+        )
+        latencies('connect', stats['connect'])
+        latencies('message delivery', stats['delivery'])
+        if stats['notification']:
+            latencies('notification', stats['notification'])
+        self.stdout.write(
+            f"sent {stats['sent']} messages at {stats['sent'] / stats['send_elapsed']:,.1f} msg/s, "
+            f"delivered {stats['delivered']} frames ({stats['delivered'] / stats['elapsed']:,.0f} frames/s), "
+            f"{stats['notified']} notifications"
+        )
+        if stats['rss_per_connection'] is not None:
+            self.stdout.write(f"memory per connection  {stats['rss_per_connection'] / 1024:,.1f} KiB RSS")
+        self.stdout.write(self.style.SUCCESS('Load test complete'))
@@ -0,0 +1,28 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chats.inbox import prune_read
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete read notifications older than the retention period from users\' inboxes. '
+        'Unread notifications are kept. Works in batches and can be interrupted at any time.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int,
+            default=getattr(settings, 'CHAT_NOTIFICATION_INBOX', {}).get('RETENTION_DAYS', 30),
+            help='Delete read notifications older than this many days',
+        )
+        parser.add_argument('--batch-size', type=int, default=1000, help='Notifications deleted per transaction')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        deleted = prune_read(cutoff, options['batch_size'])
+        self.stdout.write(f'Deleted {deleted} read notifications')
+        self.stdout.write(self.style.SUCCESS('Pruning complete'))
@@ -0,0 +1,83 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from chats.encryption import get_encryption_service, stored_ciphertext
+from chats.models import GroupMessage
+
+
+class Command(BaseCommand):
+    help = (
+        'Re-encrypt chat messages that were not written with the primary ENCRYPTION_KEY. '
+        'Works in small batches, so it can run next to live chat traffic, and can be '
+        'stopped and restarted at any time: rows already on the primary key are skipped.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200, help='Rows re-encrypted per transaction')
+        parser.add_argument('--max-rate', type=float, default=1000, help='Upper bound on messages/sec (0 for unlimited)')
+        parser.add_argument('--start-id', type=int, default=0, help='Resume after this message id')
+
+    def handle(self, *args, **options):
+        service = get_encryption_service()
+        batch_size = options['batch_size']
+        max_rate = options['max_rate']
+
+        pending = GroupMessage.objects.filter(is_encrypted=True).filter(
+            ~Q(key_id=service.key_id) | Q(key_id__isnull=True)
+        ).filter(
+            Q(ciphertext__isnull=False) | Q(encrypted_body__isnull=False)
+        ).order_by('id')
+
+        last_id = options['start_id']
+        rotated = 0
+        failed = 0
+        started = time.monotonic()
+        while True:
+            batch_started = time.monotonic()
+            batch = list(
+                pending.filter(id__gt=last_id).only('id', 'ciphertext', 'encrypted_body', 'key_id')[:batch_size]
+            )
+            if not batch:
+                break
+            last_id = batch[-1].id
+
+            to_update = []
+            for message in batch:
+                stored = stored_ciphertext(message)
+                if not stored:
+                    continue
+                try:
+                    message.ciphertext = service.reencrypt(stored, key_id=message.key_id)
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f'Could not re-encrypt message {message.id}: {e}')
+                    continue
+                message.encrypted_body = None
+                message.key_id = service.key_id
+                to_update.append(message)
+
+            # One short transaction per batch keeps the write lock away from live inserts
+            if to_update:
+                with transaction.atomic():
+                    GroupMessage.objects.bulk_update(to_update, ['ciphertext', 'encrypted_body', 'key_id'])
+            rotated += len(to_update)
+            self.stdout.write(f'Re-encrypted {rotated} messages (last id {last_id})')
+
+            if max_rate:
+                min_duration = len(batch) / max_rate
+                elapsed = time.monotonic() - batch_started
+                if elapsed < min_duration:
+                    time.sleep(min_duration - elapsed)
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(f'Re-encrypted {rotated} messages in {elapsed:.1f}s, {failed} failed')
+        if failed:
+            self.stdout.write(self.style.WARNING(
+                'Some messages could not be decrypted with any configured key; '
+                'keep their key in ENCRYPTION_LEGACY_KEYS and rerun'
+            ))
+        else:
+            self.stdout.write(self.style.SUCCESS('Key rotation complete'))
@@ -0,0 +1,147 @@
+import hashlib
+import io
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+from PIL import Image, ImageOps, features
+
+UPLOAD_DIR = 'chat_images'
+
+
+class _StreamedFile(File):
+    """A fully written temporary file; storages move it into place instead of copying"""
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def store_image(upload, schedule=True):
+    """
+    Store an uploaded image once per distinct content and return its ChatImage.
+
+    The upload is hashed while it is streamed to a temporary file, which is
+    then moved to a name derived from the hash. Content that is already
+    stored is not written again: the temporary file is dropped and the
+    existing ChatImage reused. Thumbnails are made in the background once the
+    transaction commits (see ``schedule_renditions``), unless ``schedule`` is
+    False.
+    """
+    from .models import ChatImage
+
+    digest = hashlib.sha256()
+    size = 0
+    temp_file = tempfile.NamedTemporaryFile(dir=settings.FILE_UPLOAD_TEMP_DIR, suffix='.upload', delete=False)
+    try:
+        with temp_file:
+            for chunk in upload.chunks():
+                digest.update(chunk)
+                temp_file.write(chunk)
+                size += len(chunk)
+        sha256 = digest.hexdigest()
+
+        existing = ChatImage.objects.filter(sha256=sha256).first()
+        if existing is not None:
+            return existing
+
+        with Image.open(temp_file.name) as image:
+            image_format = image.format or ''
+            width, height = image.size
+        extension = {'JPEG': 'jpg', '': 'bin'}.get(image_format, image_format.lower())
+        with open(temp_file.name, 'rb') as streamed:
+            name = default_storage.save(f'{UPLOAD_DIR}/{sha256[:2]}/{sha256}.{extension}', _StreamedFile(streamed))
+
+        try:
+            with transaction.atomic():
+                chat_image = ChatImage.objects.create(
+                    sha256=sha256, file=name, format=image_format, width=width, height=height, size=size,
+                )
+        except IntegrityError:
+            # The same content was uploaded concurrently
+            default_storage.delete(name)
+            return ChatImage.objects.get(sha256=sha256)
+    finally:
+        if os.path.exists(temp_file.name):
+            os.remove(temp_file.name)
+
+    if schedule:
+        transaction.on_commit(lambda: schedule_renditions(chat_image.id))
+    return chat_image
+
+
+def _encode_rendition(image, max_size):
+    """Downscale to fit ``max_size`` pixels and encode as WebP, or JPEG without WebP support"""
+    config = getattr(settings, 'CHAT_MEDIA', {})
+    rendition = image.copy()
+    rendition.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+    output = io.BytesIO()
+    if features.check('webp'):
+        rendition.save(output, 'WEBP', quality=config.get('QUALITY', 80), method=4)
+        return output.getvalue(), 'webp'
+    rendition.convert('RGB').save(output, 'JPEG', quality=config.get('QUALITY', 80), optimize=True)
+    return output.getvalue(), 'jpg'
+
+
+def generate_renditions(chat_image):
+    """
+    Make the thumbnail (inline in history) and preview (opened image) of a
+    ChatImage. Images already smaller than a size get no rendition for it;
+    clients fall back to the next larger one.
+    """
+    config = getattr(settings, 'CHAT_MEDIA', {})
+    sizes = {
+        'thumbnail': config.get('THUMBNAIL_SIZE', 400),
+        'preview': config.get('PREVIEW_SIZE', 1280),
+    }
+    with chat_image.file.open('rb') as original:
+        with Image.open(original) as image:
+            # Apply camera rotation and take the first frame of animations
+            image = ImageOps.exif_transpose(image)
+            for field, max_size in sizes.items():
+                if max(image.size) <= max_size:
+                    continue
+                data, extension = _encode_rendition(image, max_size)
+                getattr(chat_image, field).save(
+                    f'{chat_image.sha256}-{max_size}.{extension}', ContentFile(data), save=False
+                )
+    chat_image.processed_at = timezone.now()
+    chat_image.save(update_fields=['thumbnail', 'preview', 'processed_at'])
+
+
+def _render(chat_image_id):
+    from .models import ChatImage
+
+    close_old_connections()
+    try:
+        chat_image = ChatImage.objects.filter(id=chat_image_id, processed_at__isnull=True).first()
+        if chat_image is not None:
+            generate_renditions(chat_image)
+    except Exception as e:
+        # Left unprocessed; manage.py generate_chat_thumbnails retries it
+        print(f"Thumbnail error for chat image {chat_image_id}: {e}")
+    finally:
+        close_old_connections()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def schedule_renditions(chat_image_id):
+    """Generate a ChatImage's renditions on a small thread pool, off the request path"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'CHAT_MEDIA', {}).get('WORKERS', 2),
+                    thread_name_prefix='chat-media',
+                )
+    _executor.submit(_render, chat_image_id)
@@ -0,0 +1,43 @@
+from django.contrib.auth import get_user_model
+
+
+def clean_usernames(usernames):
+    """Distinct, stripped, non-empty usernames in the order given"""
+    return list(dict.fromkeys(
+        username.strip() for username in usernames if isinstance(username, str) and username.strip()
+    ))
+
+
+def resolve_usernames(usernames):
+    """
+    Look up users by username in one query. Returns ``(users, missing)``:
+    the users found, in the order requested, and the usernames that matched
+    nobody.
+    """
+    usernames = clean_usernames(usernames)
+    found = get_user_model().objects.in_bulk(usernames, field_name='username') if usernames else {}
+    users = [found[username] for username in usernames if username in found]
+    missing = [username for username in usernames if username not in found]
+    return users, missing
+
+
+def add_members(chat_group, users):
+    """
+    Add users to a chat group with one lookup and one bulk insert, however
+    many there are. Returns the users that were not members yet.
+    """
+    Membership = chat_group.members.through
+    users = list({user.id: user for user in users}.values())
+    existing = set(
+        Membership.objects.filter(chatgroup=chat_group, user_id__in=[user.id for user in users])
+        .values_list('user_id', flat=True)
+    )
+    added = [user for user in users if user.id not in existing]
+    # Conflicts only come from a concurrent add of the same user
+    Membership.objects.bulk_create(
+        [Membership(chatgroup=chat_group, user=user) for user in added],
+        batch_size=500,
+        ignore_conflicts=True,
+    )
+    return added
+
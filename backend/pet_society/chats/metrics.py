@@ -0,0 +1,42 @@
+import threading
+from collections import defaultdict
+
+
+class Metrics:
+    """
+    In-process counters and gauges for the websocket side of chats, e.g.
+    send queue depth, dropped frames and evicted connections. Each process
+    keeps its own values; ``snapshot`` is what the metrics endpoint returns.
+    """
+
+    def __init__(self):
+        self._values = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._values[name] += amount
+
+    def decr(self, name, amount=1):
+        self.incr(name, -amount)
+
+    def set_max(self, name, value):
+        """Keep the highest value seen, for high watermarks"""
+        with self._lock:
+            if value > self._values[name]:
+                self._values[name] = value
+
+    def get(self, name):
+        with self._lock:
+            return self._values.get(name, 0)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(sorted(self._values.items()))
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+metrics = Metrics()
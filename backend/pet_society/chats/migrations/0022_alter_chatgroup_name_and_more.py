@@ -0,0 +1,25 @@
+# Generated by Django 5.2.4 on 2026-10-19 18:06
+
+import shortuuid.main
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0021_alter_chatgroup_name'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatgroup',
+            name='name',
+            field=models.CharField(default=shortuuid.main.ShortUUID.uuid, max_length=100, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='groupmessage',
+            index=models.Index(fields=['group', 'id'], name='chats_msg_group_id_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.4 on 2026-10-19 18:09
+
+import shortuuid.main
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0022_alter_chatgroup_name_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='groupmessage',
+            name='ciphertext',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='chatgroup',
+            name='name',
+            field=models.CharField(default=shortuuid.main.ShortUUID.uuid, max_length=100, unique=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.4 on 2026-10-19 18:10
+
+import shortuuid.main
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0023_groupmessage_ciphertext_alter_chatgroup_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='groupmessage',
+            name='key_id',
+            field=models.CharField(blank=True, db_index=True, max_length=32, null=True),
+        ),
+        migrations.AlterField(
+            model_name='chatgroup',
+            name='name',
+            field=models.CharField(default=shortuuid.main.ShortUUID.uuid, max_length=100, unique=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.4 on 2026-10-19 18:19
+
+import shortuuid.main
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0024_groupmessage_key_id_alter_chatgroup_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='groupmessage',
+            name='provisional_id',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='chatgroup',
+            name='name',
+            field=models.CharField(default=shortuuid.main.ShortUUID.uuid, max_length=100, unique=True),
+        ),
+    ]
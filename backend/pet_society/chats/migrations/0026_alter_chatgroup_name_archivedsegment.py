@@ -0,0 +1,39 @@
+# Generated by Django 5.2.4 on 2026-10-19 18:41
+
+import django.db.models.deletion
+import shortuuid.main
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0025_groupmessage_provisional_id_alter_chatgroup_name'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatgroup',
+            name='name',
+            field=models.CharField(default=shortuuid.main.ShortUUID.uuid, max_length=100, unique=True),
+        ),
+        migrations.CreateModel(
+            name='ArchivedSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_id', models.BigIntegerField()),
+                ('last_id', models.BigIntegerField()),
+                ('first_created', models.DateTimeField()),
+                ('last_created', models.DateTimeField()),
+                ('message_count', models.PositiveIntegerField()),
+                ('path', models.CharField(max_length=255, unique=True)),
+                ('size', models.PositiveIntegerField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_segments', to='chats.chatgroup')),
+            ],
+            options={
+                'ordering': ['group', 'first_id'],
+                'indexes': [models.Index(fields=['group', 'last_id'], name='chats_archive_group_last_idx')],
+            },
+        ),
+    ]
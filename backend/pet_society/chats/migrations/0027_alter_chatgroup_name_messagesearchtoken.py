@@ -0,0 +1,33 @@
+# Generated by Django 5.2.4 on 2026-10-19 18:43
+
+import django.db.models.deletion
+import shortuuid.main
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0026_alter_chatgroup_name_archivedsegment'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatgroup',
+            name='name',
+            field=models.CharField(default=shortuuid.main.ShortUUID.uuid, max_length=100, unique=True),
+        ),
+        migrations.CreateModel(
+            name='MessageSearchToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=32)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chats.chatgroup')),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_tokens', to='chats.groupmessage')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['token', 'group', 'message'], name='chats_search_token_idx')],
+                'unique_together': {('message', 'token')},
+            },
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.4 on 2026-10-19 18:45
+
+import django.db.models.deletion
+import shortuuid.main
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0027_alter_chatgroup_name_messagesearchtoken'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatImage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('file', models.ImageField(upload_to='chat_images/')),
+                ('format', models.CharField(blank=True, max_length=16)),
+                ('width', models.PositiveIntegerField()),
+                ('height', models.PositiveIntegerField()),
+                ('size', models.PositiveIntegerField()),
+                ('thumbnail', models.ImageField(blank=True, null=True, upload_to='chat_images/renditions/')),
+                ('preview', models.ImageField(blank=True, null=True, upload_to='chat_images/renditions/')),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='chatgroup',
+            name='name',
+            field=models.CharField(default=shortuuid.main.ShortUUID.uuid, max_length=100, unique=True),
+        ),
+        migrations.AddField(
+            model_name='groupmessage',
+            name='media',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='messages', to='chats.chatimage'),
+        ),
+    ]
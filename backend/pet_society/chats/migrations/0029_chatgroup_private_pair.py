@@ -0,0 +1,85 @@
+# Generated by Django 5.2.4 on 2026-10-19 18:50
+
+import django.db.models.deletion
+import shortuuid.main
+from django.conf import settings
+from django.db import migrations, models
+
+
+def merge_private_chats(apps, schema_editor):
+    """
+    Key every private chat by its two users and merge duplicate chats of the
+    same pair into the oldest one. A chat's users are its members plus the
+    authors of its messages, so a chat one of them left is keyed too. Pairs
+    with archived history are only keyed, not merged: moving archived
+    segments between groups would break the archive's ordering by id. Their
+    oldest chat gets the key, which is the one get_or_create_private finds.
+    """
+    ChatGroup = apps.get_model('chats', 'ChatGroup')
+    GroupMessage = apps.get_model('chats', 'GroupMessage')
+    MessageSearchToken = apps.get_model('chats', 'MessageSearchToken')
+    ArchivedSegment = apps.get_model('chats', 'ArchivedSegment')
+    Membership = ChatGroup.members.through
+
+    users = {}
+    memberships = Membership.objects.filter(chatgroup__is_private=True)
+    for group_id, user_id in memberships.values_list('chatgroup_id', 'user_id'):
+        users.setdefault(group_id, set()).add(user_id)
+    authors = GroupMessage.objects.filter(group__is_private=True)
+    for group_id, user_id in authors.values_list('group_id', 'author_id').distinct():
+        users.setdefault(group_id, set()).add(user_id)
+
+    pairs = {}
+    for group_id, user_ids in sorted(users.items()):
+        if len(user_ids) == 2:
+            pairs.setdefault(tuple(sorted(user_ids)), []).append(group_id)
+
+    archived = set(ArchivedSegment.objects.values_list('group_id', flat=True))
+    for (low, high), group_ids in pairs.items():
+        canonical, duplicates = group_ids[0], group_ids[1:]
+        if duplicates and not archived.intersection(group_ids):
+            GroupMessage.objects.filter(group_id__in=duplicates).update(group_id=canonical)
+            MessageSearchToken.objects.filter(group_id__in=duplicates).update(group_id=canonical)
+            # Whoever is a member of any of the duplicates stays a member
+            Membership.objects.bulk_create(
+                [
+                    Membership(chatgroup_id=canonical, user_id=user_id)
+                    for user_id in set(
+                        Membership.objects.filter(chatgroup_id__in=duplicates).values_list('user_id', flat=True)
+                    )
+                ],
+                ignore_conflicts=True,
+            )
+            ChatGroup.objects.filter(id__in=duplicates).delete()
+        ChatGroup.objects.filter(id=canonical).update(pair_user_low_id=low, pair_user_high_id=high)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0028_chatimage_alter_chatgroup_name_groupmessage_media'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatgroup',
+            name='pair_user_high',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='chatgroup',
+            name='pair_user_low',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='chatgroup',
+            name='name',
+            field=models.CharField(default=shortuuid.main.ShortUUID.uuid, max_length=100, unique=True),
+        ),
+        migrations.RunPython(merge_private_chats, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='chatgroup',
+            constraint=models.UniqueConstraint(fields=('pair_user_low', 'pair_user_high'), name='chats_unique_private_pair'),
+        ),
+    ]
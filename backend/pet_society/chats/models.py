@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth import get_user_model
 import shortuuid
 
@@ -10,10 +10,54 @@ class ChatGroup(models.Model):
     users_online = models.ManyToManyField(User, related_name='chat_groups', blank=True)
     members = models.ManyToManyField(User, related_name='chat_group_members', blank=True)
     is_private = models.BooleanField(default=False)
+    # Private chats only: their two users, lower id first, so a DM is found by one unique index lookup
+    pair_user_low = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True, related_name='+')
+    pair_user_high = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True, related_name='+')
 
     def __str__(self):
         return self.name
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['pair_user_low', 'pair_user_high'], name='chats_unique_private_pair'),
+        ]
+
+    @classmethod
+    def get_or_create_private(cls, user, other_user, **defaults):
+        """
+        The private chat between two users, created if there is none yet, with
+        both as members. Returns ``(chat_group, created, added)``, ``added``
+        being the users that were not members yet (e.g. one who had left the
+        chat). Concurrent calls for the same pair race on the unique pair
+        index, and the loser gets the winner's chat.
+        """
+        from .membership import add_members
+
+        low, high = sorted((user.id, other_user.id))
+        with transaction.atomic():
+            chat_group, created = cls.objects.get_or_create(
+                pair_user_low_id=low, pair_user_high_id=high, defaults={**defaults, 'is_private': True}
+            )
+            added = add_members(chat_group, [user, other_user])
+        return chat_group, created, added
     
+class ChatImage(models.Model):
+    """An uploaded chat image, stored once per distinct content (see chats.media)"""
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.ImageField(upload_to='chat_images/')  # Full size, served on demand
+    format = models.CharField(max_length=16, blank=True)
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    size = models.PositiveIntegerField()  # Bytes
+    thumbnail = models.ImageField(upload_to='chat_images/renditions/', blank=True, null=True)  # Inline in history
+    preview = models.ImageField(upload_to='chat_images/renditions/', blank=True, null=True)  # Opened image
+    processed_at = models.DateTimeField(blank=True, null=True)  # Renditions generated
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.width}x{self.height})"
+
+
 class GroupMessage(models.Model):
     MESSAGE_TYPES = (
         ('text', 'Text'),
@@ -22,11 +66,15 @@ class GroupMessage(models.Model):
     
     group = models.ForeignKey(ChatGroup, on_delete=models.CASCADE, related_name='messages')
     author = models.ForeignKey(User, on_delete=models.CASCADE)
-    encrypted_body = models.TextField(blank=True, null=True)  # Store encrypted content for text messages
+    encrypted_body = models.TextField(blank=True, null=True)  # Legacy base64 ciphertext, or plaintext if encryption failed
+    ciphertext = models.BinaryField(blank=True, null=True)  # Compact binary ciphertext, see chats.encryption
+    key_id = models.CharField(max_length=32, blank=True, null=True, db_index=True)  # Encryption key that wrote this row
     image = models.ImageField(upload_to='chat_images/', blank=True, null=True)  # Store images
+    media = models.ForeignKey(ChatImage, on_delete=models.PROTECT, blank=True, null=True, related_name='messages')  # Deduplicated image and its renditions
     message_type = models.CharField(max_length=10, choices=MESSAGE_TYPES, default='text')
     is_encrypted = models.BooleanField(default=True)  # Text messages are encrypted by default
     created = models.DateTimeField(auto_now_add=True)
+    provisional_id = models.CharField(max_length=64, blank=True, null=True, unique=True)  # Id broadcast before a write-behind insert
 
     def __str__(self):
         if self.message_type == 'image':
@@ -35,6 +83,53 @@ class GroupMessage(models.Model):
 
     class Meta:
         ordering = ['-created']
+        indexes = [
+            # Keyset pagination over a room's history walks (group, id)
+            models.Index(fields=['group', 'id'], name='chats_msg_group_id_idx'),
+        ]
+
+
+class MessageSearchToken(models.Model):
+    """
+    Blind index entry: a keyed hash of one normalized word of a message (see
+    chats.search), so history can be searched without decrypting every row
+    """
+    message = models.ForeignKey(GroupMessage, on_delete=models.CASCADE, related_name='search_tokens')
+    group = models.ForeignKey(ChatGroup, on_delete=models.CASCADE, related_name='+')  # Scopes searches to rooms
+    token = models.CharField(max_length=32)
+
+    class Meta:
+        unique_together = ('message', 'token')
+        indexes = [
+            # Search looks up tokens within a user's rooms, newest messages first
+            models.Index(fields=['token', 'group', 'message'], name='chats_search_token_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.token} in {self.message_id}'
+
+
+class ArchivedSegment(models.Model):
+    """A compressed file of a group's oldest messages, moved out of GroupMessage (see chats.archive)"""
+    group = models.ForeignKey(ChatGroup, on_delete=models.CASCADE, related_name='archived_segments')
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    first_created = models.DateTimeField()
+    last_created = models.DateTimeField()
+    message_count = models.PositiveIntegerField()
+    path = models.CharField(max_length=255, unique=True)  # Relative to CHAT_ARCHIVE['DIR']
+    size = models.PositiveIntegerField()  # Compressed bytes
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.message_count} messages of {self.group_id} archived in {self.path}"
+
+    class Meta:
+        ordering = ['group', 'first_id']
+        indexes = [
+            # History pagination looks up the segments below a cursor
+            models.Index(fields=['group', 'last_id'], name='chats_archive_group_last_idx'),
+        ]
 
 
 class MessageRead(models.Model):
@@ -49,3 +144,45 @@ class MessageRead(models.Model):
 
     def __str__(self):
         return f'{self.user.username} read {self.message.id} at {self.read_at}'
+
+
+class Notification(models.Model):
+    """
+    One entry of a user's notification inbox, kept so users who were offline
+    still get it (see chats.inbox). Rows are only appended, never updated.
+    """
+    NEW_CHAT = 1
+    INVITED = 2
+    MESSAGE = 3
+    KINDS = (
+        (NEW_CHAT, 'new_chat_created'),
+        (INVITED, 'user_invited'),
+        (MESSAGE, 'chat_message_notification'),
+    )
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', db_index=False)  # Leads the (user, id) index
+    kind = models.PositiveSmallIntegerField(choices=KINDS)
+    chat = models.ForeignKey(ChatGroup, on_delete=models.CASCADE, related_name='+')
+    actor = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True, related_name='+')  # Who created, invited or wrote
+    message_id = models.BigIntegerField(blank=True, null=True)  # No foreign key, the message may be archived
+    count = models.PositiveIntegerField(default=1)  # Messages coalesced into this notification
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Inbox delivery reads a user's notifications after a cursor
+            models.Index(fields=['user', 'id'], name='chats_notification_user_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.get_kind_display()} for {self.user_id} in {self.chat_id}'
+
+
+class NotificationInbox(models.Model):
+    """A user's notification read cursor, and the unread count behind the badge"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='notification_inbox')
+    read_through = models.BigIntegerField(default=0)  # Notifications up to this id have been read
+    unread_count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.unread_count} unread for {self.user_id}'
@@ -0,0 +1,189 @@
+from urllib.parse import parse_qs
+
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from .consumers import ChatRoomMixin
+from .frames import FrameProtocolMixin, with_room
+from .idle import IdleTimeoutMixin
+from .notification_consumer import NotificationEventsMixin, parse_cursor
+from .presence import get_presence_registry
+
+
+class RoomSubscription(ChatRoomMixin):
+    """
+    One room a multiplexed socket is subscribed to. Frames for the room go out
+    through the socket's send queue with a ``room`` field added.
+    """
+
+    def __init__(self, consumer, room_name, presence=None, after_id=None):
+        self.consumer = consumer
+        self.user = consumer.user
+        self.channel_layer = consumer.channel_layer
+        self.channel_name = consumer.channel_name
+        self.init_room(room_name, presence=presence, after_id=after_id)
+
+    def _replaces(self, replaces):
+        # Snapshots only supersede the previous one of the same room
+        return (replaces, self.room_name) if replaces is not None else None
+
+    async def send_payload(self, payload, droppable=False, replaces=None):
+        await self.consumer.send_payload(
+            {'room': self.room_name, **payload}, droppable, self._replaces(replaces)
+        )
+
+    async def send_frame(self, frame, droppable=False, replaces=None):
+        await self.consumer.send_frame(
+            with_room(frame, self.room_name), droppable, self._replaces(replaces)
+        )
+
+    async def room_access_revoked(self):
+        await self.consumer.unsubscribe(self.room_name, reason='removed')
+
+
+class MultiplexConsumer(NotificationEventsMixin, IdleTimeoutMixin, FrameProtocolMixin, AsyncWebsocketConsumer):
+    """
+    One socket per client for notifications and any number of rooms, instead
+    of ws/notifications/<user_id>/ plus ws/chat/<room>/ per open chat. The
+    token is checked once, and every room shares the socket's send queue.
+
+    Client frames:
+
+    - ``{"type": "subscribe", "room": ..., "after_id": ..., "presence": "delta"}``,
+      ``after_id`` and ``presence`` as the ws/chat/ query parameters;
+    - ``{"type": "unsubscribe", "room": ...}``;
+    - ``chat_message``, ``typing`` and ``presence_resync`` with a ``room``;
+    - ``heartbeat`` and ``ping``.
+
+    Room frames are those of ws/chat/ with a ``room`` field; notification
+    frames are those of ws/notifications/. A subscription is answered with
+    ``subscribed``, or ``subscribe_error`` carrying the code ws/chat/ would
+    close with (4029 once CHAT_MULTIPLEX_MAX_ROOMS rooms are subscribed), and
+    ends with ``unsubscribed``.
+    """
+
+    async def connect(self):
+        self.user = self.scope['user']
+        self.subscriptions = {}  # {room name: RoomSubscription}
+
+        # Check if user is authenticated
+        if not self.user.is_authenticated:
+            await self.close(code=4001)
+            return
+
+        # Join user's personal notification group
+        self.user_group_name = f'user_{self.user.id}'
+        await self.channel_layer.group_add(
+            self.user_group_name,
+            self.channel_name
+        )
+
+        await self.accept_negotiated()
+
+        # Notifications missed while offline, after ?notifications_after= if given
+        query_params = parse_qs(self.scope.get('query_string', b'').decode())
+        await self.send_notification_backlog(parse_cursor(query_params.get('notifications_after', [''])[0]))
+
+    def connection_groups(self):
+        return [self.user_group_name] + [
+            subscription.room_group_name for subscription in self.subscriptions.values()
+        ]
+
+    async def disconnect(self, close_code):
+        if not self.user.is_authenticated:
+            return
+        for room_name in list(self.subscriptions):
+            await self.unsubscribe(room_name, reason=None)
+        await self.channel_layer.group_discard(
+            self.user_group_name,
+            self.channel_name
+        )
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = self.decode_frame(text_data, bytes_data)
+        except ValueError:  # Malformed JSON or binary frame
+            await self.send_payload({
+                'error': 'Invalid frame'
+            })
+            return
+
+        try:
+            message_type = data.get('type')
+            room_name = data.get('room')
+            get_presence_registry().heartbeat(self.channel_name)
+
+            if message_type == 'heartbeat':
+                await self.send_payload({'type': 'heartbeat_ack'}, droppable=True)
+            elif message_type == 'ping':
+                await self.send_payload({'type': 'pong', 'timestamp': data.get('timestamp')})
+            elif message_type == 'subscribe':
+                await self.subscribe(room_name, data.get('presence'), data.get('after_id'))
+            elif message_type == 'unsubscribe':
+                await self.unsubscribe(room_name)
+            elif message_type in ('chat_message', 'typing', 'presence_resync'):
+                subscription = self.subscriptions.get(room_name)
+                if subscription is None:
+                    await self.send_payload({'room': room_name, 'error': 'Not subscribed to this room'})
+                elif message_type == 'chat_message':
+                    await subscription.post_message(data['message'])
+                elif message_type == 'typing':
+                    await subscription.update_typing(bool(data.get('is_typing', False)))
+                else:
+                    # Client saw a gap in presence_delta sequence numbers
+                    await subscription.send_presence_snapshot()
+        except Exception as e:
+            await self.send_payload({
+                'error': f'Error processing message: {str(e)}'
+            })
+
+    async def subscribe(self, room_name, presence=None, after_id=None):
+        if not isinstance(room_name, str) or room_name in self.subscriptions:
+            return
+        if len(self.subscriptions) >= getattr(settings, 'CHAT_MULTIPLEX_MAX_ROOMS', 50):
+            await self.send_payload({'type': 'subscribe_error', 'room': room_name, 'code': 4029})
+            return
+
+        subscription = RoomSubscription(self, room_name, presence=presence, after_id=after_id)
+        close_code = await subscription.check_membership()
+        if close_code is not None:
+            await self.send_payload({'type': 'subscribe_error', 'room': room_name, 'code': close_code})
+            return
+
+        self.subscriptions[room_name] = subscription
+        await subscription.send_payload({'type': 'subscribed'})
+        await subscription.enter_room()
+
+    async def unsubscribe(self, room_name, reason='unsubscribed'):
+        subscription = self.subscriptions.pop(room_name, None)
+        if subscription is None:
+            return
+        await subscription.leave_room()
+        if reason is not None:
+            await subscription.send_payload({'type': 'unsubscribed', 'reason': reason})
+
+    # Room channel events, routed by the room they carry
+
+    async def chat_message(self, event):
+        subscription = self.subscriptions.get(event.get('room'))
+        if subscription is not None:
+            await subscription.chat_message(event)
+
+    async def message_persisted(self, event):
+        subscription = self.subscriptions.get(event.get('room'))
+        if subscription is not None:
+            await subscription.message_persisted(event)
+
+    async def typing_indicator(self, event):
+        subscription = self.subscriptions.get(event.get('room'))
+        if subscription is not None:
+            await subscription.typing_indicator(event)
+
+    async def presence_delta(self, event):
+        subscription = self.subscriptions.get(event.get('room'))
+        if subscription is not None:
+            await subscription.presence_delta(event)
+
+    async def membership_changed(self, event):
+        subscription = self.subscriptions.get(event.get('room'))
+        if subscription is not None:
+            await subscription.membership_changed(event)
@@ -1,15 +1,87 @@
-import json
+from urllib.parse import parse_qs
+
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth import get_user_model
 from .models import ChatGroup
+from .fanout import get_notification_fanout
+from .frames import FrameProtocolMixin
+from .idle import IdleTimeoutMixin
+from .inbox import pending_notifications, unread_count
 
 User = get_user_model()
 
-class NotificationConsumer(AsyncWebsocketConsumer):
+class NotificationEventsMixin:
+    """Forwards a user's notification events (``user_{id}`` group) to the socket"""
+
+    # Handle new chat creation notification
+    async def new_chat_created(self, event):
+        await self.send_payload({
+            'type': 'new_chat_created',
+            'notification_id': event.get('notification_id'),
+            'chat_id': event['chat_id'],
+            'chat_name': event['chat_name'],
+            'is_private': event['is_private'],
+            'created_by': event['created_by'],
+            'members': event['members']
+        })
+
+    # Handle user invitation notification
+    async def user_invited(self, event):
+        await self.send_payload({
+            'type': 'user_invited',
+            'notification_id': event.get('notification_id'),
+            'chat_id': event['chat_id'],
+            'chat_name': event['chat_name'],
+            'is_private': event['is_private'],
+            'invited_by': event['invited_by']
+        })
+
+    # Handle new message notification (for chats user is not currently viewing)
+    async def chat_message_notification(self, event):
+        await self.send_payload({
+            'type': 'chat_message_notification',
+            'notification_id': event.get('notification_id'),
+            'chat_id': event['chat_id'],
+            'chat_name': event['chat_name'],
+            'is_private': event['is_private'],
+            'message': event['message'],
+            'message_id': event.get('message_id'),
+            'count': event.get('count', 1),
+            'author': event['author'],
+            'timestamp': event['timestamp']
+        })
+
+    async def send_notification_backlog(self, after_id=None):
+        """
+        Replay stored notifications after the client's cursor, or after the
+        user's read cursor when it has none, then a ``notifications_synced``
+        frame with the new cursor. Call after joining the ``user_{id}`` group
+        so nothing falls between backlog and live events; clients drop frames
+        whose ``notification_id`` they have already seen.
+        """
+        payloads, has_more = await database_sync_to_async(pending_notifications)(self.user.id, after_id)
+        for payload in payloads:
+            await self.send_payload(dict(payload, backlog=True))
+        await self.send_payload({
+            'type': 'notifications_synced',
+            'after_id': payloads[-1]['notification_id'] if payloads else after_id,
+            'has_more': has_more,  # Fetch the rest from /api/chats/notifications/?after_id=
+            'unread_count': await database_sync_to_async(unread_count)(self.user.id),
+        })
+
+
+def parse_cursor(value):
+    """A notification cursor from a query string value, None if missing or invalid"""
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+
+class NotificationConsumer(NotificationEventsMixin, IdleTimeoutMixin, FrameProtocolMixin, AsyncWebsocketConsumer):
     async def connect(self):
         self.user_id = self.scope['url_route']['kwargs']['user_id']
-        self.user_group_name = f'user_{self.user_id}'
         self.user = self.scope['user']
 
         # Check if user is authenticated
@@ -17,16 +89,32 @@ class NotificationConsumer(AsyncWebsocketConsumer):
             await self.close(code=4001)
             return
 
+        # Only a user's own notifications, whatever id the URL names
+        if self.user_id != str(self.user.id):
+            await self.close(code=4003)
+            return
+        self.user_group_name = f'user_{self.user.id}'
+
         # Join user's personal notification group
         await self.channel_layer.group_add(
             self.user_group_name,
             self.channel_name
         )
 
-        await self.accept()
+        await self.accept_negotiated()
         print(f"User {self.user.username} connected to notifications")
 
+        # Deliver what was missed while offline, after ?after_id= if given
+        query_params = parse_qs(self.scope.get('query_string', b'').decode())
+        await self.send_notification_backlog(parse_cursor(query_params.get('after_id', [''])[0]))
+
+    def connection_groups(self):
+        return [self.user_group_name]
+
     async def disconnect(self, close_code):
+        if not hasattr(self, 'user_group_name'):
+            return  # Rejected before joining
+
         # Leave user's personal notification group
         await self.channel_layer.group_discard(
             self.user_group_name,
@@ -34,53 +122,20 @@ class NotificationConsumer(AsyncWebsocketConsumer):
         )
         print(f"User {self.user.username} disconnected from notifications")
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         # Handle any incoming messages if needed
         try:
-            data = json.loads(text_data)
+            data = self.decode_frame(text_data, bytes_data)
             message_type = data.get('type')
             
             if message_type == 'ping':
-                await self.send(text_data=json.dumps({
+                await self.send_payload({
                     'type': 'pong',
                     'timestamp': data.get('timestamp')
-                }))
-        except json.JSONDecodeError:
+                })
+        except ValueError:  # Malformed JSON or binary frame
             pass
 
-    # Handle new chat creation notification
-    async def new_chat_created(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'new_chat_created',
-            'chat_id': event['chat_id'],
-            'chat_name': event['chat_name'],
-            'is_private': event['is_private'],
-            'created_by': event['created_by'],
-            'members': event['members']
-        }))
-
-    # Handle user invitation notification
-    async def user_invited(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'user_invited',
-            'chat_id': event['chat_id'],
-            'chat_name': event['chat_name'],
-            'is_private': event['is_private'],
-            'invited_by': event['invited_by']
-        }))
-
-    # Handle new message notification (for chats user is not currently viewing)
-    async def chat_message_notification(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message_notification',
-            'chat_id': event['chat_id'],
-            'chat_name': event['chat_name'],
-            'is_private': event['is_private'],
-            'message': event['message'],
-            'author': event['author'],
-            'timestamp': event['timestamp']
-        }))
-
 
 # Utility functions to send notifications
 @database_sync_to_async
@@ -107,27 +162,33 @@ def get_user_info(user_id):
 async def notify_new_chat_created(channel_layer, chat_id, chat_name, is_private, created_by_id, member_ids):
     """Notify all members about a new chat being created"""
     created_by = await get_user_info(created_by_id)
-    
-    for member_id in member_ids:
-        if member_id != created_by_id:  # Don't notify the creator
-            await channel_layer.group_send(
-                f'user_{member_id}',
-                {
-                    'type': 'new_chat_created',
-                    'chat_id': chat_id,
-                    'chat_name': chat_name,
-                    'is_private': is_private,
-                    'created_by': created_by,
-                    'members': member_ids
-                }
-            )
+
+    # Don't notify the creator
+    recipients = [member_id for member_id in member_ids if member_id != created_by_id]
+    await get_notification_fanout().send_to_users(
+        channel_layer,
+        recipients,
+        {
+            'type': 'new_chat_created',
+            'chat_id': chat_id,
+            'chat_name': chat_name,
+            'is_private': is_private,
+            'created_by': created_by,
+            'members': member_ids
+        }
+    )
 
 async def notify_user_invited(channel_layer, chat_id, chat_name, is_private, invited_by_id, invited_user_id):
     """Notify a user when they're invited to a chat"""
+    await notify_users_invited(channel_layer, chat_id, chat_name, is_private, invited_by_id, [invited_user_id])
+
+async def notify_users_invited(channel_layer, chat_id, chat_name, is_private, invited_by_id, invited_user_ids):
+    """Notify every user invited to a chat at once"""
     invited_by = await get_user_info(invited_by_id)
-    
-    await channel_layer.group_send(
-        f'user_{invited_user_id}',
+
+    await get_notification_fanout().send_to_users(
+        channel_layer,
+        invited_user_ids,
         {
             'type': 'user_invited',
             'chat_id': chat_id,
@@ -0,0 +1,203 @@
+import asyncio
+import functools
+from collections import deque
+
+from django.conf import settings
+
+from .metrics import metrics
+
+# Close code telling the client it fell too far behind and must reconnect and
+# resync (e.g. fetch missed messages with ?after_id=)
+CLOSE_RESYNC = 4008
+
+# How often a writer held back by a full transport buffer checks it again
+TRANSPORT_POLL_INTERVAL = 0.05
+
+
+def transport_backlog(consumer):
+    """
+    Bytes handed to the ASGI server's transport for a consumer's socket but
+    not yet written to the client, or None when the server does not expose
+    them. Daphne queues every frame in Twisted without ever blocking ``send``,
+    so this is where a slow client's backlog actually builds up.
+    """
+    send = getattr(consumer, 'base_send', None)
+    # Daphne's send is partial(server.handle_reply, protocol)
+    protocol = send.args[0] if isinstance(send, functools.partial) and send.args else None
+    transport = getattr(protocol, 'transport', None)
+    if transport is None:
+        return None
+    if hasattr(transport, 'get_write_buffer_size'):  # asyncio transports
+        return transport.get_write_buffer_size()
+    if hasattr(transport, 'dataBuffer'):  # Twisted TCP transports
+        return len(transport.dataBuffer) - transport.offset + getattr(transport, '_tempDataLen', 0)
+    return None
+
+
+class OutboundQueue:
+    """
+    Bounded queue of frames waiting to be sent on one websocket.
+
+    Handlers enqueue and return at once, so a slow client no longer holds up
+    the consumer reading its channel. A writer task sends the frames in order,
+    pausing while more than ``max_transport_buffer`` bytes sit unsent in the
+    server's transport (see ``transport_backlog``), so a slow client's frames
+    back up here, where they are bounded. When ``max_depth`` frames or
+    ``max_bytes`` bytes are waiting:
+
+    - the oldest droppable frame (typing and presence) is dropped to make room;
+    - a new droppable frame is dropped if only essential frames are waiting;
+    - otherwise the client is evicted with close code ``CLOSE_RESYNC``.
+
+    Frames sent with a ``replaces`` key (snapshots such as ``user_list_update``)
+    also supersede a queued, unsent frame with the same key.
+
+    ``drain`` sends the essential frames still waiting before the socket is
+    closed; ``stop`` discards everything, for clients that are already gone
+    or too far behind.
+    """
+
+    def __init__(self, consumer, max_depth=256, max_bytes=1024 * 1024, max_transport_buffer=256 * 1024):
+        self.consumer = consumer
+        self.max_depth = max_depth
+        self.max_bytes = max_bytes
+        self.max_transport_buffer = max_transport_buffer
+        self.depth = 0
+        self.bytes = 0
+        self.closed = False
+        self._entries = deque()  # [data, droppable, replaces]; data None once dropped
+        self._latest = {}  # {replaces key: entry}
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def put(self, data, droppable=False, replaces=None):
+        if self.closed:
+            return
+        if replaces is not None and replaces in self._latest:
+            self._remove(self._latest.pop(replaces), 'send_queue.coalesced')
+        size = len(data)
+        if self._full(size) and not self._make_room(size):
+            if droppable:
+                metrics.incr('send_queue.dropped')
+                return
+            await self.evict()
+            return
+
+        entry = [data, droppable, replaces]
+        self._entries.append(entry)
+        if replaces is not None:
+            self._latest[replaces] = entry
+        self.depth += 1
+        self.bytes += size
+        metrics.incr('send_queue.depth')
+        metrics.set_max('send_queue.max_depth', self.depth)
+        self._wakeup.set()
+
+    def _full(self, size):
+        # A frame always fits an empty queue, however large
+        return self.depth >= self.max_depth or (self.bytes > 0 and self.bytes + size > self.max_bytes)
+
+    def _make_room(self, size):
+        """Drop the oldest droppable frames until a frame of ``size`` bytes fits"""
+        for entry in self._entries:
+            if not self._full(size):
+                break
+            if entry[0] is not None and entry[1]:
+                if entry[2] is not None and self._latest.get(entry[2]) is entry:
+                    del self._latest[entry[2]]
+                self._remove(entry, 'send_queue.dropped')
+        return not self._full(size)
+
+    def _remove(self, entry, counter):
+        self.bytes -= len(entry[0])
+        entry[0] = None
+        self.depth -= 1
+        metrics.decr('send_queue.depth')
+        metrics.incr(counter)
+
+    async def evict(self):
+        metrics.incr('send_queue.evicted')
+        self.stop()
+        await self.consumer.close(code=CLOSE_RESYNC)
+
+    async def drain(self, timeout=1.0):
+        """
+        Take no new frames, drop the droppable ones waiting and give the
+        writer up to ``timeout`` seconds to send the rest, then stop
+        """
+        if self.closed:
+            return
+        self.closed = True
+        for entry in self._entries:
+            if entry[0] is not None and entry[1]:
+                self._remove(entry, 'send_queue.dropped')
+        self._latest.clear()
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._discard()
+
+    def stop(self):
+        """Discard waiting frames and stop the writer"""
+        if self.closed:
+            return
+        self.closed = True
+        self._discard()
+
+    def _discard(self):
+        metrics.decr('send_queue.depth', self.depth)
+        self.depth = 0
+        self.bytes = 0
+        self._entries.clear()
+        self._latest.clear()
+        self._task.cancel()
+
+    async def _run(self):
+        while True:
+            while not self._entries:
+                if self.closed:
+                    return  # Drained
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            await self._wait_for_transport()
+            data, _, replaces = entry = self._entries.popleft()
+            if data is None:
+                continue
+            if replaces is not None and self._latest.get(replaces) is entry:
+                del self._latest[replaces]
+            self.depth -= 1
+            self.bytes -= len(data)
+            metrics.decr('send_queue.depth')
+            try:
+                if isinstance(data, bytes):
+                    await self.consumer.send(bytes_data=data)
+                else:
+                    await self.consumer.send(text_data=data)
+            except Exception as e:
+                print(f"Error sending websocket frame: {e}")
+
+
+    async def _wait_for_transport(self):
+        backlog = transport_backlog(self.consumer)
+        if backlog is None or backlog <= self.max_transport_buffer:
+            return
+        metrics.incr('send_queue.transport_waits')
+        while backlog is not None and backlog > self.max_transport_buffer:
+            await asyncio.sleep(TRANSPORT_POLL_INTERVAL)
+            backlog = transport_backlog(self.consumer)
+
+
+def send_queue_options():
+    """OutboundQueue limits configured by CHAT_SEND_QUEUE"""
+    config = getattr(settings, 'CHAT_SEND_QUEUE', {})
+    return {
+        'max_depth': config.get('MAX_DEPTH', 256),
+        'max_bytes': config.get('MAX_BYTES', 1024 * 1024),
+        'max_transport_buffer': config.get('MAX_TRANSPORT_BUFFER', 256 * 1024),
+    }
+
+
+def send_queue_drain_timeout():
+    return getattr(settings, 'CHAT_SEND_QUEUE', {}).get('DRAIN_TIMEOUT', 1.0)
@@ -0,0 +1,310 @@
+import asyncio
+import atexit
+import base64
+import glob
+import json
+import os
+import secrets
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .frames import encode_frame
+from .groups import room_group_name
+from .search import index_tokens
+
+
+@dataclass
+class PendingMessage:
+    """Stands in for a GroupMessage until the write-behind writer stores it"""
+    id: str
+    created: datetime
+
+
+class WriteBehindWriter:
+    """
+    Write-behind persistence for chat messages.
+
+    ``submit`` appends the (already encrypted) message to a local log segment
+    and returns a provisional id straight away, so the message can be
+    broadcast without waiting for the database. A background task bulk-inserts
+    the buffered rows every ``flush_interval`` seconds or ``batch_size``
+    messages, deletes the segment, then tells each room which real ids the
+    provisional ids got (``message_persisted`` events).
+
+    Segments are named after the process id. Segments left behind by a process
+    that died are replayed on start-up; rows are matched on
+    ``GroupMessage.provisional_id`` so a replay never inserts twice. On
+    interpreter exit the buffer is flushed synchronously.
+    """
+
+    def __init__(self, log_dir, batch_size=200, flush_interval=0.05, fsync=False):
+        self.log_dir = str(log_dir)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.prefix = secrets.token_hex(4)
+        self._counter = 0
+        self._segment = 0
+        self._file = None
+        self._path = None
+        self._buffer = []
+        self._retry = []  # [(segment path, records)] whose insert failed
+        self._lock = threading.Lock()
+        self._task = None
+        self._wakeup = None
+        self._recovered = False
+        atexit.register(self.flush_sync)
+
+    # Log segments
+
+    def _open_segment(self):
+        os.makedirs(self.log_dir, exist_ok=True)
+        self._segment += 1
+        self._path = os.path.join(self.log_dir, f'chat-wal-{os.getpid()}-{self.prefix}-{self._segment}.log')
+        self._file = open(self._path, 'a', encoding='utf-8')
+
+    def _rotate(self):
+        """Close the active segment and hand back its path and records"""
+        with self._lock:
+            path, records = self._path, self._buffer
+            if self._file:
+                self._file.close()
+            self._file, self._path, self._buffer = None, None, []
+        return path, records
+
+    # Producing
+
+    def submit(self, room_name, group_id, author_id, storage_fields, search_tokens=()):
+        """
+        Log a message for insertion and return a PendingMessage for
+        broadcasting. ``search_tokens`` are stored with the row (see
+        chats.search), the plaintext never reaches the log.
+        """
+        created = timezone.now()
+        with self._lock:
+            self._counter += 1
+            provisional_id = f'p-{self.prefix}-{self._counter}'
+            ciphertext = storage_fields.get('ciphertext')
+            record = {
+                'provisional_id': provisional_id,
+                'room_name': room_name,
+                'group_id': group_id,
+                'author_id': author_id,
+                'ciphertext': base64.b64encode(ciphertext).decode() if ciphertext else None,
+                'encrypted_body': storage_fields.get('encrypted_body'),
+                'is_encrypted': storage_fields.get('is_encrypted', False),
+                'key_id': storage_fields.get('key_id'),
+                'created': created.isoformat(),
+                'search_tokens': list(search_tokens),
+            }
+            if self._file is None:
+                self._open_segment()
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._buffer.append(record)
+            buffered = len(self._buffer)
+
+        self._ensure_task()
+        if buffered >= self.batch_size:
+            self._wakeup.set()
+        return PendingMessage(id=provisional_id, created=created)
+
+    # Flushing
+
+    def _ensure_task(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            if not self._recovered:
+                try:
+                    await database_sync_to_async(self.recover)()
+                except Exception as e:
+                    # Retried on the next round; new messages still flush meanwhile
+                    print(f"Write-behind recovery error: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Write-behind flush error: {e}")
+
+    async def flush(self):
+        """Insert everything buffered so far and reconcile ids with the rooms"""
+        path, records = self._rotate()
+        batches = self._retry + ([(path, records)] if records else [])
+        self._retry = []
+        for index, (segment_path, segment_records) in enumerate(batches):
+            try:
+                persisted = await database_sync_to_async(insert_records)(segment_records)
+            except Exception:
+                self._retry.extend(batches[index:])
+                raise
+            remove_segment(segment_path)
+            await self.reconcile(segment_records, persisted)
+
+    async def reconcile(self, records, persisted):
+        from channels.layers import get_channel_layer
+
+        channel_layer = get_channel_layer()
+        by_room = {}
+        for record in records:
+            message = persisted.get(record['provisional_id'])
+            if message:
+                by_room.setdefault(record['room_name'], []).append({
+                    'provisional_id': record['provisional_id'],
+                    'message_id': message[0],
+                    'timestamp': message[1],
+                })
+        for room_name, messages in by_room.items():
+            await channel_layer.group_send(room_group_name(room_name), {
+                'type': 'message_persisted',
+                'room': room_name,
+                'frame': encode_frame({'type': 'message_persisted', 'messages': messages}),
+            })
+
+    def flush_sync(self):
+        """Flush from synchronous code, e.g. at interpreter shutdown"""
+        path, records = self._rotate()
+        for segment_path, segment_records in self._retry + ([(path, records)] if records else []):
+            try:
+                insert_records(segment_records)
+                remove_segment(segment_path)
+            except Exception as e:
+                # The segment stays on disk and is replayed on the next start
+                print(f"Write-behind shutdown flush error: {e}")
+        self._retry = []
+
+    def recover(self):
+        """
+        Replay segments left behind by processes that are no longer running.
+        Safe to run again after a failure, or in several processes at once:
+        rows already stored are skipped.
+        """
+        for path in sorted(glob.glob(os.path.join(self.log_dir, 'chat-wal-*.log'))):
+            pid = int(os.path.basename(path).split('-')[2])
+            if pid != os.getpid() and _process_alive(pid):
+                continue
+            if path == self._path:
+                continue
+            try:
+                with open(path, encoding='utf-8') as segment:
+                    # A torn last line from a crash mid-write is skipped
+                    records = []
+                    for line in segment:
+                        try:
+                            records.append(json.loads(line))
+                        except ValueError:
+                            pass
+            except FileNotFoundError:
+                continue  # Replayed by another process in the meantime
+            insert_records(records)
+            remove_segment(path)
+        self._recovered = True
+
+
+def insert_records(records):
+    """
+    Bulk-insert logged messages, skipping any that are already stored.
+    Returns ``{provisional_id: (message id, created iso)}``.
+    """
+    from .models import GroupMessage
+
+    provisional_ids = [record['provisional_id'] for record in records]
+    persisted = {
+        provisional_id: (message_id, created.isoformat())
+        for provisional_id, message_id, created in GroupMessage.objects.filter(
+            provisional_id__in=provisional_ids
+        ).values_list('provisional_id', 'id', 'created')
+    }
+    new_messages = {}
+    for record in records:
+        if record['provisional_id'] in persisted or record['provisional_id'] in new_messages:
+            continue
+        new_messages[record['provisional_id']] = GroupMessage(
+            provisional_id=record['provisional_id'],
+            group_id=record['group_id'],
+            author_id=record['author_id'],
+            ciphertext=base64.b64decode(record['ciphertext']) if record['ciphertext'] else None,
+            encrypted_body=record['encrypted_body'],
+            is_encrypted=record['is_encrypted'],
+            key_id=record['key_id'],
+        )
+    new_messages = list(new_messages.values())
+    if new_messages:
+        tokens = {record['provisional_id']: record.get('search_tokens', ()) for record in records}
+        created = {record['provisional_id']: datetime.fromisoformat(record['created']) for record in records}
+        with transaction.atomic():
+            # Another process replaying the same segment may insert rows
+            # concurrently; those are skipped and picked up below
+            GroupMessage.objects.bulk_create(new_messages, ignore_conflicts=True)
+            new_messages = list(GroupMessage.objects.filter(
+                provisional_id__in=[message.provisional_id for message in new_messages]
+            ))
+            # created is auto_now_add; keep the send time already broadcast
+            # to clients rather than the (possibly much later) insert time
+            for message in new_messages:
+                message.created = created[message.provisional_id]
+            GroupMessage.objects.bulk_update(new_messages, ['created'], batch_size=500)
+            index_tokens([
+                (message.id, message.group_id, tokens[message.provisional_id]) for message in new_messages
+            ])
+        for message in new_messages:
+            persisted[message.provisional_id] = (message.id, message.created.isoformat())
+    return persisted
+
+
+def remove_segment(path):
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def write_behind_enabled():
+    return getattr(settings, 'CHAT_PERSISTENCE', {}).get('MODE', 'sync') == 'write_behind'
+
+
+def get_write_behind_writer():
+    """Return the process-wide write-behind writer configured by CHAT_PERSISTENCE"""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                config = getattr(settings, 'CHAT_PERSISTENCE', {})
+                _writer = WriteBehindWriter(
+                    config.get('LOG_DIR', os.path.join(settings.BASE_DIR, 'chat_wal')),
+                    batch_size=config.get('BATCH_SIZE', 200),
+                    flush_interval=config.get('FLUSH_INTERVAL', 0.05),
+                    fsync=config.get('FSYNC', False),
+                )
+    return _writer
@@ -0,0 +1,547 @@
+import asyncio
+import sqlite3
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .frames import encode_frame
+from .groups import room_group_name
+
+
+class MemoryPresenceStore:
+    """
+    Presence for a single process: who is connected to which room, through
+    which connection, and until when the entry is valid.
+    """
+
+    def __init__(self, ttl=90):
+        self.ttl = ttl
+        # {room: {connection: (user_id, username, expires)}}
+        self._rooms = {}
+        self._seq = {}
+        self._lock = threading.Lock()
+
+    def join(self, room, user_id, username, connection):
+        with self._lock:
+            connections = self._rooms.setdefault(room, {})
+            first = all(entry[0] != user_id for entry in connections.values())
+            connections[connection] = (user_id, username, time.time() + self.ttl)
+        return first
+
+    def leave(self, room, connection):
+        """Remove a connection; returns the user id if that was their last one in the room"""
+        with self._lock:
+            connections = self._rooms.get(room, {})
+            entry = connections.pop(connection, None)
+            if not connections:
+                self._rooms.pop(room, None)
+            if entry and all(other[0] != entry[0] for other in connections.values()):
+                return entry[0]
+        return None
+
+    def leave_connections(self, connections):
+        """Remove many connections from every room; returns the (room, user_id) pairs that went offline"""
+        connections = set(connections)
+        offline = []
+        with self._lock:
+            for room, room_connections in list(self._rooms.items()):
+                left = {room_connections.pop(c)[0] for c in connections & room_connections.keys()}
+                remaining = {entry[0] for entry in room_connections.values()}
+                offline.extend((room, user_id) for user_id in left - remaining)
+                if not room_connections:
+                    del self._rooms[room]
+        return offline
+
+    def remove_user(self, room, user_id):
+        with self._lock:
+            connections = self._rooms.get(room, {})
+            for connection, entry in list(connections.items()):
+                if entry[0] == user_id:
+                    del connections[connection]
+            if not connections:
+                self._rooms.pop(room, None)
+
+    def touch(self, connections):
+        expires = time.time() + self.ttl
+        connections = set(connections)
+        with self._lock:
+            for room_connections in self._rooms.values():
+                for connection, entry in room_connections.items():
+                    if connection in connections:
+                        room_connections[connection] = (entry[0], entry[1], expires)
+
+    def purge_expired(self):
+        """Drop entries whose heartbeat lapsed; returns the (room, user_id) pairs that went offline"""
+        now = time.time()
+        offline = []
+        with self._lock:
+            for room, connections in list(self._rooms.items()):
+                expired = {c: e for c, e in connections.items() if e[2] < now}
+                for connection in expired:
+                    del connections[connection]
+                remaining = {entry[0] for entry in connections.values()}
+                offline.extend((room, user_id) for user_id in {e[0] for e in expired.values()} - remaining)
+                if not connections:
+                    del self._rooms[room]
+        return offline
+
+    def online_users(self, room):
+        now = time.time()
+        with self._lock:
+            users = {
+                entry[0]: entry[1]
+                for entry in self._rooms.get(room, {}).values()
+                if entry[2] >= now
+            }
+        return [{'id': user_id, 'username': username} for user_id, username in sorted(users.items())]
+
+    def online_counts(self, rooms):
+        return {room: len(self.online_users(room)) for room in rooms}
+
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            return {
+                room: {entry[0] for entry in connections.values() if entry[2] >= now}
+                for room, connections in self._rooms.items()
+            }
+
+    def next_seq(self, room):
+        with self._lock:
+            self._seq[room] = self._seq.get(room, 0) + 1
+            return self._seq[room]
+
+    def current_seq(self, room):
+        return self._seq.get(room, 0)
+
+
+class SQLitePresenceStore:
+    """
+    Presence shared by every process on the machine through a SQLite WAL
+    database, so daphne workers and the REST API see the same online users.
+    Entries from a process that died expire after ``ttl`` seconds.
+    """
+
+    def __init__(self, path='presence.sqlite3', ttl=90):
+        self.path = str(path)
+        self.ttl = ttl
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS presence (
+                    room TEXT NOT NULL,
+                    connection TEXT NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    username TEXT NOT NULL,
+                    expires REAL NOT NULL,
+                    PRIMARY KEY (room, connection)
+                );
+                CREATE INDEX IF NOT EXISTS presence_connection ON presence (connection);
+                CREATE TABLE IF NOT EXISTS presence_seq (
+                    room TEXT PRIMARY KEY,
+                    seq INTEGER NOT NULL
+                );
+                """
+            )
+            self._local.connection = connection
+        return connection
+
+    def join(self, room, user_id, username, connection):
+        db = self._connection()
+        now = time.time()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            first = db.execute(
+                'SELECT 1 FROM presence WHERE room = ? AND user_id = ? AND expires >= ? LIMIT 1',
+                (room, user_id, now),
+            ).fetchone() is None
+            db.execute(
+                'INSERT OR REPLACE INTO presence (room, connection, user_id, username, expires) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (room, connection, user_id, username, now + self.ttl),
+            )
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return first
+
+    def leave(self, room, connection):
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute(
+                'SELECT user_id FROM presence WHERE room = ? AND connection = ?', (room, connection)
+            ).fetchone()
+            last = False
+            if row:
+                db.execute('DELETE FROM presence WHERE room = ? AND connection = ?', (room, connection))
+                last = db.execute(
+                    'SELECT 1 FROM presence WHERE room = ? AND user_id = ? AND expires >= ? LIMIT 1',
+                    (room, row[0], time.time()),
+                ).fetchone() is None
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return row[0] if row and last else None
+
+    def leave_connections(self, connections):
+        connections = list(connections)
+        if not connections:
+            return []
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('CREATE TEMP TABLE IF NOT EXISTS leaving (connection TEXT PRIMARY KEY)')
+            db.execute('DELETE FROM leaving')
+            db.executemany('INSERT OR IGNORE INTO leaving VALUES (?)', [(c,) for c in connections])
+            left = db.execute(
+                'SELECT DISTINCT room, user_id FROM presence WHERE connection IN (SELECT connection FROM leaving)'
+            ).fetchall()
+            db.execute('DELETE FROM presence WHERE connection IN (SELECT connection FROM leaving)')
+            still_online = set(db.execute(
+                'SELECT DISTINCT room, user_id FROM presence WHERE expires >= ?', (time.time(),)
+            ).fetchall())
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return [entry for entry in left if entry not in still_online]
+
+    def remove_user(self, room, user_id):
+        self._connection().execute('DELETE FROM presence WHERE room = ? AND user_id = ?', (room, user_id))
+
+    def touch(self, connections):
+        connections = list(connections)
+        if not connections:
+            return
+        expires = time.time() + self.ttl
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.executemany(
+                'UPDATE presence SET expires = ? WHERE connection = ?',
+                [(expires, connection) for connection in connections],
+            )
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    def purge_expired(self):
+        db = self._connection()
+        now = time.time()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            expired = db.execute(
+                'SELECT DISTINCT room, user_id FROM presence WHERE expires < ?', (now,)
+            ).fetchall()
+            db.execute('DELETE FROM presence WHERE expires < ?', (now,))
+            still_online = set(db.execute('SELECT DISTINCT room, user_id FROM presence').fetchall())
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return [entry for entry in expired if entry not in still_online]
+
+    def online_users(self, room):
+        rows = self._connection().execute(
+            'SELECT DISTINCT user_id, username FROM presence WHERE room = ? AND expires >= ? ORDER BY user_id',
+            (room, time.time()),
+        ).fetchall()
+        return [{'id': user_id, 'username': username} for user_id, username in rows]
+
+    def online_counts(self, rooms):
+        rooms = list(rooms)
+        if not rooms:
+            return {}
+        placeholders = ','.join('?' * len(rooms))
+        counts = dict(self._connection().execute(
+            f'SELECT room, COUNT(DISTINCT user_id) FROM presence '
+            f'WHERE room IN ({placeholders}) AND expires >= ? GROUP BY room',
+            (*rooms, time.time()),
+        ).fetchall())
+        return {room: counts.get(room, 0) for room in rooms}
+
+    def snapshot(self):
+        snapshot = {}
+        for room, user_id in self._connection().execute(
+            'SELECT DISTINCT room, user_id FROM presence WHERE expires >= ?', (time.time(),)
+        ):
+            snapshot.setdefault(room, set()).add(user_id)
+        return snapshot
+
+    def next_seq(self, room):
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute(
+                'INSERT INTO presence_seq (room, seq) VALUES (?, 1) '
+                'ON CONFLICT (room) DO UPDATE SET seq = seq + 1',
+                (room,),
+            )
+            seq = db.execute('SELECT seq FROM presence_seq WHERE room = ?', (room,)).fetchone()[0]
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return seq
+
+    def current_seq(self, room):
+        row = self._connection().execute('SELECT seq FROM presence_seq WHERE room = ?', (room,)).fetchone()
+        return row[0] if row else 0
+
+
+class PresenceRegistry:
+    """
+    Tracks (user, room, connection) presence for chat rooms.
+
+    Connections held by this process are refreshed on a timer while their
+    client keeps sending frames (any frame counts as a heartbeat), so their
+    entries only lapse if the process dies or a client goes silent.
+    The same timer purges expired entries and flushes a snapshot into
+    ``ChatGroup.users_online`` for the admin and anything reading the table.
+
+    Joins and leaves are announced to the room as ``presence_delta`` events
+    carrying a per-room sequence number. Changes within ``debounce`` seconds
+    are merged, so a user who drops and reconnects produces no event at all.
+    """
+
+    def __init__(self, store, heartbeat_interval=30, flush_interval=30, debounce=0.5):
+        self.store = store
+        self.heartbeat_interval = heartbeat_interval
+        self.flush_interval = flush_interval
+        self.debounce = debounce
+        self.local_connections = {}  # {connection: last client activity}
+        self._connection_rooms = {}  # {connection: {room}}, one socket may be in many rooms
+        self._task = None
+        self._last_flush = 0
+        # {room: {'joined': {user_id: username}, 'left': {user_id}}}
+        self._pending = {}
+        self._pending_handles = {}
+
+    # Connection lifecycle, called from consumers
+
+    async def join(self, room, user, connection):
+        self.local_connections[connection] = time.monotonic()
+        self._connection_rooms.setdefault(connection, set()).add(room)
+        self._ensure_task()
+        return await sync_to_async(self.store.join, thread_sensitive=False)(
+            room, user.id, user.username, connection
+        )
+
+    async def leave(self, room, connection):
+        rooms = self._connection_rooms.get(connection, set())
+        rooms.discard(room)
+        if not rooms:
+            # Keep refreshing the connection while it is in any other room
+            self._connection_rooms.pop(connection, None)
+            self.local_connections.pop(connection, None)
+        return await sync_to_async(self.store.leave, thread_sensitive=False)(room, connection)
+
+    async def drop_connections(self, connections):
+        """
+        Take many connections out of every room at once, e.g. sockets reaped
+        as idle, announce who went offline and update users_online right away.
+        """
+        for connection in connections:
+            self._connection_rooms.pop(connection, None)
+            self.local_connections.pop(connection, None)
+        offline = await sync_to_async(self.store.leave_connections, thread_sensitive=False)(connections)
+        for room, user_id in offline:
+            self.announce_leave(room, user_id)
+        if offline:
+            await self.flush()
+        return offline
+
+    def heartbeat(self, connection):
+        if connection in self.local_connections:
+            self.local_connections[connection] = time.monotonic()
+
+    async def online_users_async(self, room):
+        return await sync_to_async(self.store.online_users, thread_sensitive=False)(room)
+
+    async def online_user_ids_async(self, room):
+        return [user['id'] for user in await self.online_users_async(room)]
+
+    async def snapshot_async(self, room):
+        """Online users of a room with the sequence number they are current as of"""
+        seq = await sync_to_async(self.store.current_seq, thread_sensitive=False)(room)
+        users = await self.online_users_async(room)
+        return seq, users
+
+    # Delta announcements
+
+    def announce_join(self, room, user_id, username):
+        pending = self._pending_for(room)
+        if user_id in pending['left']:
+            # Left and came back within the window: nothing changed
+            pending['left'].discard(user_id)
+        else:
+            pending['joined'][user_id] = username
+
+    def announce_leave(self, room, user_id):
+        pending = self._pending_for(room)
+        if user_id in pending['joined']:
+            del pending['joined'][user_id]
+        else:
+            pending['left'].add(user_id)
+
+    def _pending_for(self, room):
+        if room not in self._pending_handles:
+            loop = asyncio.get_running_loop()
+            self._pending_handles[room] = loop.call_later(
+                self.debounce, lambda: loop.create_task(self._send_delta(room))
+            )
+        return self._pending.setdefault(room, {'joined': {}, 'left': set()})
+
+    async def _send_delta(self, room):
+        self._pending_handles.pop(room, None)
+        pending = self._pending.pop(room, None)
+        if not pending or not (pending['joined'] or pending['left']):
+            return
+        from channels.layers import get_channel_layer
+
+        seq = await sync_to_async(self.store.next_seq, thread_sensitive=False)(room)
+        delta = {
+            'type': 'presence_delta',
+            'seq': seq,
+            'joined': [
+                {'id': user_id, 'username': username}
+                for user_id, username in sorted(pending['joined'].items())
+            ],
+            'left': sorted(pending['left']),
+        }
+        # Sockets in delta mode forward the pre-encoded frame as is
+        await get_channel_layer().group_send(room_group_name(room), dict(delta, room=room, frame=encode_frame(delta)))
+
+    # Reads, usable from sync code such as serializers
+
+    def online_users(self, room):
+        return self.store.online_users(room)
+
+    def online_user_ids(self, room):
+        return [user['id'] for user in self.store.online_users(room)]
+
+    def online_count(self, room):
+        return self.online_counts([room])[room]
+
+    def online_counts(self, rooms):
+        return self.store.online_counts(rooms)
+
+    def remove_user(self, room, user_id):
+        self.store.remove_user(room, user_id)
+
+    # Background upkeep
+
+    def _ensure_task(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while self.local_connections:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                for room, user_id in await self.tick():
+                    self.announce_leave(room, user_id)
+            except Exception as e:
+                print(f"Presence upkeep error: {e}")
+
+    async def tick(self):
+        """
+        Refresh this process's connections that heard from their client within
+        the store's ttl, purge lapsed ones and flush a snapshot. A client that
+        stops sending frames but keeps its socket open thus goes offline.
+        """
+        now = time.monotonic()
+        live = [
+            connection for connection, last_seen in self.local_connections.items()
+            if now - last_seen < self.store.ttl
+        ]
+        await sync_to_async(self.store.touch, thread_sensitive=False)(live)
+        offline = await sync_to_async(self.store.purge_expired, thread_sensitive=False)()
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            await self.flush()
+        return offline
+
+    async def flush(self):
+        """Write the current presence snapshot into ChatGroup.users_online"""
+        from channels.db import database_sync_to_async
+
+        self._last_flush = time.monotonic()
+        # The SQLite store's snapshot is a blocking query too, so it runs off the event loop
+        await database_sync_to_async(lambda: flush_snapshot(self.store.snapshot()))()
+
+
+def flush_snapshot(snapshot):
+    """
+    Make ChatGroup.users_online match a presence snapshot, with one delete
+    and one bulk insert.
+    """
+    from .models import ChatGroup
+
+    through = ChatGroup.users_online.through
+    groups = dict(ChatGroup.objects.filter(name__in=list(snapshot)).values_list('name', 'id'))
+    wanted = {
+        (groups[room], user_id)
+        for room, user_ids in snapshot.items() if room in groups
+        for user_id in user_ids
+    }
+    current = set(through.objects.values_list('chatgroup_id', 'user_id'))
+    stale = current - wanted
+    if stale:
+        stale_ids = through.objects.filter(
+            chatgroup_id__in={group_id for group_id, _ in stale}
+        ).values_list('id', 'chatgroup_id', 'user_id')
+        through.objects.filter(
+            id__in=[row_id for row_id, group_id, user_id in stale_ids if (group_id, user_id) in stale]
+        ).delete()
+    missing = wanted - current
+    if missing:
+        through.objects.bulk_create(
+            [through(chatgroup_id=group_id, user_id=user_id) for group_id, user_id in missing],
+            ignore_conflicts=True,
+        )
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_presence_registry():
+    """Return the process-wide presence registry configured by CHAT_PRESENCE"""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                config = getattr(settings, 'CHAT_PRESENCE', {})
+                store_class = import_string(config.get('BACKEND', 'chats.presence.MemoryPresenceStore'))
+                store = store_class(**config.get('CONFIG', {}))
+                _registry = PresenceRegistry(
+                    store,
+                    heartbeat_interval=config.get('HEARTBEAT_INTERVAL', 30),
+                    flush_interval=config.get('FLUSH_INTERVAL', 30),
+                    debounce=config.get('DEBOUNCE', 0.5),
+                )
+    return _registry
+
+
+@receiver(setting_changed)
+def _reset_registry(setting, **kwargs):
+    # Like channels' layer manager: overriding CHAT_PRESENCE (e.g. in tests) takes effect
+    global _registry
+    if setting == 'CHAT_PRESENCE':
+        _registry = None
@@ -0,0 +1,78 @@
+import hashlib
+import hmac
+import re
+import unicodedata
+
+from django.conf import settings
+from django.db.models import Count
+
+_WORD_RE = re.compile(r'\w+')
+
+
+def normalize_words(text):
+    """Distinct search words of a text: NFKC, case-folded, at least CHAT_SEARCH_MIN_WORD_LENGTH long"""
+    if not text:
+        return []
+    min_length = getattr(settings, 'CHAT_SEARCH_MIN_WORD_LENGTH', 2)
+    words = _WORD_RE.findall(unicodedata.normalize('NFKC', text).casefold())
+    return list(dict.fromkeys(word for word in words if len(word) >= min_length))
+
+
+def word_token(word):
+    """Keyed hash of one normalized word, hex"""
+    key = getattr(settings, 'CHAT_SEARCH_KEY', None) or settings.SECRET_KEY
+    if isinstance(key, str):
+        key = key.encode()
+    return hmac.new(key, word.encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def search_tokens(text):
+    """
+    Blind index tokens for a message's plaintext: one keyed hash per distinct
+    word, at most CHAT_SEARCH_MAX_TOKENS. The server can match a query's
+    tokens against them without storing or seeing any plaintext word.
+    """
+    max_tokens = getattr(settings, 'CHAT_SEARCH_MAX_TOKENS', 100)
+    return [word_token(word) for word in normalize_words(text)[:max_tokens]]
+
+
+def index_message(message, text):
+    """Store the search tokens of one new GroupMessage"""
+    index_tokens([(message.id, message.group_id, search_tokens(text))])
+
+
+def index_tokens(entries):
+    """Bulk-store tokens given as ``(message id, group id, tokens)``"""
+    from .models import MessageSearchToken
+
+    MessageSearchToken.objects.bulk_create(
+        [
+            MessageSearchToken(message_id=message_id, group_id=group_id, token=token)
+            for message_id, group_id, tokens in entries
+            for token in tokens
+        ],
+        batch_size=500,
+        ignore_conflicts=True,
+    )
+
+
+def search_message_ids(query, group_ids, before_id=None, limit=50):
+    """
+    Ids of messages in ``group_ids`` containing every word of ``query``,
+    newest first, below ``before_id``. One index query; no decryption.
+    """
+    from .models import MessageSearchToken
+
+    tokens = [word_token(word) for word in normalize_words(query)]
+    if not tokens:
+        return []
+    matches = MessageSearchToken.objects.filter(token__in=tokens, group_id__in=group_ids)
+    if before_id is not None:
+        matches = matches.filter(message_id__lt=before_id)
+    return list(
+        matches.values('message_id')
+        .annotate(matched=Count('token', distinct=True))
+        .filter(matched=len(tokens))
+        .order_by('-message_id')
+        .values_list('message_id', flat=True)[:limit]
+    )
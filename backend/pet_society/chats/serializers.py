@@ -1,6 +1,13 @@
 from rest_framework import serializers
+from rest_framework.reverse import reverse
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db import transaction
 from .models import ChatGroup, GroupMessage
+from .presence import get_presence_registry
+from .search import index_message
+from .media import store_image
+from .archive import get_message_archive
 
 User = get_user_model()
 
@@ -11,95 +18,196 @@ class UserSerializer(serializers.ModelSerializer):
         fields = ['id', 'username', 'first_name', 'last_name', 'image']
 
 
+class GroupMessageListSerializer(serializers.ListSerializer):
+    """Decrypts a whole page of messages in one batch before serializing it"""
+
+    def to_representation(self, data):
+        from .encryption import decrypt_messages
+
+        messages = data.all() if hasattr(data, 'all') else data
+        messages = list(messages)
+        self.child.decrypted_messages = decrypt_messages(messages)
+        try:
+            return super().to_representation(messages)
+        finally:
+            self.child.decrypted_messages = None
+
+
 class GroupMessageSerializer(serializers.ModelSerializer):
     author = UserSerializer(read_only=True)
     body = serializers.CharField(write_only=True, required=False, allow_blank=True)  # For accepting text messages
     image = serializers.ImageField(required=False)  # For accepting image uploads
     message = serializers.SerializerMethodField()  # For displaying the message content
     image_url = serializers.SerializerMethodField()  # For displaying image URL
+    thumbnail_url = serializers.SerializerMethodField()  # Small rendition shown in history
+    preview_url = serializers.SerializerMethodField()  # Screen-sized rendition; image_url is the original
+    image_width = serializers.IntegerField(source='media.width', read_only=True, default=None)
+    image_height = serializers.IntegerField(source='media.height', read_only=True, default=None)
     
     class Meta:
         model = GroupMessage
-        fields = ['id', 'author', 'body', 'image', 'message', 'image_url', 'message_type', 'created']
+        fields = [
+            'id', 'author', 'body', 'image', 'message', 'image_url', 'thumbnail_url', 'preview_url',
+            'image_width', 'image_height', 'message_type', 'created',
+        ]
         read_only_fields = ['id', 'author', 'message', 'image_url', 'created']
+        list_serializer_class = GroupMessageListSerializer
+
+    decrypted_messages = None  # Filled in by GroupMessageListSerializer for a page
     
     def get_message(self, obj):
         """Return decrypted message content for text messages"""
         if obj.message_type == 'image':
             return None  # No text content for image messages
         
-        if obj.is_encrypted and obj.encrypted_body:
-            from .encryption import decrypt_message
-            decrypted = decrypt_message(obj.encrypted_body)
+        if obj.is_encrypted and (obj.ciphertext or obj.encrypted_body):
+            if self.decrypted_messages and obj.id in self.decrypted_messages:
+                decrypted = self.decrypted_messages[obj.id]
+            else:
+                from .encryption import decrypt_group_message
+                decrypted = decrypt_group_message(obj)
             return decrypted if decrypted else '[Encrypted Message]'
         return obj.encrypted_body
     
     def get_image_url(self, obj):
         """Return image URL for image messages"""
         if obj.message_type == 'image' and obj.image:
-            request = self.context.get('request')
-            if request:
-                return request.build_absolute_uri(obj.image.url)
-            return obj.image.url
+            return self._absolute_url(obj.image.url)
         return None
+
+    def get_thumbnail_url(self, obj):
+        """Thumbnail, or the preview or original while it is generated or for small images"""
+        return self._rendition_url(obj, 'thumbnail', 'preview')
+
+    def get_preview_url(self, obj):
+        return self._rendition_url(obj, 'preview')
+
+    def _rendition_url(self, obj, *fields):
+        if obj.message_type != 'image' or not obj.media_id:
+            return self.get_image_url(obj)
+        for field in fields:
+            rendition = getattr(obj.media, field)
+            if rendition:
+                return self._absolute_url(rendition.url)
+        return self.get_image_url(obj)
+
+    def _absolute_url(self, url):
+        request = self.context.get('request')
+        if request:
+            return request.build_absolute_uri(url)
+        return url
     
     def create(self, validated_data):
-        from .encryption import encrypt_message
+        from .encryption import message_storage_fields
         
         # Determine message type based on provided data
         has_image = 'image' in validated_data and validated_data['image']
         has_text = 'body' in validated_data and validated_data['body']
         
         if has_image:
-            # Image message
+            # Image message, stored once per distinct image
             message_type = 'image'
-            encrypted_body = None
-            is_encrypted = False
+            storage_fields = {'encrypted_body': None, 'is_encrypted': False}
             validated_data.pop('body', None)  # Remove text body if present
+            chat_image = store_image(validated_data.pop('image'))
+            validated_data['image'] = chat_image.file.name
+            validated_data['media'] = chat_image
         else:
             # Text message
             message_type = 'text'
             message = validated_data.pop('body', '')
-            encrypted_body = encrypt_message(message)
-            
-            if not encrypted_body:
-                encrypted_body = message
-                is_encrypted = False
-            else:
-                is_encrypted = True
+            storage_fields = message_storage_fields(message) if message else {
+                'encrypted_body': message, 'is_encrypted': False
+            }
             
             validated_data.pop('image', None)  # Remove image if present
             
-        # Create the message
-        return GroupMessage.objects.create(
-            encrypted_body=encrypted_body,
-            message_type=message_type,
-            is_encrypted=is_encrypted,
-            **validated_data
-        )
+        # Create the message, with its blind index tokens for search
+        with transaction.atomic():
+            group_message = GroupMessage.objects.create(
+                message_type=message_type,
+                **storage_fields,
+                **validated_data
+            )
+            if message_type == 'text':
+                index_message(group_message, message)
+        return group_message
 
 
 class ChatGroupSerializer(serializers.ModelSerializer):
-    messages = GroupMessageSerializer(many=True, read_only=True)
-    users_online = UserSerializer(many=True, read_only=True)
-    members = UserSerializer(many=True, read_only=True)
+    """
+    Group detail: metadata, the newest messages and a preview of the members.
+
+    Only CHAT_GROUP_DETAIL['MESSAGES'] messages and ['MEMBERS'] members (and
+    online members) are included, so the payload stays the same size however
+    old or large the group is. Clients page through the rest with
+    ``messages_url`` and ``members_url``.
+    """
+    messages = serializers.SerializerMethodField()
+    has_more_messages = serializers.SerializerMethodField()
+    users_online = serializers.SerializerMethodField()
+    members = serializers.SerializerMethodField()
     online_count = serializers.SerializerMethodField()
     member_count = serializers.SerializerMethodField()
-    
+    messages_url = serializers.SerializerMethodField()
+    members_url = serializers.SerializerMethodField()
+
     class Meta:
         model = ChatGroup
         fields = [
-            'id', 'name', 'is_private', 'messages', 'users_online', 
-            'members', 'online_count', 'member_count'
+            'id', 'name', 'is_private', 'messages', 'has_more_messages', 'users_online',
+            'members', 'online_count', 'member_count', 'messages_url', 'members_url'
         ]
-        read_only_fields = ['id', 'users_online']
-    
+        read_only_fields = ['id']
+
+    def _detail_limit(self, key, default):
+        return getattr(settings, 'CHAT_GROUP_DETAIL', {}).get(key, default)
+
+    def _latest_messages(self, obj):
+        """The newest messages plus one, to tell whether there are more; read through to the archive"""
+        cache = self.__dict__.setdefault('_latest_messages_cache', {})
+        if obj.id not in cache:
+            limit = self._detail_limit('MESSAGES', 30)
+            messages = list(
+                GroupMessage.objects.filter(group=obj).select_related('author', 'media').order_by('-id')[:limit + 1]
+            )
+            if len(messages) <= limit:
+                messages += get_message_archive().messages_before(
+                    obj.id, messages[-1].id if messages else None, limit + 1 - len(messages)
+                )
+            cache[obj.id] = messages
+        return cache[obj.id]
+
+    def get_messages(self, obj):
+        messages = self._latest_messages(obj)[:self._detail_limit('MESSAGES', 30)]
+        return GroupMessageSerializer(messages, many=True, context=self.context).data
+
+    def get_has_more_messages(self, obj):
+        return len(self._latest_messages(obj)) > self._detail_limit('MESSAGES', 30)
+
+    def get_users_online(self, obj):
+        user_ids = sorted(get_presence_registry().online_user_ids(obj.name))[:self._detail_limit('MEMBERS', 20)]
+        if not user_ids:
+            return []
+        return UserSerializer(User.objects.filter(id__in=user_ids).order_by('id'), many=True).data
+
+    def get_members(self, obj):
+        members = obj.members.order_by('id')[:self._detail_limit('MEMBERS', 20)]
+        return UserSerializer(members, many=True).data
+
     def get_online_count(self, obj):
-        return obj.users_online.count()
+        return get_presence_registry().online_count(obj.name)
     
     def get_member_count(self, obj):
         return obj.members.count()
 
+    def get_messages_url(self, obj):
+        url = reverse('chatgroup-messages', args=[obj.id], request=self.context.get('request'))
+        return f"{url}?limit={self._detail_limit('MESSAGES', 30)}"
+
+    def get_members_url(self, obj):
+        return reverse('chatgroup-members', args=[obj.id], request=self.context.get('request'))
+
 
 class ChatGroupListSerializer(serializers.ModelSerializer):
     """Simplified serializer for listing chat groups without messages"""
@@ -117,7 +225,7 @@ class ChatGroupListSerializer(serializers.ModelSerializer):
         ]
     
     def get_online_count(self, obj):
-        return obj.users_online.count()
+        return get_presence_registry().online_count(obj.name)
     
     def get_member_count(self, obj):
         return obj.members.count()
@@ -133,8 +241,8 @@ class ChatGroupListSerializer(serializers.ModelSerializer):
                     'created': last_message.created
                 }
             else:
-                from .encryption import decrypt_message
-                message_content = decrypt_message(last_message.encrypted_body) if last_message.is_encrypted else last_message.encrypted_body
+                from .encryption import decrypt_group_message
+                message_content = decrypt_group_message(last_message)
                 return {
                     'id': last_message.id,
                     'body': message_content if message_content else '[Encrypted Message]',
@@ -1,3 +1,1206 @@
-from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
 
-# Create your tests here.
+from .models import ChatGroup, GroupMessage
+
+User = get_user_model()
+
+# Tests never touch channel_layer.sqlite3, which the dev server shares
+isolated_realtime = override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    CHAT_PRESENCE={'BACKEND': 'chats.presence.MemoryPresenceStore'},
+)
+
+
+@isolated_realtime
+@override_settings(CHAT_GROUP_DETAIL={'MESSAGES': 30, 'MEMBERS': 20})
+class ChatGroupDetailTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='owner', email='owner@example.com', password='password', first_name='O', last_name='Wner'
+        )
+        self.group = ChatGroup.objects.create(name='detail-budget')
+        self.group.members.add(self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def add_members(self, count, start=0):
+        users = User.objects.bulk_create([
+            User(username=f'member{i}', email=f'member{i}@example.com', first_name='M', last_name=str(i))
+            for i in range(start, start + count)
+        ])
+        self.group.members.add(*users)
+
+    def add_messages(self, count):
+        GroupMessage.objects.bulk_create([
+            GroupMessage(group=self.group, author=self.user, encrypted_body=f'message {i}', is_encrypted=False)
+            for i in range(count)
+        ])
+
+    def retrieve(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/api/chats/groups/{self.group.id}/')
+        self.assertEqual(response.status_code, 200)
+        return response.data, len(queries)
+
+    def test_detail_is_bounded(self):
+        self.add_members(50)
+        self.add_messages(200)
+
+        data, _ = self.retrieve()
+
+        self.assertEqual(len(data['messages']), 30)
+        self.assertTrue(data['has_more_messages'])
+        self.assertEqual(data['messages'][0]['message'], 'message 199')
+        self.assertEqual(len(data['members']), 20)
+        self.assertEqual(data['member_count'], 51)
+        self.assertIn(f'/api/chats/groups/{self.group.id}/messages/?limit=30', data['messages_url'])
+        self.assertIn(f'/api/chats/groups/{self.group.id}/members/', data['members_url'])
+
+    def test_detail_query_budget(self):
+        self.add_members(5)
+        self.add_messages(40)
+        _, small_queries = self.retrieve()
+
+        self.add_members(200, start=5)
+        self.add_messages(1000)
+        _, large_queries = self.retrieve()
+
+        self.assertEqual(small_queries, large_queries)
+        self.assertLessEqual(large_queries, 5)
+
+    def test_members_pagination(self):
+        self.add_members(45)
+
+        response = self.client.get(f'/api/chats/groups/{self.group.id}/members/?limit=20')
+        self.assertTrue(response.data['has_more'])
+        seen = [member['id'] for member in response.data['members']]
+        while response.data['has_more']:
+            response = self.client.get(
+                f'/api/chats/groups/{self.group.id}/members/?limit=20&after_id={response.data["after_id"]}'
+            )
+            seen += [member['id'] for member in response.data['members']]
+
+        self.assertEqual(seen, sorted(self.group.members.values_list('id', flat=True)))
+
+
+@isolated_realtime
+class PrivateChatTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(
+            username='alice', email='alice@example.com', password='password', first_name='A', last_name='Lice'
+        )
+        self.bob = User.objects.create_user(
+            username='bob', email='bob@example.com', password='password', first_name='B', last_name='Ob'
+        )
+
+    def create_private(self, user, invite_user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client.post('/api/chats/groups/', {'invite_user': invite_user, 'is_private': True}, format='json')
+
+    def test_private_chat_is_reused_from_either_side(self):
+        created = self.create_private(self.alice, 'bob')
+        again = self.create_private(self.bob, 'alice')
+
+        self.assertEqual(created.status_code, 201)
+        self.assertEqual(again.status_code, 200)
+        self.assertEqual(created.data['id'], again.data['id'])
+        self.assertEqual(ChatGroup.objects.filter(is_private=True).count(), 1)
+
+    def test_pair_is_unique(self):
+        ChatGroup.get_or_create_private(self.alice, self.bob)
+        with self.assertRaises(IntegrityError):
+            ChatGroup.objects.create(is_private=True, pair_user_low=self.alice, pair_user_high=self.bob)
+
+    def test_reopening_brings_back_a_user_who_left(self):
+        from unittest import mock
+
+        chat_id = self.create_private(self.alice, 'bob').data['id']
+        bob = APIClient()
+        bob.force_authenticate(self.bob)
+        bob.post(f'/api/chats/groups/{chat_id}/leave/')
+
+        with mock.patch('chats.views.membership_changed') as membership_changed:
+            response = self.create_private(self.alice, 'bob')
+            self.create_private(self.alice, 'bob')
+
+        self.assertEqual(response.data['id'], chat_id)
+        self.assertTrue(ChatGroup.objects.get(id=chat_id).members.filter(id=self.bob.id).exists())
+        # Only the call that re-added bob invalidates cached membership
+        self.assertEqual(membership_changed.call_count, 1)
+
+
+@isolated_realtime
+class PrivateChatMergeMigrationTests(TransactionTestCase):
+    before = [('chats', '0028_chatimage_alter_chatgroup_name_groupmessage_media')]
+    after = [('chats', '0029_chatgroup_private_pair')]
+
+    def migrate(self, targets):
+        from django.db.migrations.executor import MigrationExecutor
+
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        from django.db.migrations.loader import MigrationLoader
+
+        self.migrate(MigrationLoader(connection).graph.leaf_nodes())
+
+    def setUp(self):
+        apps = self.migrate(self.before)
+        self.ChatGroup = apps.get_model('chats', 'ChatGroup')
+        self.GroupMessage = apps.get_model('chats', 'GroupMessage')
+        self.ArchivedSegment = apps.get_model('chats', 'ArchivedSegment')
+        self.alice, self.bob, self.carol = (
+            apps.get_model(User._meta.label).objects.create(
+                username=name, email=f'{name}@example.com', first_name=name, last_name=name
+            )
+            for name in ('alice', 'bob', 'carol')
+        )
+
+    def private_chat(self, members, authors=None):
+        # Historical models cannot call the shortuuid default
+        chat = self.ChatGroup.objects.create(name=f'private-{self.ChatGroup.objects.count()}', is_private=True)
+        chat.members.add(*members)
+        for author in members[:1] if authors is None else authors:
+            self.GroupMessage.objects.create(group=chat, author=author, encrypted_body='hi', is_encrypted=False)
+        return chat
+
+    def migrated_chats(self):
+        apps = self.migrate(self.after)
+        ChatGroup = apps.get_model('chats', 'ChatGroup')
+        return {
+            chat.id: (chat.pair_user_low_id, chat.pair_user_high_id, sorted(user.id for user in chat.members.all()))
+            for chat in ChatGroup.objects.prefetch_related('members')
+        }, apps.get_model('chats', 'GroupMessage')
+
+    def test_duplicate_private_chats_are_merged(self):
+        alice, bob, carol = self.alice, self.bob, self.carol
+        oldest = self.private_chat([alice, bob])
+        self.private_chat([bob, alice])
+        with_carol = self.private_chat([alice, carol])
+        self.private_chat([alice, bob])
+
+        chats, GroupMessage = self.migrated_chats()
+
+        self.assertEqual(chats, {
+            oldest.id: (alice.id, bob.id, [alice.id, bob.id]),
+            with_carol.id: (alice.id, carol.id, [alice.id, carol.id]),
+        })
+        self.assertEqual(GroupMessage.objects.filter(group_id=oldest.id).count(), 3)
+        self.assertEqual(GroupMessage.objects.filter(group_id=with_carol.id).count(), 1)
+
+    def test_chat_one_user_left_is_keyed_by_its_authors(self):
+        alice, bob, carol = self.alice, self.bob, self.carol
+        # Bob left after writing; the pair then started a second chat
+        left = self.private_chat([alice], authors=[alice, bob])
+        self.private_chat([alice, bob])
+        # Nobody but carol ever took part: nothing to key it by
+        alone = self.private_chat([carol])
+
+        chats, GroupMessage = self.migrated_chats()
+
+        self.assertEqual(chats, {
+            left.id: (alice.id, bob.id, [alice.id, bob.id]),
+            alone.id: (None, None, [carol.id]),
+        })
+        self.assertEqual(GroupMessage.objects.filter(group_id=left.id).count(), 3)
+
+    def test_pair_with_archived_history_keys_the_oldest_chat(self):
+        from django.utils import timezone
+
+        oldest = self.private_chat([self.bob, self.carol])
+        archived = self.private_chat([self.carol, self.bob])
+        self.ArchivedSegment.objects.create(
+            group=archived, first_id=1, last_id=1, first_created=timezone.now(), last_created=timezone.now(),
+            message_count=1, path='archived.jsonl.gz', size=1,
+        )
+
+        chats, _ = self.migrated_chats()
+
+        self.assertEqual(chats[oldest.id][:2], (self.bob.id, self.carol.id))
+        self.assertEqual(chats[archived.id][:2], (None, None))
+
+
+@isolated_realtime
+class BulkMembershipTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='owner', email='owner@example.com', password='password', first_name='O', last_name='Wner'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def make_users(self, count, start=0):
+        return User.objects.bulk_create([
+            User(username=f'invitee{i}', email=f'invitee{i}@example.com', first_name='I', last_name=str(i))
+            for i in range(start, start + count)
+        ])
+
+    def create_group(self, usernames):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                '/api/chats/groups/', {'name': f'group-{len(usernames)}', 'invite_users': usernames}, format='json'
+            )
+        self.assertEqual(response.status_code, 201)
+        return response, len(queries)
+
+    def test_create_queries_do_not_grow_with_invitees(self):
+        # Stays within one SQLite bulk insert batch (999 query parameters)
+        users = self.make_users(120)
+        _, few_queries = self.create_group([user.username for user in users[:3]])
+        response, many_queries = self.create_group([user.username for user in users])
+
+        self.assertEqual(few_queries, many_queries)
+        self.assertEqual(ChatGroup.objects.get(id=response.data['id']).members.count(), 121)
+
+    def test_create_with_missing_users_creates_nothing(self):
+        self.make_users(2)
+        response = self.client.post(
+            '/api/chats/groups/', {'invite_users': ['invitee0', 'nobody', 'invitee1']}, format='json'
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('nobody', response.data['error'])
+        self.assertFalse(ChatGroup.objects.exists())
+
+    def test_bulk_invite_reports_each_username(self):
+        users = self.make_users(5)
+        group = ChatGroup.objects.create(name='bulk-invite')
+        group.members.add(self.user, users[0])
+
+        response = self.client.post(
+            f'/api/chats/groups/{group.id}/invite_users/',
+            {'usernames': [user.username for user in users] + ['nobody', ' invitee1 ']},
+            format='json',
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([user['username'] for user in response.data['invited']], [u.username for u in users[1:]])
+        self.assertEqual(response.data['already_members'], ['invitee0'])
+        self.assertEqual(response.data['missing'], ['nobody'])
+        self.assertEqual(group.members.count(), 6)
+
+    def test_single_invite_goes_through_the_bulk_path(self):
+        from unittest import mock
+
+        users = self.make_users(1)
+        group = ChatGroup.objects.create(name='single-invite')
+        group.members.add(self.user)
+        url = f'/api/chats/groups/{group.id}/invite_user/'
+
+        with mock.patch('chats.views.membership_changed') as membership_changed:
+            response = self.client.post(url, {'username': ' invitee0 '}, format='json')
+            again = self.client.post(url, {'username': 'invitee0'}, format='json')
+        missing = self.client.post(url, {'username': 'nobody'}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['user']['id'], users[0].id)
+        self.assertEqual(again.status_code, 200)
+        # Only the call that added someone changes membership
+        self.assertEqual(membership_changed.call_count, 1)
+        self.assertEqual(missing.status_code, 404)
+        self.assertEqual(group.members.count(), 2)
+
+    def test_membership_changes_in_groups_with_any_name(self):
+        from channels.layers import get_channel_layer
+        from .groups import room_group_name
+
+        users = self.make_users(1)
+        for name in ('My Friends', 'Hunde & Katzen 🐾', 'x' * 100):
+            group = ChatGroup.objects.create(name=name)
+            group.members.add(self.user)
+            self.assertTrue(get_channel_layer().require_valid_group_name(room_group_name(name)))
+
+            self.assertEqual(self.client.post(f'/api/chats/groups/{group.id}/join/').status_code, 200)
+            response = self.client.post(
+                f'/api/chats/groups/{group.id}/invite_users/', {'usernames': [users[0].username]}, format='json'
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.data['invited']), 1)
+            self.assertEqual(self.client.post(f'/api/chats/groups/{group.id}/leave/').status_code, 200)
+
+
+@isolated_realtime
+class NotificationInboxTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(
+            username='owner', email='owner@example.com', password='password', first_name='O', last_name='Wner'
+        )
+        self.guest = User.objects.create_user(
+            username='guest', email='guest@example.com', password='password', first_name='G', last_name='Uest'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+        self.guest_client = APIClient()
+        self.guest_client.force_authenticate(self.guest)
+
+    def test_offline_user_catches_up_from_inbox(self):
+        for name in ('first', 'second'):
+            response = self.client.post('/api/chats/groups/', {'name': name, 'invite_user': 'guest'}, format='json')
+            self.assertEqual(response.status_code, 201)
+
+        self.assertEqual(self.guest_client.get('/api/chats/notifications/badge/').data['unread_count'], 2)
+        # The creator is not notified about their own chats
+        self.assertEqual(self.client.get('/api/chats/notifications/badge/').data['unread_count'], 0)
+
+        response = self.guest_client.get('/api/chats/notifications/?after_id=0')
+        notifications = response.data['notifications']
+        self.assertEqual([n['chat_name'] for n in notifications], ['first', 'second'])
+        self.assertEqual(notifications[0]['type'], 'new_chat_created')
+        self.assertEqual(notifications[0]['created_by']['username'], 'owner')
+
+        response = self.guest_client.post(
+            '/api/chats/notifications/read/', {'through_id': notifications[0]['notification_id']}, format='json'
+        )
+        self.assertEqual(response.data['unread_count'], 1)
+        response = self.guest_client.post('/api/chats/notifications/read/', {}, format='json')
+        self.assertEqual(response.data['unread_count'], 0)
+
+    def test_prune_keeps_unread(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from .inbox import mark_read, prune_read
+        from .models import Notification
+
+        for name in ('first', 'second'):
+            self.client.post('/api/chats/groups/', {'name': name, 'invite_user': 'guest'}, format='json')
+        first = Notification.objects.filter(user=self.guest).order_by('id').first()
+        mark_read(self.guest.id, first.id)
+
+        self.assertEqual(prune_read(timezone.now() + timedelta(seconds=1)), 1)
+        self.assertEqual(Notification.objects.filter(user=self.guest).count(), 1)
+
+    def test_read_cursor_stops_at_newest_notification(self):
+        from .inbox import mark_read, read_cursor
+
+        self.client.post('/api/chats/groups/', {'name': 'first', 'invite_user': 'guest'}, format='json')
+        self.assertEqual(mark_read(self.guest.id, 10 ** 9), 0)
+
+        self.client.post('/api/chats/groups/', {'name': 'second', 'invite_user': 'guest'}, format='json')
+        self.assertEqual(self.guest_client.get('/api/chats/notifications/badge/').data['unread_count'], 1)
+        self.assertLess(read_cursor(self.guest.id), 10 ** 9)
+
+    async def test_socket_only_serves_the_users_own_notifications(self):
+        from channels.testing import WebsocketCommunicator
+        from .notification_consumer import NotificationConsumer
+
+        communicator = WebsocketCommunicator(NotificationConsumer.as_asgi(), f'/ws/notifications/{self.owner.id}/')
+        communicator.scope['user'] = self.guest
+        communicator.scope['url_route'] = {'kwargs': {'user_id': str(self.owner.id)}}
+        connected, close_code = await communicator.connect()
+
+        self.assertFalse(connected)
+        self.assertEqual(close_code, 4003)
+
+
+@isolated_realtime
+class IdleReaperTests(TestCase):
+    class FakeConsumer:
+        def __init__(self, channel_name, channel_layer):
+            self.channel_name = channel_name
+            self.channel_layer = channel_layer
+            self.sent = []
+            self.closed = None
+
+        def connection_groups(self):
+            return [f'group_{self.channel_name}']
+
+        async def send_payload(self, payload, droppable=False):
+            self.sent.append(payload)
+
+        async def close(self, code=None):
+            self.closed = code
+
+    class FakeLayer:
+        def __init__(self):
+            self.discarded = []
+
+        async def group_discard_many(self, memberships):
+            self.discarded.append(memberships)
+
+    async def test_quiet_sockets_are_pinged_then_reaped_together(self):
+        from .idle import IdleReaper
+
+        reaper = IdleReaper(idle_timeout=60, ping_after=30, sweep_interval=3600)
+        layer = self.FakeLayer()
+        active, quiet, dead = (self.FakeConsumer(name, layer) for name in ('active', 'quiet', 'dead'))
+        for consumer in (active, quiet, dead):
+            reaper.register(consumer)
+        reaper._connections[quiet] -= 40
+        reaper._connections[dead] -= 70
+
+        reaped = await reaper.sweep()
+
+        self.assertEqual(reaped, [dead])
+        self.assertEqual(dead.closed, 4010)
+        self.assertEqual([frame['type'] for frame in quiet.sent], ['ping'])
+        self.assertEqual(active.sent, [])
+        self.assertEqual(layer.discarded, [[('group_dead', 'dead')]])
+        reaper._task.cancel()
+
+    async def test_reaped_sockets_are_closed_concurrently(self):
+        import asyncio
+        import time
+        from .idle import IdleReaper
+
+        class DrainingConsumer(self.FakeConsumer):
+            async def close(self, code=None):
+                await asyncio.sleep(0.2)  # Waits out its send queue's drain timeout
+                self.closed = code
+
+        reaper = IdleReaper()
+        layer = self.FakeLayer()
+        consumers = [DrainingConsumer(f'socket{i}', layer) for i in range(5)]
+
+        started = time.monotonic()
+        await reaper.reap(consumers)
+
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual([consumer.closed for consumer in consumers], [4010] * 5)
+
+
+@isolated_realtime
+class WriteBehindRecoveryTests(TestCase):
+    def setUp(self):
+        import tempfile
+
+        self.user = User.objects.create_user(
+            username='owner', email='owner@example.com', password='password', first_name='O', last_name='Wner'
+        )
+        self.group = ChatGroup.objects.create(name='write-behind')
+        self.log_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.log_dir)
+
+    def write_segment(self, records, pid=2 ** 22 + 1):
+        import json
+        import os
+
+        # A pid above the kernel's pid_max, so the segment looks orphaned
+        path = os.path.join(self.log_dir, f'chat-wal-{pid}-dead-1.log')
+        with open(path, 'w', encoding='utf-8') as segment:
+            for record in records:
+                segment.write(json.dumps(record) + '\n')
+            segment.write('{"provisional_id": "p-dead-torn"')
+        return path
+
+    def record(self, provisional_id, body):
+        return {
+            'provisional_id': provisional_id,
+            'room_name': str(self.group.id),
+            'group_id': self.group.id,
+            'author_id': self.user.id,
+            'ciphertext': None,
+            'encrypted_body': body,
+            'is_encrypted': False,
+            'key_id': None,
+            'created': '2024-01-01T00:00:00+00:00',
+            'search_tokens': [],
+        }
+
+    def test_segment_is_replayed_exactly_once(self):
+        import os
+        from .persistence import WriteBehindWriter, insert_records
+
+        # One row made it to the database before the crash
+        insert_records([self.record('p-dead-1', 'first')])
+        path = self.write_segment([
+            self.record('p-dead-1', 'first'),
+            self.record('p-dead-2', 'second'),
+            self.record('p-dead-2', 'second'),
+        ])
+
+        WriteBehindWriter(self.log_dir).recover()
+        self.assertFalse(os.path.exists(path))
+
+        # A second process replaying a copy of the same segment adds nothing
+        self.write_segment([self.record('p-dead-1', 'first'), self.record('p-dead-2', 'second')])
+        WriteBehindWriter(self.log_dir).recover()
+
+        self.assertEqual(
+            sorted(GroupMessage.objects.values_list('provisional_id', 'encrypted_body')),
+            [('p-dead-1', 'first'), ('p-dead-2', 'second')],
+        )
+        # Rows keep the time the message was sent, not when it was replayed
+        self.assertEqual(
+            {message.created.isoformat() for message in GroupMessage.objects.all()}, {'2024-01-01T00:00:00+00:00'}
+        )
+
+    def test_persisted_ids_carry_the_logged_send_time(self):
+        from .persistence import insert_records
+
+        persisted = insert_records([self.record('p-late-1', 'late')])
+
+        self.assertEqual(persisted['p-late-1'][1], '2024-01-01T00:00:00+00:00')
+        self.assertEqual(GroupMessage.objects.get().created.isoformat(), '2024-01-01T00:00:00+00:00')
+
+    def test_failed_recovery_is_retried(self):
+        from unittest import mock
+        from .persistence import WriteBehindWriter
+
+        self.write_segment([self.record('p-dead-1', 'first')])
+        writer = WriteBehindWriter(self.log_dir)
+        with mock.patch('chats.persistence.insert_records', side_effect=RuntimeError('database is locked')):
+            with self.assertRaises(RuntimeError):
+                writer.recover()
+        self.assertFalse(writer._recovered)
+
+        writer.recover()
+        self.assertTrue(writer._recovered)
+        self.assertEqual(GroupMessage.objects.filter(provisional_id='p-dead-1').count(), 1)
+
+
+class OutboundQueueTests(TestCase):
+    class SlowConsumer:
+        def __init__(self):
+            self.sent = []
+
+        async def send(self, text_data=None, bytes_data=None):
+            import asyncio
+
+            await asyncio.sleep(0.01)
+            self.sent.append(text_data)
+
+    async def test_drain_sends_essential_frames_only(self):
+        from .outbound import OutboundQueue
+
+        consumer = self.SlowConsumer()
+        queue = OutboundQueue(consumer)
+        await queue.put('message 1')
+        await queue.put('typing', droppable=True)
+        await queue.put('error')
+
+        await queue.drain(timeout=1)
+        await queue.put('after close')
+
+        self.assertEqual(consumer.sent, ['message 1', 'error'])
+        self.assertTrue(queue._task.done())
+
+    class TransportConsumer:
+        """Sends like daphne: through partial(handle_reply, protocol), never blocking"""
+
+        class Transport:
+            def __init__(self):
+                self.buffered = 0
+
+            def get_write_buffer_size(self):
+                return self.buffered
+
+        def __init__(self):
+            import functools
+            from types import SimpleNamespace
+
+            self.transport = self.Transport()
+            self.base_send = functools.partial(self.handle_reply, SimpleNamespace(transport=self.transport))
+            self.sent = []
+            self.closed = None
+
+        async def handle_reply(self, protocol, message):
+            pass
+
+        async def send(self, text_data=None, bytes_data=None):
+            self.sent.append(text_data)
+            self.transport.buffered += len(text_data)
+
+        async def close(self, code=None):
+            self.closed = code
+
+    async def test_full_transport_buffer_backs_frames_up_into_the_queue(self):
+        import asyncio
+        from .outbound import OutboundQueue
+
+        consumer = self.TransportConsumer()
+        queue = OutboundQueue(consumer, max_depth=3, max_transport_buffer=10)
+        await queue.put('x' * 20)
+        await asyncio.sleep(0.01)
+        # The client reads nothing: the rest waits in the queue, then it overflows
+        for i in range(3):
+            await queue.put(f'message {i}')
+        await asyncio.sleep(0.01)
+        self.assertEqual(consumer.sent, ['x' * 20])
+        self.assertEqual(queue.depth, 3)
+        self.assertIsNone(consumer.closed)
+
+        await queue.put('one too many')
+        self.assertEqual(consumer.closed, 4008)
+
+    async def test_writer_resumes_once_the_transport_drains(self):
+        import asyncio
+        from .outbound import OutboundQueue
+
+        consumer = self.TransportConsumer()
+        queue = OutboundQueue(consumer, max_transport_buffer=10)
+        await queue.put('x' * 20)
+        await queue.put('next')
+        await asyncio.sleep(0.01)
+        self.assertEqual(consumer.sent, ['x' * 20])
+
+        consumer.transport.buffered = 0
+        await asyncio.sleep(0.1)
+        self.assertEqual(consumer.sent, ['x' * 20, 'next'])
+        queue.stop()
+
+    async def test_byte_budget_drops_droppable_frames_then_evicts(self):
+        from .outbound import OutboundQueue
+
+        consumer = self.TransportConsumer()
+        queue = OutboundQueue(consumer, max_bytes=100)
+        await queue.put('a' * 30)
+        await queue.put('typing' * 5, droppable=True)
+        await queue.put('b' * 30)
+        await queue.put('c' * 30)  # Fits once the typing frame is dropped
+        self.assertEqual(queue.bytes, 90)
+        self.assertIsNone(consumer.closed)
+
+        await queue.put('d' * 30)
+        self.assertEqual(consumer.closed, 4008)
+
+    async def test_drain_gives_up_after_timeout(self):
+        from .outbound import OutboundQueue
+
+        consumer = self.SlowConsumer()
+        queue = OutboundQueue(consumer)
+        for i in range(100):
+            await queue.put(f'message {i}')
+
+        await queue.drain(timeout=0.05)
+
+        self.assertLess(len(consumer.sent), 100)
+        self.assertEqual(queue.depth, 0)
+
+
+@isolated_realtime
+class ArchivePaginationTests(TestCase):
+    def setUp(self):
+        import shutil
+        import tempfile
+        from datetime import timedelta
+        from django.utils import timezone
+        from .encryption import message_storage_fields
+
+        self.archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.archive_dir)
+        archive_settings = self.settings(CHAT_ARCHIVE={'DIR': self.archive_dir, 'CHUNK_SIZE': 7, 'RETENTION_DAYS': 30})
+        archive_settings.enable()
+        self.addCleanup(archive_settings.disable)
+
+        self.user = User.objects.create_user(
+            username='owner', email='owner@example.com', password='password', first_name='O', last_name='Wner'
+        )
+        self.group = ChatGroup.objects.create(name='archived')
+        self.group.members.add(self.user)
+        self.ids = []
+        for i in range(30):
+            message = GroupMessage.objects.create(group=self.group, author=self.user, **message_storage_fields(f'm{i}'))
+            if i < 20:
+                # The oldest 20 fall past the retention period
+                GroupMessage.objects.filter(id=message.id).update(created=timezone.now() - timedelta(days=60 - i))
+            self.ids.append(message.id)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = f'/api/chats/groups/{self.group.id}/messages/'
+
+    def archive(self, *args):
+        from io import StringIO
+        from django.core.management import call_command
+
+        call_command('archive_chat_messages', '--sleep', '0', *args, stdout=StringIO())
+
+    def page_ids(self, params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return [message['id'] for message in response.data['messages']], response.data
+
+    def test_keyset_pages_cross_into_the_archive(self):
+        self.archive()
+        self.assertEqual(GroupMessage.objects.filter(group=self.group).count(), 10)
+
+        seen, data = self.page_ids({'limit': 8})
+        while data['has_more']:
+            ids, data = self.page_ids({'limit': 8, 'before_id': data['before_id']})
+            seen += ids
+        self.assertEqual(seen, self.ids[::-1])
+
+        seen, data = self.page_ids({'limit': 8, 'after_id': 0})
+        seen = seen[::-1]
+        while data['has_more']:
+            ids, data = self.page_ids({'limit': 8, 'after_id': data['after_id']})
+            seen += ids[::-1]
+        self.assertEqual(seen, self.ids)
+
+    def test_page_numbers_cross_into_the_archive(self):
+        self.archive()
+
+        seen = []
+        for page in range(1, 5):
+            ids, data = self.page_ids({'page': page, 'page_size': 9})
+            seen += ids
+            self.assertEqual(data['has_more'], page < 4)
+        self.assertEqual(seen, self.ids[::-1])
+
+    def test_before_archived_message(self):
+        self.archive()
+
+        ids, data = self.page_ids({'page': 1, 'page_size': 5, 'before_message_id': self.ids[12]})
+        self.assertEqual(ids, self.ids[7:12][::-1])
+        self.assertTrue(data['has_more'])
+        ids, data = self.page_ids({'page': 3, 'page_size': 5, 'before_message_id': self.ids[12]})
+        self.assertEqual(ids, self.ids[:2][::-1])
+        self.assertFalse(data['has_more'])
+
+    def test_interrupted_run_resumes_and_prunes_orphans(self):
+        import os
+        from .models import ArchivedSegment
+
+        self.archive('--max-chunks', '1')
+        self.assertEqual(ArchivedSegment.objects.count(), 1)
+
+        # A file a crashed run wrote but never indexed
+        orphan = os.path.join(self.archive_dir, str(self.group.id), 'orphan.jsonl.gz')
+        with open(orphan, 'wb') as orphan_file:
+            orphan_file.write(b'')
+        os.utime(orphan, (0, 0))
+
+        self.archive()
+
+        self.assertFalse(os.path.exists(orphan))
+        segments = list(ArchivedSegment.objects.order_by('first_id').values_list('first_id', 'last_id'))
+        self.assertEqual(segments, [
+            (self.ids[0], self.ids[6]), (self.ids[7], self.ids[13]), (self.ids[14], self.ids[19]),
+        ])
+        ids, _ = self.page_ids({'limit': 200})
+        self.assertEqual(ids, self.ids[::-1])
+
+
+@isolated_realtime
+class KeyRotationTests(TestCase):
+    OLD_KEY = 'ZmDfcTF7_60GrrY167zsiPd67pEvs0aGOv2oasOM1Pg='
+    NEW_KEY = 'yLPJ2MFDm8nh2wO2z-47KgEqtnsbK3JrrjwVnTjb5Rs='
+
+    def setUp(self):
+        from .encryption import reset_encryption_service
+
+        self.addCleanup(reset_encryption_service)
+        self.user = User.objects.create_user(
+            username='owner', email='owner@example.com', password='password', first_name='O', last_name='Wner'
+        )
+        self.group = ChatGroup.objects.create(name='rotation')
+
+    def use_keys(self, key, key_id, legacy_keys=None):
+        from .encryption import reset_encryption_service
+
+        key_settings = self.settings(
+            ENCRYPTION_KEY=key, ENCRYPTION_KEY_ID=key_id, ENCRYPTION_LEGACY_KEYS=legacy_keys or {}
+        )
+        key_settings.enable()
+        self.addCleanup(key_settings.disable)
+        reset_encryption_service()
+
+    def rotate(self):
+        from io import StringIO
+        from django.core.management import call_command
+
+        out = StringIO()
+        call_command('rotate_encryption_key', '--max-rate', '0', '--batch-size', '2', stdout=out, stderr=StringIO())
+        return out.getvalue()
+
+    def decrypted(self):
+        from .encryption import decrypt_group_message, get_encryption_service
+
+        get_encryption_service().clear_cache()
+        return [decrypt_group_message(message) for message in GroupMessage.objects.order_by('id')]
+
+    def test_rotation_reencrypts_and_old_rows_stay_readable(self):
+        from .encryption import encrypt_message, message_storage_fields
+
+        self.use_keys(self.OLD_KEY, 'old')
+        texts = ['binary row', 'legacy text row', 'row without a key id', 'x' * 1000]
+        GroupMessage.objects.create(group=self.group, author=self.user, **message_storage_fields(texts[0]))
+        GroupMessage.objects.create(
+            group=self.group, author=self.user, encrypted_body=encrypt_message(texts[1]), is_encrypted=True,
+            key_id='old',
+        )
+        # Rows from before key ids were recorded are decrypted by trying every key
+        GroupMessage.objects.create(
+            group=self.group, author=self.user, encrypted_body=encrypt_message(texts[2]), is_encrypted=True,
+        )
+        GroupMessage.objects.create(group=self.group, author=self.user, **message_storage_fields(texts[3]))
+
+        self.use_keys(self.NEW_KEY, 'new', {'old': self.OLD_KEY})
+        self.assertEqual(self.decrypted(), texts)
+
+        self.assertIn('Re-encrypted 4 messages', self.rotate())
+        self.assertEqual(set(GroupMessage.objects.values_list('key_id', flat=True)), {'new'})
+        self.assertFalse(GroupMessage.objects.filter(encrypted_body__isnull=False).exists())
+
+        # The old key can go once every row is rotated
+        self.use_keys(self.NEW_KEY, 'new')
+        self.assertEqual(self.decrypted(), texts)
+        self.assertIn('Re-encrypted 0 messages', self.rotate())
+
+    def test_rows_of_an_unknown_key_are_left_alone(self):
+        from .encryption import message_storage_fields
+
+        self.use_keys(self.OLD_KEY, 'old')
+        message = GroupMessage.objects.create(group=self.group, author=self.user, **message_storage_fields('lost'))
+
+        self.use_keys(self.NEW_KEY, 'new')
+        self.assertIn('1 failed', self.rotate())
+
+        stored = GroupMessage.objects.get(id=message.id)
+        self.assertEqual(stored.key_id, 'old')
+        self.assertEqual(bytes(stored.ciphertext), message.ciphertext)
+
+
+@isolated_realtime
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        from .encryption import message_storage_fields
+
+        self.user = User.objects.create_user(
+            username='owner', email='owner@example.com', password='password', first_name='O', last_name='Wner'
+        )
+        self.chat = ChatGroup.objects.create(name='searchable')
+        self.chat.members.add(self.user)
+        self.other_chat = ChatGroup.objects.create(name='also-mine')
+        self.other_chat.members.add(self.user)
+        self.foreign_chat = ChatGroup.objects.create(name='not-mine')
+        # Stored without search tokens, as before search existed
+        self.messages = {
+            name: GroupMessage.objects.create(group=group, author=self.user, **message_storage_fields(text))
+            for name, group, text in (
+                ('fox', self.chat, 'The quick brown fox'),
+                ('thinking', self.chat, 'quick thinking'),
+                ('dog', self.other_chat, 'Brown, QUICK dog!'),
+                ('foreign', self.foreign_chat, 'quick brown fox'),
+            )
+        }
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def backfill(self):
+        from io import StringIO
+        from django.core.management import call_command
+
+        call_command('index_chat_messages', '--sleep', '0', stdout=StringIO())
+
+    def search(self, **params):
+        response = self.client.get('/api/chats/groups/search/', params)
+        self.assertEqual(response.status_code, 200)
+        return [result['id'] for result in response.data['results']], response.data
+
+    def test_matches_every_word_in_the_users_chats(self):
+        from .models import MessageSearchToken
+
+        self.backfill()
+        tokens = MessageSearchToken.objects.count()
+        self.backfill()
+        self.assertEqual(MessageSearchToken.objects.count(), tokens)
+
+        ids, _ = self.search(q='QUICK brown')
+        self.assertEqual(ids, [self.messages['dog'].id, self.messages['fox'].id])
+        ids, _ = self.search(q='quick brown', chat_id=self.chat.id)
+        self.assertEqual(ids, [self.messages['fox'].id])
+        ids, _ = self.search(q='quick cat')
+        self.assertEqual(ids, [])
+
+    def test_pages_back_with_before_id(self):
+        self.backfill()
+
+        seen, data = self.search(q='quick', limit=1)
+        while data['has_more']:
+            ids, data = self.search(q='quick', limit=1, before_id=data['before_id'])
+            seen += ids
+        self.assertEqual(seen, [self.messages[name].id for name in ('dog', 'thinking', 'fox')])
+
+    def test_index_collisions_are_filtered_out(self):
+        from .models import MessageSearchToken
+        from .search import word_token
+
+        self.backfill()
+        # Truncated hashes may collide: the index claims 'brown' for 'quick thinking'
+        thinking = self.messages['thinking']
+        MessageSearchToken.objects.create(message=thinking, group_id=thinking.group_id, token=word_token('brown'))
+
+        ids, _ = self.search(q='quick brown', chat_id=self.chat.id)
+        self.assertEqual(ids, [self.messages['fox'].id])
+
+
+class PresenceHeartbeatTests(TestCase):
+    async def test_silent_connection_drops_out(self):
+        import asyncio
+        from types import SimpleNamespace
+        from .presence import MemoryPresenceStore, PresenceRegistry
+
+        registry = PresenceRegistry(MemoryPresenceStore(ttl=0.2), heartbeat_interval=3600, flush_interval=3600)
+        active, silent = SimpleNamespace(id=1, username='active'), SimpleNamespace(id=2, username='silent')
+        await registry.join('room', active, 'active-socket')
+        await registry.join('room', silent, 'silent-socket')
+
+        await asyncio.sleep(0.3)
+        registry.heartbeat('active-socket')
+        offline = await registry.tick()
+
+        self.assertEqual(offline, [('room', 2)])
+        self.assertEqual([user['id'] for user in registry.online_users('room')], [1])
+        registry._task.cancel()
+
+
+@isolated_realtime
+class ChatSocketTests(TransactionTestCase):
+    def setUp(self):
+        from rest_framework.authtoken.models import Token
+
+        self.member = User.objects.create_user(
+            username='member', email='member@example.com', password='password', first_name='M', last_name='Ember'
+        )
+        self.outsider = User.objects.create_user(
+            username='outsider', email='outsider@example.com', password='password', first_name='O', last_name='Utsider'
+        )
+        self.tokens = {user: Token.objects.create(user=user).key for user in (self.member, self.outsider)}
+        self.group = ChatGroup.objects.create(name='room1')
+        self.group.members.add(self.member)
+
+    def communicator(self, user, room='room1', query=''):
+        from channels.testing import WebsocketCommunicator
+        from pet_society.asgi import application
+
+        return WebsocketCommunicator(
+            application, f'/ws/chat/{room}/?token={self.tokens[user]}{query}', headers=[(b'origin', b'http://localhost')]
+        )
+
+    async def frames(self, communicator, frame_type=None):
+        frames = []
+        while not await communicator.receive_nothing(timeout=0.3):
+            frames.append(await communicator.receive_json_from())
+        return [frame for frame in frames if frame_type is None or frame['type'] in frame_type]
+
+    async def test_unknown_room_closes_with_4004(self):
+        connected, close_code = await self.communicator(self.member, room='nowhere').connect()
+
+        self.assertFalse(connected)
+        self.assertEqual(close_code, 4004)
+
+    async def test_non_member_closes_with_4003_and_is_not_added(self):
+        from asgiref.sync import sync_to_async
+
+        connected, close_code = await self.communicator(self.outsider).connect()
+
+        self.assertFalse(connected)
+        self.assertEqual(close_code, 4003)
+        members = await sync_to_async(lambda: list(self.group.members.values_list('id', flat=True)))()
+        self.assertEqual(members, [self.member.id])
+
+    async def test_message_costs_one_insert(self):
+        from unittest import mock
+        from django.db.backends.utils import CursorWrapper
+
+        communicator = self.communicator(self.member)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await self.frames(communicator)
+
+        # Patched on the class: the consumer's queries run in a worker thread
+        statements = []
+        execute = CursorWrapper.execute
+
+        def record(cursor, sql, params=None):
+            statements.append(sql)
+            return execute(cursor, sql, params)
+
+        with mock.patch.object(CursorWrapper, 'execute', record):
+            await communicator.send_json_to({'type': 'chat_message', 'message': 'hello'})
+            sent = await self.frames(communicator, ('chat_message',))
+
+        self.assertEqual([frame['message'] for frame in sent], ['hello'])
+        writes = [
+            sql.split('"')[1] for sql in statements if sql.lstrip().upper().startswith(('INSERT', 'UPDATE', 'DELETE'))
+        ]
+        # One row for the message, plus its search tokens in one bulk insert;
+        # nothing touches membership
+        self.assertEqual(writes, ['chats_groupmessage', 'chats_messagesearchtoken'])
+        await communicator.disconnect()
+
+    def add_messages(self, count):
+        from .encryption import message_storage_fields
+
+        return [
+            GroupMessage.objects.create(group=self.group, author=self.member, **message_storage_fields(f'm{i}')).id
+            for i in range(count)
+        ]
+
+    async def resume(self, after_id):
+        communicator = self.communicator(self.member, query=f'&after_id={after_id}')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator, await self.frames(communicator, ('chat_message', 'resume_gap', 'resume_complete'))
+
+    async def test_resume_replays_missed_messages(self):
+        from asgiref.sync import sync_to_async
+
+        ids = await sync_to_async(self.add_messages)(5)
+
+        communicator, frames = await self.resume(ids[2])
+
+        self.assertEqual([(frame['type'], frame.get('message_id')) for frame in frames], [
+            ('chat_message', ids[3]), ('chat_message', ids[4]), ('resume_complete', None),
+        ])
+        self.assertEqual([frame['message'] for frame in frames[:2]], ['m3', 'm4'])
+        self.assertTrue(all(frame['replayed'] for frame in frames[:2]))
+        self.assertEqual((frames[2]['count'], frames[2]['last_id']), (2, ids[4]))
+        await communicator.disconnect()
+
+    async def test_resume_past_the_limit_signals_a_gap(self):
+        from asgiref.sync import sync_to_async
+
+        ids = await sync_to_async(self.add_messages)(5)
+
+        with self.settings(CHAT_RESUME_LIMIT=3):
+            communicator, frames = await self.resume(ids[0])
+
+        self.assertEqual(frames[0], {'type': 'resume_gap', 'after_id': ids[0], 'before_id': ids[2]})
+        self.assertEqual([frame.get('message_id') for frame in frames[1:4]], ids[2:])
+        self.assertEqual(frames[4]['type'], 'resume_complete')
+        await communicator.disconnect()
+
+    async def test_live_messages_covered_by_the_replay_are_skipped(self):
+        from asgiref.sync import sync_to_async
+        from channels.layers import get_channel_layer
+        from .frames import encode_frame
+        from .groups import room_group_name
+
+        ids = await sync_to_async(self.add_messages)(3)
+        communicator, frames = await self.resume(ids[0])
+        self.assertEqual(frames[-1]['last_id'], ids[2])
+
+        # Broadcasts racing the replay: one it already sent, one it did not
+        for message_id in (ids[2], ids[2] + 1):
+            await get_channel_layer().group_send(room_group_name('room1'), {
+                'type': 'chat_message',
+                'room': 'room1',
+                'message_id': message_id,
+                'frame': encode_frame({'type': 'chat_message', 'message_id': message_id, 'message': 'live'}),
+            })
+
+        live = await self.frames(communicator, ('chat_message',))
+        self.assertEqual([frame['message_id'] for frame in live], [ids[2] + 1])
+        await communicator.disconnect()
+
+
+class TypingCoordinatorTests(TestCase):
+    class FakeLayer:
+        def __init__(self):
+            self.sent = []
+
+        async def group_send(self, group, message):
+            self.sent.append(message['is_typing'])
+
+    class FakeSocket:
+        def __init__(self, user_id):
+            from types import SimpleNamespace
+
+            self.user = SimpleNamespace(id=user_id)
+            self.frames = []
+
+        async def send_frame(self, frame, droppable=False, replaces=None):
+            import json
+
+            self.frames.append(json.loads(frame))
+
+    def setUp(self):
+        from types import SimpleNamespace
+        from unittest import mock
+
+        # Only the coordinator's clock; the event loop keeps the real one
+        self.now = 1000.0
+        clock = mock.patch('chats.typing.time', SimpleNamespace(monotonic=lambda: self.now))
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def coordinator(self, **kwargs):
+        from .typing import TypingCoordinator
+
+        # Trailing sends are timed by the event loop, so the throttle stays short
+        coordinator = TypingCoordinator(**{'throttle': 0.05, 'timeout': 6.0, 'cadence': 3600, **kwargs})
+        self.addCleanup(lambda: coordinator._task and coordinator._task.cancel())
+        return coordinator
+
+    def event(self, user_id, is_typing, username=None):
+        return {'user_id': user_id, 'username': username or f'user{user_id}', 'is_typing': is_typing}
+
+    async def test_throttle_sends_leading_and_trailing_edges(self):
+        import asyncio
+        from types import SimpleNamespace
+
+        coordinator, layer = self.coordinator(), self.FakeLayer()
+        alice, bob = SimpleNamespace(id=1, username='alice'), SimpleNamespace(id=2, username='bob')
+
+        await coordinator.update(layer, 'room', alice, True)
+        self.now += 0.01
+        await coordinator.update(layer, 'room', alice, True)
+        await coordinator.update(layer, 'room', alice, False)
+        self.assertEqual(layer.sent, [True])  # Leading edge only, so far
+
+        await asyncio.sleep(0.1)
+        self.assertEqual(layer.sent, [True, False])  # Trailing edge: the last state
+
+        # A change undone within the window sends nothing more
+        layer.sent = []
+        self.now += 1
+        await coordinator.update(layer, 'room', bob, True)
+        self.now += 0.01
+        await coordinator.update(layer, 'room', bob, False)
+        await coordinator.update(layer, 'room', bob, True)
+        await asyncio.sleep(0.1)
+        self.assertEqual(layer.sent, [True])
+
+    async def test_typers_expire_or_stop_explicitly(self):
+        coordinator, socket = self.coordinator(), self.FakeSocket(99)
+        coordinator.register('room', socket)
+
+        coordinator.receive('room', self.event(1, True))
+        coordinator.receive('room', self.event(2, True))
+        await coordinator.tick()
+        self.assertEqual([user['id'] for user in socket.frames[-1]['users']], [1, 2])
+
+        coordinator.receive('room', self.event(1, False))
+        await coordinator.tick()
+        self.assertEqual([user['id'] for user in socket.frames[-1]['users']], [2])
+
+        # No refresh within the timeout
+        self.now += 6.5
+        await coordinator.tick()
+        self.assertEqual(socket.frames[-1], {'type': 'typing_update', 'users': [], 'text': ''})
+
+        frames = len(socket.frames)
+        await coordinator.tick()
+        self.assertEqual(len(socket.frames), frames)  # Nothing changed, nothing sent
+
+    async def test_aggregated_text(self):
+        from .typing import typing_text
+
+        self.assertEqual(typing_text(['A']), 'A is typing')
+        self.assertEqual(typing_text(['A', 'B', 'C']), 'A, B and C are typing')
+        self.assertEqual(typing_text(['A', 'B', 'C', 'D', 'E']), 'A, B and 3 others are typing')
+
+        coordinator = self.coordinator()
+        watcher, typer = self.FakeSocket(99), self.FakeSocket(1)
+        coordinator.register('room', watcher)
+        coordinator.register('room', typer)
+        for user_id, name in enumerate('ABCDE', start=1):
+            coordinator.receive('room', self.event(user_id, True, username=name))
+        await coordinator.tick()
+
+        self.assertEqual(watcher.frames[-1]['text'], 'A, B and 3 others are typing')
+        # A typer's own socket leaves them out
+        self.assertEqual(typer.frames[-1]['text'], 'B, C and 2 others are typing')
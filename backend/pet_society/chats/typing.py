@@ -0,0 +1,200 @@
+import asyncio
+import threading
+import time
+
+from django.conf import settings
+
+from .frames import encode_frame
+from .groups import room_group_name
+
+
+def typing_text(usernames):
+    """'A is typing', 'A and B are typing', 'A, B and 3 others are typing'"""
+    if not usernames:
+        return ''
+    if len(usernames) == 1:
+        return f'{usernames[0]} is typing'
+    if len(usernames) <= 3:
+        return f'{", ".join(usernames[:-1])} and {usernames[-1]} are typing'
+    return f'{usernames[0]}, {usernames[1]} and {len(usernames) - 2} others are typing'
+
+
+class TypingCoordinator:
+    """
+    Throttles typing events and turns them into aggregated room frames.
+
+    Sending side: each (user, room) passes at most one typing event to the
+    channel layer per ``throttle`` seconds. The first event goes out at once
+    (leading edge); if the state changes during the window the last state is
+    sent when the window closes (trailing edge), repeats are dropped.
+
+    Receiving side: every process keeps who is typing in the rooms its sockets
+    are in. Users who sent no refresh for ``timeout`` seconds are treated as
+    having stopped. Every ``cadence`` seconds rooms whose typers changed get
+    one ``typing_update`` frame per local socket, listing everyone typing
+    except the socket's own user.
+    """
+
+    def __init__(self, throttle=2.0, timeout=6.0, cadence=0.5):
+        self.throttle = throttle
+        self.timeout = timeout
+        self.cadence = cadence
+        self._outgoing = {}  # {(user_id, room): {'sent_at', 'state', 'pending', 'handle'}}
+        self._typing = {}  # {room: {user_id: (username, expires at)}}
+        self._sockets = {}  # {room: {consumer}}
+        self._dirty = set()
+        self._task = None
+
+    # Sending side
+
+    async def update(self, channel_layer, room, user, is_typing):
+        """Pass a client's typing state on to the room, throttled"""
+        key = (user.id, room)
+        now = time.monotonic()
+        state = self._outgoing.get(key)
+        if state is None or now - state['sent_at'] >= self.throttle:
+            if state and state['handle']:
+                state['handle'].cancel()
+            self._outgoing[key] = {'sent_at': now, 'state': is_typing, 'pending': None, 'handle': None}
+            self._schedule_trailing(channel_layer, key, user.username, self.throttle)
+            await self._send(channel_layer, room, user.id, user.username, is_typing)
+        else:
+            state['pending'] = is_typing
+
+    def _schedule_trailing(self, channel_layer, key, username, delay):
+        self._outgoing[key]['handle'] = asyncio.get_running_loop().call_later(
+            delay, lambda: asyncio.ensure_future(self._trailing(channel_layer, key, username))
+        )
+
+    async def _trailing(self, channel_layer, key, username):
+        state = self._outgoing.get(key)
+        if state is None:
+            return
+        state['handle'] = None
+        if state['pending'] is None or state['pending'] == state['state']:
+            # Nothing changed; the state is kept while typing so stop() knows
+            state['pending'] = None
+            if not state['state']:
+                del self._outgoing[key]
+            return
+        user_id, room = key
+        self._outgoing[key] = {
+            'sent_at': time.monotonic(), 'state': state['pending'], 'pending': None, 'handle': None,
+        }
+        self._schedule_trailing(channel_layer, key, username, self.throttle)
+        await self._send(channel_layer, room, user_id, username, state['pending'])
+
+    async def stop(self, channel_layer, room, user):
+        """A socket went away; clear its user's typing state right away"""
+        state = self._outgoing.pop((user.id, room), None)
+        if state is None:
+            return
+        if state['handle']:
+            state['handle'].cancel()
+        if state['state'] or state['pending']:
+            await self._send(channel_layer, room, user.id, user.username, False)
+
+    async def _send(self, channel_layer, room, user_id, username, is_typing):
+        await channel_layer.group_send(room_group_name(room), {
+            'type': 'typing_indicator',
+            'room': room,
+            'user_id': user_id,
+            'username': username,
+            'is_typing': is_typing,
+        })
+
+    # Receiving side
+
+    def register(self, room, consumer):
+        self._sockets.setdefault(room, set()).add(consumer)
+
+    def unregister(self, room, consumer):
+        sockets = self._sockets.get(room)
+        if sockets is not None:
+            sockets.discard(consumer)
+            if not sockets:
+                del self._sockets[room]
+                self._typing.pop(room, None)
+                self._dirty.discard(room)
+
+    def receive(self, room, event):
+        """
+        Record a typing event. Every local socket in the room delivers the
+        same event, so this has to be idempotent.
+        """
+        typers = self._typing.setdefault(room, {})
+        if event['is_typing']:
+            if event['user_id'] not in typers:
+                self._dirty.add(room)
+            typers[event['user_id']] = (event['username'], time.monotonic() + self.timeout)
+        elif typers.pop(event['user_id'], None) is not None:
+            self._dirty.add(room)
+        if not typers:
+            del self._typing[room]
+        self._ensure_task()
+
+    def _ensure_task(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while self._typing or self._dirty:
+            await asyncio.sleep(self.cadence)
+            try:
+                await self.tick()
+            except Exception as e:
+                print(f"Typing update error: {e}")
+
+    async def tick(self):
+        """Expire stale typers and send one frame per changed room and socket"""
+        now = time.monotonic()
+        for room, typers in list(self._typing.items()):
+            for user_id, (_, expires) in list(typers.items()):
+                if expires < now:
+                    del typers[user_id]
+                    self._dirty.add(room)
+            if not typers:
+                del self._typing[room]
+
+        dirty, self._dirty = self._dirty, set()
+        for room in dirty:
+            typers = self._typing.get(room, {})
+            frames = {}
+            for consumer in list(self._sockets.get(room, ())):
+                # Only sockets of someone who is typing need their own frame
+                viewer = consumer.user.id if consumer.user.id in typers else None
+                if viewer not in frames:
+                    users = [
+                        {'id': user_id, 'username': username}
+                        for user_id, (username, _) in typers.items()
+                        if user_id != viewer
+                    ]
+                    frames[viewer] = encode_frame({
+                        'type': 'typing_update',
+                        'users': users,
+                        'text': typing_text([user['username'] for user in users]),
+                    })
+                try:
+                    await consumer.send_frame(frames[viewer], droppable=True, replaces='typing_update')
+                except Exception as e:
+                    print(f"Error sending typing update: {e}")
+
+
+_coordinator = None
+_coordinator_lock = threading.Lock()
+
+
+def get_typing_coordinator():
+    """Return the process-wide typing coordinator configured by CHAT_TYPING"""
+    global _coordinator
+    if _coordinator is None:
+        with _coordinator_lock:
+            if _coordinator is None:
+                config = getattr(settings, 'CHAT_TYPING', {})
+                _coordinator = TypingCoordinator(
+                    throttle=config.get('THROTTLE', 2.0),
+                    timeout=config.get('TIMEOUT', 6.0),
+                    cadence=config.get('CADENCE', 0.5),
+                )
+    return _coordinator
@@ -1,9 +1,11 @@
+from django.conf import settings
+from django.db import transaction
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from django.contrib.auth import get_user_model
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
@@ -14,12 +16,24 @@ from .serializers import (
     GroupMessageSerializer,
     UserSerializer
 )
-from .notification_consumer import notify_new_chat_created, notify_user_invited
+from .notification_consumer import notify_new_chat_created, notify_users_invited
+from .membership import add_members, resolve_usernames
 from .encryption import encrypt_message
+from .presence import get_presence_registry
+from .fanout import invalidate_membership
+from .metrics import metrics as chat_metrics
+from .archive import get_message_archive
+from .search import normalize_words, search_message_ids
+from . import inbox
 
 User = get_user_model()
 
 
+def membership_changed(chat_group):
+    """Invalidate cached membership of a chat group in the chat consumers"""
+    async_to_sync(invalidate_membership)(get_channel_layer(), chat_group.name)
+
+
 @method_decorator(csrf_exempt, name='dispatch')
 class ChatGroupViewSet(viewsets.ModelViewSet):
     serializer_class = ChatGroupSerializer
@@ -48,99 +62,86 @@ class ChatGroupViewSet(viewsets.ModelViewSet):
             is_private = request.data.get('is_private', False)
 
             if invite_user and is_private:
-                # Validate if the user exists before proceeding
-                if not User.objects.filter(username=invite_user).exists():
+                user_to_invite = User.objects.filter(username=invite_user).first()
+                if user_to_invite is None:
                     return Response(
                         {'error': f'User {invite_user} not found'},
                         status=status.HTTP_404_NOT_FOUND
                     )
-                
-                try:
-                    user_to_invite = User.objects.get(username=invite_user)
-
-                    # Check if private chat already exists between these two users
-                    existing_chat = ChatGroup.objects.filter(
-                        is_private=True,
-                        members=request.user
-                    ).filter(
-                        members=user_to_invite
-                    ).first()
-
-                    if existing_chat:
-                        # Return existing chat instead of creating new one
-                        return Response(
-                            ChatGroupSerializer(existing_chat).data,
-                            status=status.HTTP_200_OK
-                        )
-
-                except User.DoesNotExist:
-                    pass  # Continue with creation if user not found
-
-            chat_group = serializer.save()
-            chat_group.members.add(request.user)
-
-            # Handle single user invitation
-            if invite_user:
-                try:
-                    user_to_invite = User.objects.get(username=invite_user)
-                    chat_group.members.add(user_to_invite)
-                except User.DoesNotExist:
-                    chat_group.delete()  # Clean up the created chat group
+
+                # One lookup on the unique pair index; returns the existing chat
+                # instead of creating a duplicate, even under concurrent requests
+                chat_group, created, added = ChatGroup.get_or_create_private(
+                    request.user, user_to_invite, **serializer.validated_data
+                )
+                if created:
+                    self._notify_chat_created(request, chat_group)
+                elif added:
+                    # A user who had left is back; consumers must let them in again
+                    membership_changed(chat_group)
+                return Response(
+                    ChatGroupSerializer(chat_group, context=self.get_serializer_context()).data,
+                    status=status.HTTP_201_CREATED if created else status.HTTP_200_OK
+                )
+
+            # Resolve every invitee in one query before creating anything
+            usernames = [invite_user] if invite_user else []
+            invite_users = request.data.get('invite_users')
+            if invite_users and isinstance(invite_users, list):
+                usernames += invite_users
+            if len(usernames) > getattr(settings, 'CHAT_MAX_INVITES', 500):
+                return Response(
+                    {'error': f"At most {getattr(settings, 'CHAT_MAX_INVITES', 500)} users can be invited at once"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            users_to_invite, non_existent_users = resolve_usernames(usernames)
+
+            if non_existent_users:
+                if len(non_existent_users) == 1:
+                    return Response(
+                        {'error': f'User "{non_existent_users[0]}" does not exist'},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+                else:
                     return Response(
-                        {'error': f'User "{invite_user}" does not exist'},
+                        {'error': f'Users {", ".join([repr(u) for u in non_existent_users])} do not exist'},
                         status=status.HTTP_400_BAD_REQUEST
                     )
 
-            # Handle multiple users invitation (for group chats)
-            invite_users = request.data.get('invite_users')
-            if invite_users and isinstance(invite_users, list):
-                non_existent_users = []
-                for username in invite_users:
-                    try:
-                        user_to_invite = User.objects.get(username=username.strip())
-                        chat_group.members.add(user_to_invite)
-                    except User.DoesNotExist:
-                        non_existent_users.append(username.strip())
-                
-                if non_existent_users:
-                    chat_group.delete()  # Clean up the created chat group
-                    if len(non_existent_users) == 1:
-                        return Response(
-                            {'error': f'User "{non_existent_users[0]}" does not exist'},
-                            status=status.HTTP_400_BAD_REQUEST
-                        )
-                    else:
-                        return Response(
-                           
-                            {'error': f'Users {", ".join([repr(u) for u in non_existent_users])} do not exist'},
-                            status=status.HTTP_400_BAD_REQUEST
-                        )
+            with transaction.atomic():
+                chat_group = serializer.save()
+                add_members(chat_group, [request.user, *users_to_invite])
 
             # Send real-time notifications to all members
-            channel_layer = get_channel_layer()
-            member_ids = list(chat_group.members.values_list('id', flat=True))
-
-            if channel_layer:
-                async_to_sync(notify_new_chat_created)(
-                    channel_layer,
-                    chat_group.id,
-                    chat_group.name,
-                    chat_group.is_private,
-                    request.user.id,
-                    member_ids
-                )
+            self._notify_chat_created(request, chat_group)
 
             return Response(
-                ChatGroupSerializer(chat_group).data,
+                ChatGroupSerializer(chat_group, context=self.get_serializer_context()).data,
                 status=status.HTTP_201_CREATED
             )
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    def _notify_chat_created(self, request, chat_group):
+        """Tell every member of a new chat group about it in real time"""
+        channel_layer = get_channel_layer()
+        member_ids = list(chat_group.members.values_list('id', flat=True))
+
+        if channel_layer:
+            async_to_sync(notify_new_chat_created)(
+                channel_layer,
+                chat_group.id,
+                chat_group.name,
+                chat_group.is_private,
+                request.user.id,
+                member_ids
+            )
+
     @action(detail=True, methods=['post'])
     def join(self, request, pk=None):
         """Join a chat group"""
         chat_group = self.get_object()
         chat_group.members.add(request.user)
+        membership_changed(chat_group)
         return Response({'status': 'joined'})
 
     @action(detail=True, methods=['post'])
@@ -149,8 +150,93 @@ class ChatGroupViewSet(viewsets.ModelViewSet):
         chat_group = self.get_object()
         chat_group.members.remove(request.user)
         chat_group.users_online.remove(request.user)
+        get_presence_registry().remove_user(chat_group.name, request.user.id)
+        membership_changed(chat_group)
         return Response({'status': 'left'})
 
+    @action(detail=True, methods=['post'])
+    def invite_users(self, request, pk=None):
+        """
+        Invite many users to the chat group at once: ``{"usernames": [...]}``.
+        Users that exist are added and notified; the response lists them,
+        those already in the group and the usernames that matched nobody.
+        """
+        chat_group = self.get_object()
+        usernames = request.data.get('usernames')
+        max_invites = getattr(settings, 'CHAT_MAX_INVITES', 500)
+
+        if not usernames or not isinstance(usernames, list):
+            return Response(
+                {'error': 'usernames must be a non-empty list'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(usernames) > max_invites:
+            return Response(
+                {'error': f'At most {max_invites} users can be invited at once'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if chat_group.is_private:
+            return Response(
+                {'error': 'Private chats cannot have more members'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        users, invited, missing = self._add_invitees(request, chat_group, usernames)
+        invited_ids = {user.id for user in invited}
+        return Response({
+            'invited': UserSerializer(invited, many=True).data,
+            'already_members': [user.username for user in users if user.id not in invited_ids],
+            'missing': missing,
+        })
+
+    def _add_invitees(self, request, chat_group, usernames):
+        """
+        Resolve and add users in bulk, then invalidate membership and notify
+        the new members. Returns ``(users found, users added, missing usernames)``.
+        """
+        users, missing = resolve_usernames(usernames)
+        invited = add_members(chat_group, users)
+        if invited:
+            membership_changed(chat_group)
+            async_to_sync(notify_users_invited)(
+                get_channel_layer(),
+                chat_group.id,
+                chat_group.name,
+                chat_group.is_private,
+                request.user.id,
+                [user.id for user in invited]
+            )
+        return users, invited, missing
+
+    @action(detail=True, methods=['get'])
+    def members(self, request, pk=None):
+        """Page through a group's members by user id: ?after_id= and ?limit="""
+        chat_group = self.get_object()
+        try:
+            limit = int(request.query_params.get('limit', 50))
+            after_id = request.query_params.get('after_id')
+            after_id = int(after_id) if after_id else None
+        except ValueError:
+            return Response(
+                {'error': 'limit and after_id must be integers'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        limit = max(1, min(limit, 200))
+
+        members_queryset = chat_group.members.order_by('id')
+        if after_id is not None:
+            members_queryset = members_queryset.filter(id__gt=after_id)
+        members = list(members_queryset[:limit + 1])
+        has_more = len(members) > limit
+        members = members[:limit]
+
+        return Response({
+            'members': UserSerializer(members, many=True).data,
+            'has_more': has_more,
+            'limit': limit,
+            'after_id': members[-1].id if members else after_id,
+        })
+
     @action(detail=True, methods=['post'])
     def mark_as_read(self, request, pk=None):
         """Mark all messages in this chat as read for the current user"""
@@ -182,31 +268,47 @@ class ChatGroupViewSet(viewsets.ModelViewSet):
     def messages(self, request, pk=None):
         """Get messages for a chat group with pagination support"""
         chat_group = self.get_object()
-        
+
+        # Keyset mode: ?before_id=, ?after_id= or just ?limit= for the newest page
+        if any(param in request.query_params for param in ('before_id', 'after_id', 'limit')):
+            return self._keyset_messages(request, chat_group)
+
         # Get pagination parameters
         page = int(request.query_params.get('page', 1))
         page_size = int(request.query_params.get('page_size', 50))
         before_message_id = request.query_params.get('before_message_id')
-        
+
         # Start with all messages, ordered by creation date (newest first)
         messages_queryset = chat_group.messages.all().order_by('-created')
-        
+        archive = get_message_archive()
+        archive_before_id = None
+
         # If before_message_id is provided, get messages before that message
         if before_message_id:
             try:
                 before_message = chat_group.messages.get(id=before_message_id)
                 messages_queryset = messages_queryset.filter(created__lt=before_message.created)
-            except GroupMessage.DoesNotExist:
-                pass
-        
-        # Apply pagination
+                archive_before_id = before_message.id
+            except (GroupMessage.DoesNotExist, ValueError):
+                # Archived messages all come before the rows still in the table
+                if str(before_message_id).isdigit() and archive.contains(chat_group.id, int(before_message_id)):
+                    messages_queryset = messages_queryset.none()
+                    archive_before_id = int(before_message_id)
+
+        # Apply pagination, fetching one extra row to know if there are more messages
         start = (page - 1) * page_size
         end = start + page_size
-        messages = messages_queryset[start:end]
-        
-        # Check if there are more messages
-        has_more = messages_queryset.count() > end
-        
+        messages = list(messages_queryset.select_related('author', 'media')[start:end + 1])
+        if len(messages) <= page_size:
+            # Past the newest rows: continue into the archived history
+            in_table = start + len(messages) if messages else messages_queryset.count()
+            messages += archive.messages_before(
+                chat_group.id, archive_before_id, page_size + 1 - len(messages),
+                offset=max(0, start - in_table),
+            )
+        has_more = len(messages) > page_size
+        messages = messages[:page_size]
+
         serializer = GroupMessageSerializer(messages, many=True)
         return Response({
             'messages': serializer.data,
@@ -215,6 +317,63 @@ class ChatGroupViewSet(viewsets.ModelViewSet):
             'page_size': page_size
         })
 
+    def _keyset_messages(self, request, chat_group):
+        """
+        Id-based pagination over a group's messages.
+
+        ``before_id`` scrolls back through history, ``after_id`` catches up on
+        messages sent after the client's last seen id (e.g. after a reconnect).
+        Every page is a single range scan on the (group, id) index, no COUNT.
+        Messages are always returned newest first.
+        """
+        try:
+            limit = int(request.query_params.get('limit', 50))
+            before_id = request.query_params.get('before_id')
+            after_id = request.query_params.get('after_id')
+            before_id = int(before_id) if before_id else None
+            after_id = int(after_id) if after_id else None
+        except ValueError:
+            return Response(
+                {'error': 'limit, before_id and after_id must be integers'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        limit = max(1, min(limit, 200))
+
+        messages_queryset = GroupMessage.objects.filter(group=chat_group).select_related('author', 'media')
+        if before_id is not None:
+            messages_queryset = messages_queryset.filter(id__lt=before_id)
+        archive = get_message_archive()
+
+        if after_id is not None:
+            # Walk forward from the cursor so a catch-up never skips messages;
+            # archived messages all come before the rows still in the table
+            messages = archive.messages_after(chat_group.id, after_id, limit + 1)
+            if before_id is not None:
+                messages = [message for message in messages if message.id < before_id]
+            messages_queryset = messages_queryset.filter(id__gt=after_id).order_by('id')
+            messages += list(messages_queryset[:limit + 1 - len(messages)])
+            has_more = len(messages) > limit
+            messages = messages[:limit][::-1]
+        else:
+            messages_queryset = messages_queryset.order_by('-id')
+            messages = list(messages_queryset[:limit + 1])
+            if len(messages) <= limit:
+                # Past the oldest row in the table: continue into the archive
+                messages += archive.messages_before(
+                    chat_group.id, messages[-1].id if messages else before_id, limit + 1 - len(messages)
+                )
+            has_more = len(messages) > limit
+            messages = messages[:limit]
+
+        serializer = GroupMessageSerializer(messages, many=True)
+        return Response({
+            'messages': serializer.data,
+            'has_more': has_more,
+            'limit': limit,
+            'before_id': messages[-1].id if messages else before_id,
+            'after_id': messages[0].id if messages else after_id,
+        })
+
     @action(detail=True, methods=['post'])
     def send_message(self, request, pk=None):
         """Send a message to a chat group"""
@@ -249,6 +408,60 @@ class ChatGroupViewSet(viewsets.ModelViewSet):
             'total_unread_count': total_unread
         })
 
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """
+        Search the text messages of the user's chats for every word of ?q=.
+
+        Matches are found through the blind index (see chats.search), and only
+        the returned page is decrypted. Optional ?chat_id= narrows the search
+        to one chat; ?before_id= and ?limit= page back through older matches.
+        """
+        query = request.query_params.get('q', '').strip()
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', 20)), 50))
+            before_id = request.query_params.get('before_id')
+            before_id = int(before_id) if before_id else None
+            chat_id = request.query_params.get('chat_id')
+            chat_id = int(chat_id) if chat_id else None
+        except ValueError:
+            return Response(
+                {'error': 'limit, before_id and chat_id must be integers'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not normalize_words(query):
+            return Response({'error': 'q must contain a word to search for'}, status=status.HTTP_400_BAD_REQUEST)
+
+        chat_groups = self.get_queryset()
+        if chat_id is not None:
+            chat_groups = chat_groups.filter(id=chat_id)
+        group_names = dict(chat_groups.values_list('id', 'name'))
+
+        message_ids = search_message_ids(query, list(group_names), before_id=before_id, limit=limit + 1)
+        has_more = len(message_ids) > limit
+        message_ids = message_ids[:limit]
+        messages = list(GroupMessage.objects.filter(id__in=message_ids).select_related('author', 'media').order_by('-id'))
+
+        serializer = GroupMessageSerializer(messages, many=True, context={'request': request})
+        words = set(normalize_words(query))
+        results = [
+            # Index tokens are truncated hashes; drop the odd collision
+            dict(data, chat_id=message.group_id, chat_name=group_names[message.group_id])
+            for message, data in zip(messages, serializer.data)
+            if words <= set(normalize_words(data['message']))
+        ]
+        return Response({
+            'results': results,
+            'has_more': has_more,
+            'limit': limit,
+            'before_id': message_ids[-1] if message_ids else before_id,
+        })
+
+    @action(detail=False, methods=['get'], permission_classes=[IsAdminUser])
+    def metrics(self, request):
+        """Websocket counters of the process serving this request"""
+        return Response(chat_metrics.snapshot())
+
     @action(detail=True, methods=['post'])
     def invite_user(self, request, pk=None):
         """Invite a user to the chat group"""
@@ -261,20 +474,71 @@ class ChatGroupViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        try:
-            user_to_invite = User.objects.get(username=username)
-            chat_group.members.add(user_to_invite)
-            return Response({
-                'message': f'User {username} invited to {chat_group.name}',
-                'user': UserSerializer(user_to_invite).data
-            })
-        except User.DoesNotExist:
+        if chat_group.is_private:
+            return Response(
+                {'error': 'Private chats cannot have more members'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # The bulk invite with a single username
+        users, _, missing = self._add_invitees(request, chat_group, [username])
+        if missing or not users:
             return Response(
                 {'error': f'User {username} not found'},
                 status=status.HTTP_404_NOT_FOUND
             )
+        return Response({
+            'message': f'User {username} invited to {chat_group.name}',
+            'user': UserSerializer(users[0]).data
+        })
 
 
+class NotificationViewSet(viewsets.ViewSet):
+    """The current user's notification inbox (see chats.inbox)"""
+    permission_classes = [IsAuthenticated]
 
+    def list(self, request):
+        """
+        ``?after_id=`` catches up after a cursor, oldest first, like the
+        backlog sent on connect; otherwise pages back from ``?before_id=``,
+        newest first.
+        """
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', 50)), 200))
+            after_id = request.query_params.get('after_id')
+            before_id = request.query_params.get('before_id')
+            after_id = int(after_id) if after_id else None
+            before_id = int(before_id) if before_id else None
+        except ValueError:
+            return Response(
+                {'error': 'limit, before_id and after_id must be integers'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
+        if after_id is not None:
+            notifications, has_more = inbox.pending_notifications(request.user.id, after_id, limit)
+        else:
+            notifications, has_more = inbox.recent_notifications(request.user.id, before_id, limit)
+        return Response({
+            'notifications': notifications,
+            'has_more': has_more,
+            'limit': limit,
+        })
 
+    @action(detail=False, methods=['get'])
+    def badge(self, request):
+        """Unread notification count, read from a maintained counter"""
+        return Response({'unread_count': inbox.unread_count(request.user.id)})
+
+    @action(detail=False, methods=['post'])
+    def read(self, request):
+        """Mark notifications read up to ``through_id``, or all of them"""
+        through_id = request.data.get('through_id')
+        try:
+            through_id = int(through_id) if through_id is not None else None
+        except (TypeError, ValueError):
+            return Response(
+                {'error': 'through_id must be an integer'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response({'unread_count': inbox.mark_read(request.user.id, through_id)})
@@ -12,7 +12,6 @@ import os
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.security.websocket import AllowedHostsOriginValidator
-from chats.middleware import TokenAuthMiddlewareStack
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pet_society.settings')
 
@@ -21,6 +20,7 @@ django_asgi_application = get_asgi_application()
 
 # Import routing after Django is set up
 from chats import routing
+from chats.middleware import TokenAuthMiddlewareStack
 application = ProtocolTypeRouter({
     "http": django_asgi_application,
     "websocket": AllowedHostsOriginValidator(
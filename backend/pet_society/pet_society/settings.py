@@ -24,6 +24,28 @@ SECRET_KEY = 'django-insecure-+w@we&^dwf0oc*uz$fs4jlfsx5_po=e08a1gvh!om!=x=-#02*
 
 # Encryption key for chat messages
 ENCRYPTION_KEY = '6aYeOKM2f-YYbtwCoSGf2lddSzoCJ6aKVxg3OgtyI8A='
+# Id recorded on messages encrypted with ENCRYPTION_KEY. To rotate, move the old
+# key into ENCRYPTION_LEGACY_KEYS under its id, set a new key and id, then run
+# `manage.py rotate_encryption_key`.
+ENCRYPTION_KEY_ID = 'default'
+ENCRYPTION_LEGACY_KEYS = {}
+# Decrypted-message LRU size and thread pool used for batch decryption of history pages
+CHAT_DECRYPT_CACHE_SIZE = 4096
+CHAT_DECRYPT_WORKERS = 4
+CHAT_DECRYPT_PARALLEL_THRESHOLD = 64
+# Key of the chat search blind index (HMAC of normalized words, see chats.search).
+# Kept apart from ENCRYPTION_KEY so either can rotate; after changing it run
+# `manage.py index_chat_messages --rebuild`.
+CHAT_SEARCH_KEY = 'DM51ldMtHfKm8W52exI3RogwXcb2seaeQSVc4rgIhqY='
+# Words shorter than this are not indexed; at most this many words per message
+CHAT_SEARCH_MIN_WORD_LENGTH = 2
+CHAT_SEARCH_MAX_TOKENS = 100
+# Text messages at least this many bytes long are zlib-compressed before encryption
+CHAT_COMPRESS_THRESHOLD = 256
+# Websocket clients that negotiate a binary subprotocol (see chats.frames) get
+# frames of at least this many bytes raw-deflated at this zlib level
+CHAT_FRAME_COMPRESS_THRESHOLD = 512
+CHAT_FRAME_COMPRESS_LEVEL = 6
 
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
@@ -91,12 +113,140 @@ TEMPLATES = [
 
 ASGI_APPLICATION = 'pet_society.asgi.application'
 
+# Shared by every daphne/gunicorn process on this machine through a SQLite WAL
+# database, so group_send from the REST API reaches sockets held by any worker.
+# Use 'channels.layers.InMemoryChannelLayer' for a single-process setup.
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'BACKEND': 'chats.layers.SQLiteChannelLayer',
+        'CONFIG': {
+            'path': BASE_DIR / 'channel_layer.sqlite3',
+            'expiry': 60,
+            'group_expiry': 86400,
+            'capacity': 100,
+        },
     }
 }
 
+# Online presence for chat rooms, kept next to the channel layer so every
+# process sees the same users. Use 'chats.presence.MemoryPresenceStore' for a
+# single-process setup.
+CHAT_PRESENCE = {
+    'BACKEND': 'chats.presence.SQLitePresenceStore',
+    'CONFIG': {
+        'path': BASE_DIR / 'channel_layer.sqlite3',
+        'ttl': 90,
+    },
+    'HEARTBEAT_INTERVAL': 30,
+    'FLUSH_INTERVAL': 30,
+    # Joins/leaves within this many seconds are merged into one presence_delta
+    'DEBOUNCE': 0.5,
+}
+
+# Chat notification fan-out: concurrent sends per batch, the window in which
+# message notifications to one user are coalesced, and membership cache TTL
+CHAT_NOTIFICATIONS = {
+    'BATCH_SIZE': 100,
+    'COALESCE_WINDOW': 2.0,
+    'MEMBERSHIP_TTL': 60,
+}
+
+# Notification inbox (chats.inbox): everything fanned out is also stored per
+# user. Sockets replay up to BACKLOG_LIMIT missed notifications on connect;
+# manage.py prune_notifications deletes read ones older than RETENTION_DAYS.
+CHAT_NOTIFICATION_INBOX = {
+    'BACKLOG_LIMIT': 100,
+    'RETENTION_DAYS': 30,
+}
+
+# Typing indicators: each user passes at most one typing event per THROTTLE
+# seconds, stops counting as typing after TIMEOUT seconds without a refresh,
+# and rooms get an aggregated typing_update frame every CADENCE seconds
+CHAT_TYPING = {
+    'THROTTLE': 2.0,
+    'TIMEOUT': 6.0,
+    'CADENCE': 0.5,
+}
+
+# Most messages replayed to a chat socket resuming with ?after_id=; clients
+# further behind get a resume_gap frame and refetch the rest over REST. Keep it
+# below CHAT_SEND_QUEUE['MAX_DEPTH'].
+CHAT_RESUME_LIMIT = 200
+
+# Frames waiting to be sent on one websocket: at most MAX_DEPTH frames and
+# MAX_BYTES bytes. Frames stay queued while more than MAX_TRANSPORT_BUFFER
+# bytes are still unsent in the server's socket buffer. When full, typing and
+# presence frames are dropped first, then the client is closed with code 4008
+# (resync). Closing a socket first sends the essential frames still queued,
+# for at most DRAIN_TIMEOUT seconds.
+CHAT_SEND_QUEUE = {
+    'MAX_DEPTH': 256,
+    'MAX_BYTES': 1024 * 1024,
+    'MAX_TRANSPORT_BUFFER': 256 * 1024,
+    'DRAIN_TIMEOUT': 1.0,
+}
+
+# Group detail (GET /api/chats/groups/<id>/) carries only the newest MESSAGES
+# messages and the first MEMBERS members and online members; the rest is paged
+# through the messages/ and members/ endpoints it links to.
+CHAT_GROUP_DETAIL = {
+    'MESSAGES': 30,
+    'MEMBERS': 20,
+}
+
+# Most users one request may add to a chat group, on creation (invite_users)
+# or through the bulk invite endpoint
+CHAT_MAX_INVITES = 500
+
+# Idle websockets (chats.idle): a socket whose client has sent nothing for
+# PING_AFTER seconds gets a ping frame, which clients answer with a pong. One
+# quiet for TIMEOUT seconds is closed with code 4010, and its groups and
+# presence are dropped in bulk. Checked every SWEEP_INTERVAL seconds.
+CHAT_IDLE = {
+    'TIMEOUT': 90,
+    'PING_AFTER': 45,
+    'SWEEP_INTERVAL': 15,
+}
+
+# Most rooms one multiplexed socket (ws/multiplex/) may subscribe to at once
+CHAT_MULTIPLEX_MAX_ROOMS = 50
+
+# How chat messages sent over websockets are stored. 'sync' inserts each
+# message before broadcasting it. 'write_behind' broadcasts right away with a
+# provisional id, logs the message to LOG_DIR and bulk-inserts every
+# FLUSH_INTERVAL seconds or BATCH_SIZE messages (see chats.persistence).
+CHAT_PERSISTENCE = {
+    'MODE': 'sync',
+    'LOG_DIR': BASE_DIR / 'chat_wal',
+    'BATCH_SIZE': 200,
+    'FLUSH_INTERVAL': 0.05,
+    # fsync the log on every message; survives power loss, not just crashes
+    'FSYNC': False,
+}
+
+# Chat image uploads are stored once per distinct content. Renditions that fit
+# THUMBNAIL_SIZE (history) and PREVIEW_SIZE (opened image) pixels are made by
+# WORKERS background threads per process; manage.py generate_chat_thumbnails
+# catches up on any that were missed.
+CHAT_MEDIA = {
+    'THUMBNAIL_SIZE': 400,
+    'PREVIEW_SIZE': 1280,
+    'QUALITY': 80,
+    'WORKERS': 2,
+}
+
+# Message retention: manage.py archive_chat_messages moves messages older than
+# RETENTION_DAYS out of GroupMessage into gzipped per-group segments in DIR,
+# CHUNK_SIZE messages per segment. History pagination reads through to them.
+CHAT_ARCHIVE = {
+    'DIR': BASE_DIR / 'chat_archive',
+    'RETENTION_DAYS': 365,
+    'CHUNK_SIZE': 500,
+    'COMPRESS_LEVEL': 6,
+    # Decompressed segments kept in memory per process
+    'CACHE_SIZE': 16,
+}
+
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
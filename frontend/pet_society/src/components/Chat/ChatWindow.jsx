@@ -127,6 +127,10 @@ const ChatWindow = ({ conversation, isMinimized, position, onClose, onMinimize }
     });
 
     const unsubscribeConnection = webSocketService.onConnection((status) => {
+      if (status === 'resync') {
+        loadMessages();
+        return;
+      }
       setConnectionStatus(status);
     });
 
@@ -135,16 +139,8 @@ const ChatWindow = ({ conversation, isMinimized, position, onClose, onMinimize }
     });
 
     const unsubscribeTyping = webSocketService.onTyping((data) => {
-      if (data.is_typing) {
-        setTypingUsers(prev => {
-          if (!prev.find(user => user.id === data.user_id)) {
-            return [...prev, { id: data.user_id, username: data.username }];
-          }
-          return prev;
-        });
-      } else {
-        setTypingUsers(prev => prev.filter(user => user.id !== data.user_id));
-      }
+      // The server sends everyone typing in the room except us
+      setTypingUsers(data.users);
     });
 
     webSocketService.connect(conversation.name);
@@ -28,8 +28,8 @@ const Message = ({ message, isOwnMessage, formatMessageTime }) => {
 
   const renderMessageContent = () => {
     if (message.message_type === 'image') {
-      // Try different image URL possibilities and convert to absolute URL
-      const relativeImageUrl = message.image_url || message.image;
+      // Show the thumbnail in history; the full-size image loads on demand
+      const relativeImageUrl = message.thumbnail_url || message.image_url || message.image;
       const imageUrl = getAbsoluteImageUrl(relativeImageUrl);
       
       if (imageUrl) {
@@ -195,7 +195,7 @@ const Message = ({ message, isOwnMessage, formatMessageTime }) => {
           </IconButton>
           {message.message_type === 'image' && (message.image_url || message.image) && (
             <img
-              src={getAbsoluteImageUrl(message.image_url || message.image)}
+              src={getAbsoluteImageUrl(message.preview_url || message.image_url || message.image)}
               alt="Full size image"
               style={{
                 width: '100%',
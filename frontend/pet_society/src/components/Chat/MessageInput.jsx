@@ -22,6 +22,10 @@ import {
 } from '@mui/icons-material';
 import { useTheme } from '../../context/ThemeContext';
 
+// The server forgets a typer after CHAT_TYPING['TIMEOUT'] (6s) without a
+// refresh, so keep re-sending while the user types; stays above its 2s throttle
+const TYPING_REFRESH_MS = 3000;
+
 const MessageInput = ({ onSendMessage, onSendImage, onTyping, disabled, compact = false }) => {
   const [message, setMessage] = useState('');
   const [isTyping, setIsTyping] = useState(false);
@@ -32,6 +36,7 @@ const MessageInput = ({ onSendMessage, onSendImage, onTyping, disabled, compact
   const inputRef = useRef(null);
   const fileInputRef = useRef(null);
   const typingTimeoutRef = useRef(null);
+  const typingSentAtRef = useRef(0);
   const { theme } = useTheme();
 
   useEffect(() => {
@@ -59,9 +64,11 @@ const MessageInput = ({ onSendMessage, onSendImage, onTyping, disabled, compact
   const handleInputChange = (e) => {
     setMessage(e.target.value);
     
-    // Handle typing indicator
-    if (e.target.value.trim() && !isTyping) {
+    // Handle typing indicator, refreshed while input keeps arriving
+    const now = Date.now();
+    if (e.target.value.trim() && (!isTyping || now - typingSentAtRef.current >= TYPING_REFRESH_MS)) {
       setIsTyping(true);
+      typingSentAtRef.current = now;
       onTyping(true);
     }
 
@@ -79,6 +86,7 @@ const MessageInput = ({ onSendMessage, onSendImage, onTyping, disabled, compact
   const handleStopTyping = () => {
     if (isTyping) {
       setIsTyping(false);
+      typingSentAtRef.current = 0;
       onTyping(false);
     }
     if (typingTimeoutRef.current) {
@@ -88,8 +88,8 @@ export const ChatProvider = ({ children }) => {
         // Reload conversations to get the new chat
         loadConversations();
 
-        // Show notification if available
-        if (window.showChatNotification) {
+        // Show notification if available; missed ones replayed on connect stay quiet
+        if (window.showChatNotification && !data.backlog) {
           window.showChatNotification(
             {
               author: data.created_by || data.invited_by,
@@ -127,7 +127,7 @@ export const ChatProvider = ({ children }) => {
           }, 100);
 
           // Show notification if chat is not currently active
-          if (!isActiveChat && window.showChatNotification) {
+          if (!isActiveChat && !data.backlog && window.showChatNotification) {
             const conversation = {
               id: data.chat_id,
               name: data.chat_name,
@@ -138,6 +138,10 @@ export const chatAPI = {
   inviteUser: (groupId, username) =>
     api.post(`/chats/groups/${groupId}/invite_user/`, { username: username }),
 
+  // Invite many users to a group at once
+  inviteUsers: (groupId, usernames) =>
+    api.post(`/chats/groups/${groupId}/invite_users/`, { usernames }),
+
   // User search and follow functionality for chat
   searchUsers: (query) => authApi.get(`/users/?search=${encodeURIComponent(query)}`),
   getFollowedUsers: () => authApi.get('/users/following/'),
@@ -25,7 +25,10 @@ class GlobalWebSocketService {
       return;
     }
     
-    const wsUrl = `ws://localhost:8000/ws/notifications/${user.id}/?token=${token}`;
+    // Notifications after this id are replayed on connect, so none are missed while offline
+    const cursor = localStorage.getItem(`notificationCursor_${this.user.id}`);
+    const afterId = cursor ? `&after_id=${cursor}` : '';
+    const wsUrl = `ws://localhost:8000/ws/notifications/${user.id}/?token=${token}${afterId}`;
     
     try {
       this.socket = new WebSocket(wsUrl);
@@ -70,6 +73,15 @@ class GlobalWebSocketService {
   }
 
   handleMessage(data) {
+    if (data.notification_id) {
+      // Drop notifications seen before, e.g. both replayed and sent live
+      const cursor = parseInt(localStorage.getItem(`notificationCursor_${this.user.id}`) || '0', 10);
+      if (data.notification_id <= cursor) {
+        return;
+      }
+      localStorage.setItem(`notificationCursor_${this.user.id}`, data.notification_id.toString());
+    }
+
     switch (data.type) {
       case 'new_chat_created':
         this.notifyNewChatHandlers(data);
@@ -90,6 +102,15 @@ class GlobalWebSocketService {
       case 'user_invited':
         this.notifyNewChatHandlers(data);
         break;
+      case 'ping':
+        // Server checking for idle sockets, which it closes with code 4010
+        this.socket.send(JSON.stringify({ type: 'pong', timestamp: data.timestamp }));
+        break;
+      case 'notifications_synced':
+        if (data.after_id) {
+          localStorage.setItem(`notificationCursor_${this.user.id}`, data.after_id.toString());
+        }
+        break;
       default:
         console.log('Unknown message type:', data.type);
     }
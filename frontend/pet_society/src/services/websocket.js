@@ -4,6 +4,7 @@ class WebSocketService {
   constructor() {
     this.socket = null;
     this.roomName = null;
+    this.lastMessageId = null;
     this.reconnectAttempts = 0;
     this.maxReconnectAttempts = 5;
     this.reconnectInterval = 3000;
@@ -54,11 +55,14 @@ class WebSocketService {
     }
   }
 
-  connect(roomName) {
+  connect(roomName, resume = false) {
     if (this.socket && this.socket.readyState === WebSocket.OPEN) {
       this.disconnect();
     }
 
+    if (!resume || roomName !== this.roomName) {
+      this.lastMessageId = null;
+    }
     this.roomName = roomName;
     
     // Get auth token for WebSocket authentication
@@ -69,7 +73,11 @@ class WebSocketService {
       return;
     }
     
-    const wsUrl = `ws://localhost:8000/ws/chat/${roomName}/?token=${token}`;
+    let wsUrl = `ws://localhost:8000/ws/chat/${roomName}/?token=${token}`;
+    // Resuming: the server replays what we missed since the last message
+    if (this.lastMessageId !== null) {
+      wsUrl += `&after_id=${this.lastMessageId}`;
+    }
 
     console.log('Attempting to connect to WebSocket:', wsUrl);
 
@@ -132,9 +140,22 @@ class WebSocketService {
     switch (data.type) {
       case 'chat_message':
         // The message should already be decrypted by the backend
+        if (Number.isInteger(data.message_id)) {
+          this.lastMessageId = Math.max(this.lastMessageId ?? 0, data.message_id);
+        }
         this.notifyMessageHandlers(data);
         break;
-      case 'typing_indicator':
+      case 'resume_gap':
+        // Too much was missed to replay, reload the history
+        this.notifyConnectionHandlers('resync');
+        break;
+      case 'resume_complete':
+        break;
+      case 'ping':
+        // Server checking for idle sockets, which it closes with code 4010
+        this.socket.send(JSON.stringify({ type: 'pong', timestamp: data.timestamp }));
+        break;
+      case 'typing_update':
         this.notifyTypingHandlers(data);
         break;
       case 'user_list_update':
@@ -184,7 +205,7 @@ class WebSocketService {
     
     setTimeout(() => {
       if (this.roomName) {
-        this.connect(this.roomName);
+        this.connect(this.roomName, true);
       }
     }, this.reconnectInterval);
   }